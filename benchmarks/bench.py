@@ -0,0 +1,226 @@
+from __future__ import print_function, division
+
+import torch
+import torch.nn as nn
+import numpy as np
+import os
+import sys
+import json
+import time
+import platform
+import tempfile
+from torchvision import datasets, models, transforms
+
+from benchmarks.synthetic import generate
+from functions import fine_tune as ft
+from functions import stats
+from functions.decode import DraftLoader
+from functions.profiling import read_timing
+
+'''
+CPU benchmark suite.
+
+Times the loader throughput, a train_model step of every algo, the val pass, stats.extractFeats and
+stats.class_based_cirs on synthetic ABID-shaped datasets of several sizes. Every run is stored as
+<results_dir>/<timestamp>.json and compared against the previous run of the directory (or --baseline).
+All results are times, lower is better.
+
+  python -m benchmarks.bench --data /tmp/abid_synth --sizes 64 256
+'''
+
+ALGOS = ['softmax', 'sigmoid', 'KL', 'learn_a', 'fix_a', 'poisson', 'binomial', 'cheng', 'weighted_softmax',
+         'weighted_softmax_2', 'regression']
+
+VAL_TRANSFORM = transforms.Compose([
+    transforms.Resize(256),
+    transforms.CenterCrop(224),
+    transforms.ToTensor(),
+    transforms.Normalize([0.485, 0.456, 0.406], [0.229, 0.224, 0.225])])
+
+
+class _NullWriter(object):
+    def add_scalar(self, *args, **kwargs):
+        pass
+
+
+def algo_kwargs(algo, numOut):
+    '''train_model arguments every algo needs besides its name.'''
+    # Rows of labels k-1, k, k+1 per count, as make_coeff of the notebook
+    window = np.eye(numOut) + np.eye(numOut, k=1) + np.eye(numOut, k=-1)
+    kwargs = {'multi_coeff': window, 'single_coeff': window / window.sum(1, keepdims=True)}
+    if algo == 'sigmoid':
+        kwargs.update(cross_loss=0., multi_loss=1.)
+    elif algo == 'KL':
+        kwargs.update(KL=True)
+    elif algo == 'cheng':
+        kwargs['multi_coeff'] = np.eye(numOut)
+    elif algo == 'weighted_softmax':
+        kwargs.update(multi_loss=1.)
+    elif algo == 'weighted_softmax_2':
+        kwargs['softmax_matrices'] = [(1, torch.eye(numOut))]
+    return kwargs
+
+
+def bench_loader(folder_dir, batch_size=16, num_workers=2, fast_decode=False):
+    '''Milliseconds per image of one pass over the train folder with the val transform.'''
+    kwargs = {'loader': DraftLoader(256)} if fast_decode else {}
+    dset = datasets.ImageFolder(os.path.join(folder_dir, 'train'), VAL_TRANSFORM, **kwargs)
+    loader = torch.utils.data.DataLoader(dset, batch_size=batch_size, num_workers=num_workers)
+    since = time.perf_counter()
+    for inputs, labels in loader:
+        pass
+    return 1000. * (time.perf_counter() - since) / len(dset)
+
+
+def bench_train_step(algo, numOut=6, batch_size=8, steps=4, arch='resnet18'):
+    '''
+    One epoch of train_model on random tensors with stage timing.
+
+    :return: Mean train step (ms) and val pass per image (ms)
+    '''
+    torch.manual_seed(0)
+    n = batch_size * steps
+    dset = torch.utils.data.TensorDataset(torch.randn(n, 3, 224, 224), torch.randint(0, numOut, (n,)))
+    loaders = {x: torch.utils.data.DataLoader(dset, batch_size=batch_size) for x in ['train', 'val']}
+    model = getattr(models, arch)(num_classes=numOut)
+    handle, timing_path = tempfile.mkstemp(suffix='.jsonl')
+    os.close(handle)
+    try:
+        ft.train_model(model, 'sgd', None, loaders, {'train': n, 'val': n}, _NullWriter(), use_gpu=False,
+                       num_epochs=1, batch_size=batch_size, numOut=numOut, algo=algo, logname=None,
+                       timing=True, timing_path=timing_path, **algo_kwargs(algo, numOut))
+        records = {r['phase']: r['stages'] for r in read_timing(timing_path)}
+    finally:
+        os.remove(timing_path)
+    step = sum(s['mean'] for name, s in records['train'].items() if name != 'log')
+    val = 1000. * sum(s['total'] for s in records['val'].values()) / n
+    return step, val
+
+
+def bench_extract_feats(paths, arch='resnet18', batch_size=16):
+    '''Milliseconds per image of stats.extractFeats on the CPU.'''
+    network = getattr(models, arch)()
+    outsize = network.fc.in_features
+    network.fc = nn.Sequential()
+    network.train(False)
+    since = time.perf_counter()
+    with torch.no_grad():
+        stats.extractFeats(paths, network, batchsize=batch_size, outsize=outsize, use_gpu=False)
+    return 1000. * (time.perf_counter() - since) / len(paths)
+
+
+def bench_class_based_cirs(n, repeat=5):
+    '''Milliseconds per call of stats.class_based_cirs on n random labels and predictions.'''
+    rng = np.random.RandomState(0)
+    label = rng.randint(0, 10, n)
+    pred = np.clip(label + rng.randint(-2, 3, n), 0, 9)
+    since = time.perf_counter()
+    for k in range(repeat):
+        stats.class_based_cirs(label, pred)
+    return 1000. * (time.perf_counter() - since) / repeat
+
+
+def run(data_dir, sizes=(64, 256), algos=ALGOS, num_workers=2, batch_size=8, steps=4,
+        cir_sizes=(10000, 1000000), feat_images=32):
+    '''
+    Runs the suite.
+
+    :param data_dir: Synthetic datasets are generated once into <data_dir>/n<size>
+    :return: Dictionary of result name to milliseconds
+    '''
+    results = {}
+    for size in sizes:
+        root = os.path.join(data_dir, 'n{}'.format(size))
+        if not os.path.exists(os.path.join(root, 'folder')):
+            print('Generating {} images into {}'.format(size, root))
+            generate(root, num_images=size)
+        folder = os.path.join(root, 'folder')
+        results['loader/n{}/ms_per_image'.format(size)] = bench_loader(folder, num_workers=num_workers)
+        results['loader_draft/n{}/ms_per_image'.format(size)] = bench_loader(folder, num_workers=num_workers,
+                                                                             fast_decode=True)
+        paths, cir, house, room = stats.subsetCreator(os.path.join(root, 'rooms') + os.sep, im_per_room=0)
+        paths = list(paths[:feat_images])
+        results['extract_feats/n{}/ms_per_image'.format(size)] = bench_extract_feats(paths)
+        print('Size {} done'.format(size))
+
+    for algo in algos:
+        step, val = bench_train_step(algo, batch_size=batch_size, steps=steps)
+        results['train_step/{}/ms'.format(algo)] = step
+        results['val_pass/{}/ms_per_image'.format(algo)] = val
+        print('{}: step {:.1f} ms, val {:.2f} ms/image'.format(algo, step, val))
+
+    for n in cir_sizes:
+        results['class_based_cirs/n{}/ms'.format(n)] = bench_class_based_cirs(n)
+    return results
+
+
+def meta():
+    return {'time': time.strftime('%Y-%m-%d %H:%M:%S'), 'host': platform.node(), 'python': sys.version.split()[0],
+            'torch': torch.__version__, 'threads': torch.get_num_threads()}
+
+
+def latest_result(results_dir):
+    '''Path of the most recent result file of results_dir, None if there is none.'''
+    if not os.path.exists(results_dir):
+        return None
+    files = sorted(f for f in os.listdir(results_dir) if f.endswith('.json'))
+    return os.path.join(results_dir, files[-1]) if files else None
+
+
+def save_result(results, results_dir):
+    if not os.path.exists(results_dir):
+        os.makedirs(results_dir)
+    path = os.path.join(results_dir, time.strftime('%Y%m%d-%H%M%S') + '.json')
+    with open(path, 'w') as f:
+        json.dump({'meta': meta(), 'results': results}, f, indent=1, sort_keys=True)
+    return path
+
+
+def compare(baseline, results, threshold=0.1):
+    '''
+    Prints every result next to its baseline value.
+
+    :return: Names of the results more than threshold slower than the baseline
+    '''
+    slower = []
+    print('{:45s} {:>12s} {:>12s} {:>7s}'.format('benchmark', 'baseline', 'current', 'ratio'))
+    for name in sorted(results):
+        if name not in baseline:
+            print('{:45s} {:>12s} {:12.3f}'.format(name, '-', results[name]))
+            continue
+        ratio = results[name] / max(baseline[name], 1e-12)
+        flag = ''
+        if ratio > 1 + threshold:
+            flag = ' SLOWER'
+            slower.append(name)
+        elif ratio < 1 - threshold:
+            flag = ' faster'
+        print('{:45s} {:12.3f} {:12.3f} {:7.2f}{}'.format(name, baseline[name], results[name], ratio, flag))
+    return slower
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='CPU benchmark suite on synthetic ABID-shaped data')
+    parser.add_argument('--data', default=os.path.join(tempfile.gettempdir(), 'abid_synth'),
+                        help='Directory of the generated datasets')
+    parser.add_argument('--results', default=os.path.join(os.path.dirname(__file__), 'results'),
+                        help='Directory of the JSON results')
+    parser.add_argument('--baseline', default=None, help='Result file to compare with, the latest if not given')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[64, 256])
+    parser.add_argument('--algos', nargs='+', default=ALGOS)
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--threshold', type=float, default=0.1, help='Relative slowdown reported as SLOWER')
+    args = parser.parse_args()
+
+    baseline_path = args.baseline if args.baseline is not None else latest_result(args.results)
+    results = run(args.data, sizes=args.sizes, algos=args.algos, num_workers=args.workers)
+    print('Results written to ' + save_result(results, args.results))
+    if baseline_path is not None:
+        with open(baseline_path) as f:
+            baseline = json.load(f)['results']
+        print('Compared with ' + baseline_path)
+        slower = compare(baseline, results, args.threshold)
+        if slower:
+            print('{} benchmarks slower than the baseline'.format(len(slower)))
@@ -0,0 +1,115 @@
+from __future__ import print_function, division
+
+import numpy as np
+import os
+import json
+import threading
+import time
+
+try:
+    from urllib.request import Request, urlopen
+except ImportError:
+    from urllib2 import Request, urlopen
+
+from functions.profiling import PERCENTILES
+from functions.shards import IMG_EXTENSIONS
+
+'''
+Load generator for the counting server (functions.serving).
+
+concurrency threads post images of a directory (cycled, read into memory once) to /count back to back for
+a number of requests or a duration, then the client side latency percentiles and throughput are printed
+next to the server's /stats.
+
+  python -m benchmarks.loadgen http://127.0.0.1:8080 /data/abid/images --concurrency 16 --requests 2000
+'''
+
+
+def load_images(image_dir, limit=256):
+    '''Bytes of at most limit images below image_dir.'''
+    images = []
+    for root, dirs, files in os.walk(image_dir):
+        dirs.sort()
+        for fname in sorted(files):
+            if fname.lower().endswith(IMG_EXTENSIONS):
+                with open(os.path.join(root, fname), 'rb') as f:
+                    images.append(f.read())
+                if len(images) == limit:
+                    return images
+    return images
+
+
+def post_image(url, data, timeout=60.):
+    request = Request(url + '/count', data=data, headers={'Content-Type': 'application/octet-stream'})
+    return json.loads(urlopen(request, timeout=timeout).read().decode('utf-8'))
+
+
+def run(url, images, concurrency=8, requests=1000, duration=None):
+    '''
+    :param requests: Total number of requests, ignored if duration (s) is given
+
+    :return: Dictionary with the request count, errors, requests per second and latency percentiles (ms)
+    '''
+    latencies = [[] for k in range(concurrency)]
+    errors = [0] * concurrency
+    counter = {'next': 0}
+    lock = threading.Lock()
+    stop = [time.perf_counter() + duration] if duration is not None else None
+
+    def worker(k):
+        while True:
+            with lock:
+                n = counter['next']
+                counter['next'] += 1
+            if stop is not None:
+                if time.perf_counter() >= stop[0]:
+                    return
+            elif n >= requests:
+                return
+            since = time.perf_counter()
+            try:
+                post_image(url, images[n % len(images)])
+            except Exception:
+                errors[k] += 1
+                continue
+            latencies[k].append(1000. * (time.perf_counter() - since))
+
+    since = time.perf_counter()
+    threads = [threading.Thread(target=worker, args=(k,)) for k in range(concurrency)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - since
+
+    ms = np.concatenate([np.asarray(l) for l in latencies])
+    result = {'requests': len(ms), 'errors': sum(errors), 'requests_per_s': len(ms) / elapsed}
+    if len(ms):
+        result['mean_ms'] = float(ms.mean())
+        for p, value in zip(PERCENTILES, np.percentile(ms, PERCENTILES)):
+            result['p{}_ms'.format(p)] = float(value)
+    return result
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Load generator for the counting server')
+    parser.add_argument('url', help='Server address, e.g. http://127.0.0.1:8080')
+    parser.add_argument('image_dir', help='Directory searched recursively for images')
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[8],
+                        help='Concurrent clients, one run per value')
+    parser.add_argument('--requests', type=int, default=1000)
+    parser.add_argument('--duration', type=float, default=None, help='Seconds per run instead of --requests')
+    parser.add_argument('--images', type=int, default=256, help='Number of distinct images sent')
+    args = parser.parse_args()
+
+    url = args.url.rstrip('/')
+    images = load_images(args.image_dir, args.images)
+    print('{} images loaded'.format(len(images)))
+    for concurrency in args.concurrency:
+        result = run(url, images, concurrency, args.requests, args.duration)
+        print('concurrency {}: {}'.format(concurrency, json.dumps(result, sort_keys=True)))
+    server = json.loads(urlopen(url + '/stats').read().decode('utf-8'))
+    print('server: {}'.format(json.dumps({'throughput': server['throughput'], 'batch_size': server['batch_size'],
+                                          'latency_ms': server['latency_ms']}, sort_keys=True)))
@@ -0,0 +1,102 @@
+from __future__ import print_function, division
+
+import numpy as np
+import os
+import json
+import shutil
+from PIL import Image, ImageDraw
+
+'''
+Synthetic ABID-shaped dataset for the benchmarks.
+
+generate writes every image once under images/ and links it into the layouts the code reads:
+
+  images/<id>.jpg, metadata/<id>.json       ABID layout (metadata_index.build_index)
+  folder/{train,val}/<count>/<id>.jpg        per-count ImageFolder tree (data.load_data, shards)
+  rooms/<house>/{BR,Kitchen,LR}/<count>/...  room tree of stats.subsetCreator (counts 1..9)
+
+Images are JPEGs of ABID-like size (about 400-600 x 300-500) with count random boxes on a smooth
+background, so decoding and compression behave like photos rather than flat color.
+'''
+
+ROOMS = ['BR', 'Kitchen', 'LR']
+
+
+def _image(rng, count):
+    width = int(rng.randint(400, 601))
+    height = int(rng.randint(300, 501))
+    # Smooth background, low resolution noise upsampled
+    background = (rng.rand(height // 20 + 1, width // 20 + 1, 3) * 255).astype(np.uint8)
+    im = Image.fromarray(background).resize((width, height), Image.BILINEAR)
+    draw = ImageDraw.Draw(im)
+    for k in range(count):
+        w, h = rng.randint(30, width // 3), rng.randint(30, height // 3)
+        x, y = rng.randint(0, width - w), rng.randint(0, height - h)
+        draw.rectangle([x, y, x + w, y + h], fill=tuple(int(c) for c in rng.randint(0, 256, 3)))
+    return im
+
+
+def _metadata(rng, count):
+    skus = {}
+    remaining = count
+    k = 0
+    while remaining > 0:
+        quantity = int(rng.randint(1, remaining + 1))
+        skus['B{:09d}'.format(k)] = {'quantity': quantity,
+                                     'weight': {'unit': 'pounds', 'value': float(rng.rand() * 3)}}
+        remaining -= quantity
+        k += 1
+    return {'EXPECTED_QUANTITY': int(count), 'BIN_FCSKU_DATA': skus}
+
+
+def _link(src, dst):
+    if not os.path.exists(os.path.dirname(dst)):
+        os.makedirs(os.path.dirname(dst))
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
+
+
+def generate(out_dir, num_images=256, num_classes=6, val_fraction=0.2, houses=2, quality=90, seed=0):
+    '''
+    Writes a synthetic dataset with the counts 0..num_classes-1 equally frequent, every count is present in
+    both phases if num_images >= 2 * num_classes.
+
+    :return: Dictionary of the layout roots (images, metadata, folder, rooms)
+    '''
+    rng = np.random.RandomState(seed)
+    roots = {x: os.path.join(out_dir, x) for x in ['images', 'metadata', 'folder', 'rooms']}
+    for x in ['images', 'metadata']:
+        if not os.path.exists(roots[x]):
+            os.makedirs(roots[x])
+
+    order = np.arange(num_images)
+    val_every = max(1, int(round(1. / val_fraction)))
+    perm = rng.permutation(num_images)
+    counts = (order % num_classes)[perm]
+    phases = np.where((order // num_classes) % val_every == 0, 'val', 'train')[perm]
+    for k in range(num_images):
+        image_id = '{:05d}'.format(k + 1)
+        path = os.path.join(roots['images'], image_id + '.jpg')
+        _image(rng, counts[k]).save(path, quality=quality)
+        with open(os.path.join(roots['metadata'], image_id + '.json'), 'w') as f:
+            json.dump(_metadata(rng, counts[k]), f)
+        _link(path, os.path.join(roots['folder'], phases[k], str(counts[k]), image_id + '.jpg'))
+        if counts[k] >= 1:
+            room_dir = os.path.join(roots['rooms'], 'House{}'.format(k % houses + 1), ROOMS[k % len(ROOMS)],
+                                    str(counts[k]))
+            _link(path, os.path.join(room_dir, image_id + '.jpg'))
+    return roots
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Generate a synthetic ABID-shaped dataset')
+    parser.add_argument('out_dir')
+    parser.add_argument('--num-images', type=int, default=256)
+    parser.add_argument('--num-classes', type=int, default=6)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    print(generate(args.out_dir, args.num_images, args.num_classes, seed=args.seed))
@@ -0,0 +1,97 @@
+from __future__ import print_function, division
+
+import torch
+import numpy as np
+from torchvision import transforms
+
+'''
+Batched augmentation on uint8 tensors.
+
+Workers only decode and resize images to a fixed size and ship them as HxWx3 uint8 tensors (4x smaller
+than float32 over the worker queues). BatchAugment then takes the random crop, the horizontal flip and the
+normalization of the whole batch with a few vectorized ops on the training device, replacing
+RandomCrop/RandomHorizontalFlip/ToTensor/Normalize per image.
+'''
+
+
+class PILToUint8Tensor(object):
+    '''PIL image to HxWx3 uint8 tensor.'''
+
+    def __call__(self, im):
+        return torch.from_numpy(np.array(im.convert('RGB'), dtype=np.uint8))
+
+    def __repr__(self):
+        return self.__class__.__name__ + '()'
+
+
+def uint8_transform(size=256):
+    '''
+    Worker side transform for the batched pipeline. Images are resized to size on the short side and center
+    cropped to a size x size square so that they can be stacked; the 224 crop is taken on the device. A
+    center crop of the square is the crop of Resize(size) + CenterCrop(224), a random crop only ranges over
+    the central square (see batch_transforms).
+    '''
+    return transforms.Compose([transforms.Resize(size), transforms.CenterCrop(size), PILToUint8Tensor()])
+
+
+class BatchAugment(object):
+    '''
+    Crop, flip and normalize a uint8 NxHxWx3 batch into a float Nx3xSxS batch.
+
+    :param crop_size: Output size S
+    :param random_crop: Random crop offsets per image, center crop otherwise
+    :param flip: Random horizontal flip per image with probability 0.5
+    '''
+
+    def __init__(self, crop_size=224, random_crop=True, flip=True, mean=(0.485, 0.456, 0.406),
+                 std=(0.229, 0.224, 0.225)):
+        self.crop_size = crop_size
+        self.random_crop = random_crop
+        self.flip = flip
+        self.mean = np.asarray(mean, dtype=np.float32)
+        self.std = np.asarray(std, dtype=np.float32)
+        self._consts = {}
+
+    def _scale_shift(self, device):
+        if device not in self._consts:
+            scale = torch.from_numpy(1. / (255. * self.std)).view(1, 3, 1, 1).to(device)
+            shift = torch.from_numpy(self.mean / self.std).view(1, 3, 1, 1).to(device)
+            self._consts[device] = (scale, shift)
+        return self._consts[device]
+
+    def __call__(self, batch):
+        n, h, w, c = batch.size()
+        device = batch.device
+        size = self.crop_size
+        if self.random_crop:
+            top = torch.randint(0, h - size + 1, (n,), device=device)
+            left = torch.randint(0, w - size + 1, (n,), device=device)
+        else:
+            top = torch.full((n,), (h - size) // 2, dtype=torch.long, device=device)
+            left = torch.full((n,), (w - size) // 2, dtype=torch.long, device=device)
+        steps = torch.arange(size, device=device)
+        rows = top.view(-1, 1) + steps
+        cols = left.view(-1, 1) + steps
+        if self.flip:
+            flipped = torch.rand(n, device=device) < 0.5
+            cols = torch.where(flipped.view(-1, 1), cols.flip(1), cols)
+
+        # One gather for the crops and flips of the whole batch
+        idx = torch.arange(n, device=device).view(-1, 1, 1)
+        out = batch[idx, rows.view(n, size, 1), cols.view(n, 1, size)]
+        out = out.permute(0, 3, 1, 2).float()
+        scale, shift = self._scale_shift(device)
+        return (out * scale - shift).contiguous()
+
+
+def batch_transforms(crop_size=224):
+    '''
+    BatchAugment for every phase, random crop and flip for training and center crop otherwise.
+
+    Batches are stacked from fixed size squares (uint8_transform, the 256 x 256 records of shards.py), the
+    center crop of an aspect preserving resize. The training crops therefore cover the central square only,
+    not the full long side as RandomCrop after Resize(256) does: the augmentation range is smaller than the
+    one of the per-sample transforms of the notebook on non-square images. Validation crops are the same.
+    '''
+    return {'train': BatchAugment(crop_size, random_crop=True, flip=True),
+            'val': BatchAugment(crop_size, random_crop=False, flip=False)}
@@ -0,0 +1,221 @@
+from __future__ import print_function, division
+
+import torch
+import numpy as np
+import os
+import random
+import threading
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+'''
+Resumable training checkpoints.
+
+A checkpoint holds everything train_model needs to continue a run from a step boundary: model and
+optimizer state, epoch and step, the running metrics of the phase, the best model so far, the RNG states of
+the training process and the state of the training sampler (sample order or seed, position and, with the
+SeededSampler of load_data, the epoch's loader seed). The RNG states replay the draws of the step loop
+(batch transforms, dropout); the per-sample transforms of the datasets are seeded by SeededDataset from the
+loader seed and the sample's position in the epoch, so they replay in any loader worker. States are copied
+to the CPU on the training thread and written by a background CheckpointWriter (to a temporary file renamed
+over the previous checkpoint), so a crash never leaves a half-written checkpoint and the step loop only pays
+for the copy.
+'''
+
+
+def rng_state():
+    '''States of the python, numpy and torch (CPU and CUDA) generators.'''
+    state = {'python': random.getstate(), 'numpy': np.random.get_state(), 'torch': torch.get_rng_state()}
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state):
+    random.setstate(state['python'])
+    np.random.set_state(state['numpy'])
+    torch.set_rng_state(state['torch'])
+    if 'cuda' in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+
+def cpu_copy(obj):
+    '''Copy of a (nested) state with every tensor detached and cloned to the CPU.'''
+    if torch.is_tensor(obj):
+        return obj.detach().cpu().clone()
+    if isinstance(obj, dict):
+        return type(obj)((k, cpu_copy(v)) for k, v in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(cpu_copy(v) for v in obj)
+    return obj
+
+
+class ResumableSampler(torch.utils.data.Sampler):
+    '''
+    Wraps a sampler and keeps the sample order of the current epoch.
+
+    Every epoch draws the order of the wrapped sampler once (the same RNG draws as using it directly).
+    After load_state_dict the next epoch replays the stored order from the stored position instead, so a
+    resumed run sees the remaining batches of the interrupted epoch.
+    '''
+
+    def __init__(self, sampler):
+        self.sampler = sampler
+        self.order = None
+        self.start = 0
+        self._replay = False
+
+    def __len__(self):
+        return len(self.sampler)
+
+    def __iter__(self):
+        if not self._replay:
+            self.order = torch.as_tensor(list(iter(self.sampler)), dtype=torch.long)
+            self.start = 0
+        self._replay = False
+        return iter(self.order[self.start:].tolist())
+
+    def state_dict(self, position):
+        '''
+        :param position: Number of samples of the current order already consumed by the training loop
+        '''
+        return {'order': self.order, 'position': int(position)}
+
+    def load_state_dict(self, state):
+        self.order = state['order']
+        self.start = state['position']
+        self._replay = True
+
+
+class SeededSampler(torch.utils.data.Sampler):
+    '''
+    Wraps a resumable training sampler (ResumableSampler, BalancedSampler) and yields (epoch seed, position,
+    index) keys for a SeededDataset, so that the random transforms of a sample only depend on its position in
+    the epoch's order.
+
+    The epoch seed is drawn from the torch RNG with the epoch's order and stored in state_dict with the state
+    of the wrapped sampler; after load_state_dict the replayed samples get the keys, and the transform draws,
+    of the interrupted epoch whichever loader worker reads them.
+    '''
+
+    def __init__(self, sampler):
+        self.sampler = sampler
+        self.epoch_seed = None
+        self.start = 0
+        self._replay = False
+
+    def __len__(self):
+        return len(self.sampler)
+
+    def set_epoch(self, epoch):
+        if hasattr(self.sampler, 'set_epoch'):
+            self.sampler.set_epoch(epoch)
+
+    def __iter__(self):
+        if not self._replay:
+            self.epoch_seed = int(torch.empty((), dtype=torch.int64).random_(2 ** 31 - 1).item())
+            self.start = 0
+        self._replay = False
+        seed, start = self.epoch_seed, self.start
+        return ((seed, start + k, int(index)) for k, index in enumerate(self.sampler))
+
+    def state_dict(self, position):
+        return {'sampler': self.sampler.state_dict(position), 'epoch_seed': self.epoch_seed,
+                'position': int(position)}
+
+    def load_state_dict(self, state):
+        self.sampler.load_state_dict(state['sampler'])
+        self.epoch_seed = state['epoch_seed']
+        self.start = state['position']
+        self._replay = True
+
+
+class SeededDataset(torch.utils.data.Dataset):
+    '''
+    Dataset read with the keys of a SeededSampler. The python, numpy and torch generators are seeded from
+    (epoch seed, position) for every sample and restored afterwards, so the per-sample transforms draw the
+    same crops and flips in a resumed run, in any worker or in the training process (num_workers=0) without
+    touching its random stream. Plain indices are read without seeding. Other attributes are the dataset's.
+    '''
+
+    def __init__(self, dataset):
+        self.dataset = dataset
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getattr__(self, name):
+        if name == 'dataset':
+            raise AttributeError(name)
+        return getattr(self.dataset, name)
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            return self.dataset[key]
+        epoch_seed, position, index = key
+        seed = int(np.random.SeedSequence([epoch_seed, position]).generate_state(1)[0])
+        state = {'python': random.getstate(), 'numpy': np.random.get_state(), 'torch': torch.get_rng_state()}
+        random.seed(seed)
+        np.random.seed(seed)
+        torch.default_generator.manual_seed(seed)
+        try:
+            return self.dataset[index]
+        finally:
+            random.setstate(state['python'])
+            np.random.set_state(state['numpy'])
+            torch.set_rng_state(state['torch'])
+
+
+class CheckpointWriter(object):
+    '''
+    Writes checkpoints on a background thread.
+
+    save returns once the state is queued; at most one checkpoint waits behind the one being written, a
+    newer one replaces it.
+
+    :param path: Checkpoint file
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self._queue = queue.Queue(maxsize=1)
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            state = self._queue.get()
+            if state is None:
+                self._queue.task_done()
+                break
+            torch.save(state, self.path + '.tmp')
+            os.replace(self.path + '.tmp', self.path)
+            self._queue.task_done()
+
+    def save(self, state):
+        '''Queues a state, it must not share tensors with the training loop (see cpu_copy).'''
+        try:
+            self._queue.get_nowait()
+            self._queue.task_done()
+        except queue.Empty:
+            pass
+        self._queue.put(state)
+
+    def flush(self):
+        self._queue.join()
+
+    def close(self):
+        self._queue.put(None)
+        self._thread.join()
+
+
+def load_checkpoint(path):
+    try:
+        return torch.load(path, map_location='cpu', weights_only=False)
+    except TypeError:
+        # torch without the weights_only argument
+        return torch.load(path, map_location='cpu')
@@ -1,17 +1,55 @@
 import torch
 from torchvision import datasets
 import os
+from functions.shards import ShardDataset, default_shard_transform
+from functions.decode import DraftLoader
+from functions.checkpoint import ResumableSampler, SeededDataset, SeededSampler
+from functions.sampling import BalancedSampler, dataset_labels
 
-def load_data(dataset, data_transforms, uniform_sampler=True, batch_size=16):
-    if dataset == 'real':
+def load_data(dataset, data_transforms, uniform_sampler=True, batch_size=16, shard_dir=None, crop_size=224,
+              batch_augment=False, fast_decode=False, replacement=True, sampler_seed=None, num_workers=12):
+    '''
+    Builds the training and validation loaders.
+
+    :param shard_dir: Directory written by shards.folder_to_shards. If given, the real dataset is read from
+    the memory mapped shards and data_transforms should only hold the post-crop steps (ToTensor, Normalize),
+    crop and flip are taken by ShardDataset. None for data_transforms uses shards.default_shard_transform.
+    :param crop_size: Crop size for the shard dataset
+    :param batch_augment: With shard_dir, the loaders yield the full uint8 records and crop, flip and
+    normalization are left to augment.batch_transforms(crop_size), passed to train_model as batch_transform.
+    Random crops are taken within the square records, so they range over the center of the long side only
+    (as the per-sample crops of the shards, unlike RandomCrop after Resize(256) on the image folders)
+    :param fast_decode: Image folder datasets decode JPEGs at reduced resolution (decode.DraftLoader), the
+    transforms should resize to 256 or less
+    :param replacement: The balanced sampler draws images with replacement within their class (as the former
+    WeightedRandomSampler), otherwise every class is cycled through a reshuffled stream
+    :param sampler_seed: Base seed of the balanced sampler's per-epoch draws, the torch RNG if None
+    :param num_workers: DataLoader workers of every phase, 0 loads in the training process
+
+    :return: dset_loaders, dset_sizes, dset_classes
+    '''
+    folder_kwargs = {'loader': DraftLoader(256)} if fast_decode else {}
+    if dataset == 'real' and shard_dir is not None:
+        if data_transforms is None:
+            data_transforms = {x: default_shard_transform for x in ['train', 'val']}
+        if batch_augment:
+            dsets = {x: ShardDataset(os.path.join(shard_dir, x), None, crop_size=None) for x in ['train', 'val']}
+        else:
+            dsets = {x: ShardDataset(os.path.join(shard_dir, x), data_transforms[x], crop_size=crop_size,
+                                     random_crop=(x == 'train'), flip=(x == 'train'))
+                     for x in ['train', 'val']}
+        dsets_real = dsets
+    elif dataset == 'real':
         data_dir = '..//Data_Sets//pruned//good'
-        dsets = {x: datasets.ImageFolder_mtezcan([os.path.join(data_dir, x)], data_transforms[x])
+        dsets = {x: datasets.ImageFolder_mtezcan([os.path.join(data_dir, x)], data_transforms[x],
+                                                 **folder_kwargs)
                  for x in ['train', 'val']}
         dsets_real = dsets
 
     if dataset == 'mit_indoor':
         data_dir = '..//Data_Sets//MIT_indoor_scenes'
-        dsets = {x: datasets.ImageFolder_mtezcan([os.path.join(data_dir, x)], data_transforms[x])
+        dsets = {x: datasets.ImageFolder_mtezcan([os.path.join(data_dir, x)], data_transforms[x],
+                                                 **folder_kwargs)
                  for x in ['train', 'val']}
         dsets_real = dsets
 
@@ -32,21 +70,31 @@ def load_data(dataset, data_transforms, uniform_sampler=True, batch_size=16):
         roomdirs=['//LR']
         '''
         dsets = {'train': datasets.ImageFolder_mtezcan([rootdir + subdir + room for subdir in subdirs
-                                                        for room in roomdirs], data_transforms['train']),
-                 'val': datasets.ImageFolder_mtezcan([valdir], data_transforms['val'])}
+                                                        for room in roomdirs], data_transforms['train'],
+                                                       **folder_kwargs),
+                 'val': datasets.ImageFolder_mtezcan([valdir], data_transforms['val'], **folder_kwargs)}
 
     if uniform_sampler:
-        weights, wpc = ft.make_weights_for_balanced_classes(dsets['train'].imgs, len(dsets['train'].classes))
-        weights = torch.DoubleTensor(weights)
-        sampler = {'train': torch.utils.data.sampler.WeightedRandomSampler(weights, len(weights)),
+        # Class-balanced draws, the distribution of the balanced WeightedRandomSampler weights
+        sampler = {'train': BalancedSampler(dataset_labels(dsets['train']), replacement=replacement,
+                                            seed=sampler_seed),
                    'val': None}
     else:
-        sampler = {'train': None,
+        # Keeps the epoch's sample order for mid-epoch checkpoints of train_model
+        sampler = {'train': ResumableSampler(torch.utils.data.sampler.RandomSampler(dsets['train'])),
                    'val': None}
 
+    # Training samples are read by (epoch seed, position) keys: their random transforms replay on resume
+    sampler['train'] = SeededSampler(sampler['train'])
+    loader_dsets = {'train': SeededDataset(dsets['train']), 'val': dsets['val']}
+
+    # Pinned batches for the non-blocking copies of train_model's prefetcher, workers kept across epochs
     shuffler = {'train': True, 'val': False}
     dset_loaders = {
-    x: torch.utils.data.DataLoader(dsets[x], batch_size=batch_size, shuffle=shuffler[x], sampler=sampler[x], num_workers=12)
+    x: torch.utils.data.DataLoader(loader_dsets[x], batch_size=batch_size,
+                                  shuffle=shuffler[x] and sampler[x] is None,
+                                  sampler=sampler[x], num_workers=num_workers,
+                                  pin_memory=torch.cuda.is_available(), persistent_workers=num_workers > 0)
     for x in ['train', 'val']}
     dset_sizes = {x: len(dsets[x]) for x in ['train', 'val']}
     dset_classes = dsets['train'].classes
@@ -63,4 +111,6 @@ def load_data(dataset, data_transforms, uniform_sampler=True, batch_size=16):
     if use_gpu:
         print('GPU is available')
     else:
-        print('!!!!! NO CUDA GPUS DETECTED')
\ No newline at end of file
+        print('!!!!! NO CUDA GPUS DETECTED')
+
+    return dset_loaders, dset_sizes, dset_classes
\ No newline at end of file
@@ -0,0 +1,135 @@
+from __future__ import print_function, division
+
+import numpy as np
+import os
+import time
+from PIL import Image
+
+'''
+Reduced-resolution JPEG decoding.
+
+ABID photos are much larger than the 256px the networks use. PIL's draft mode lets libjpeg decode a JPEG
+directly at 1/2, 1/4 or 1/8 scale in the DCT domain, which skips most of the decoding work. open_draft picks
+the smallest such scale that still leaves the image at or above the target size, so the following resize
+only ever downsamples, as with a full decode.
+'''
+
+
+def draft_size(width, height, size, keep_aspect=True):
+    '''
+    Size to request from Image.draft.
+
+    :param size: Target size, the short side if keep_aspect (transforms.Resize(256)), both sides otherwise
+    (the square resize of stats.im2torchNorm, an int or a (width, height) pair)
+    '''
+    if not keep_aspect:
+        return tuple(size) if hasattr(size, '__len__') else (size, size)
+    if width < height:
+        return size, int(np.ceil(height * size / float(width)))
+    return int(np.ceil(width * size / float(height))), size
+
+
+def open_draft(path, size=256, keep_aspect=True):
+    '''Opens an image as RGB, decoding JPEGs at the smallest DCT scale that is at least size.'''
+    im = Image.open(path)
+    if im.format == 'JPEG':
+        im.draft('RGB', draft_size(im.size[0], im.size[1], size, keep_aspect))
+    return im.convert('RGB')
+
+
+def open_full(path):
+    '''Full resolution decode, as the default ImageFolder loader.'''
+    with open(path, 'rb') as f:
+        im = Image.open(f)
+        return im.convert('RGB')
+
+
+class DraftLoader(object):
+    '''Picklable image loader for ImageFolder datasets (loader=DraftLoader(256)).'''
+
+    def __init__(self, size=256, keep_aspect=True):
+        self.size = size
+        self.keep_aspect = keep_aspect
+
+    def __call__(self, path):
+        return open_draft(path, self.size, self.keep_aspect)
+
+
+def _resize_short(im, size):
+    w, h = im.size
+    if w < h:
+        return im.resize((size, int(size * h / w)), Image.BILINEAR)
+    return im.resize((int(size * w / h), size), Image.BILINEAR)
+
+
+def benchmark(paths, size=256, repeat=1):
+    '''
+    Times decode + resize to size with the full and the draft decoder.
+
+    :return: Dictionary with milliseconds per image of both paths and the speedup
+    '''
+    times = {}
+    for name, loader in (('full', open_full), ('draft', DraftLoader(size))):
+        since = time.time()
+        for r in range(repeat):
+            for path in paths:
+                _resize_short(loader(path), size)
+        times[name] = 1000. * (time.time() - since) / (repeat * max(len(paths), 1))
+    times['speedup'] = times['full'] / max(times['draft'], 1e-9)
+    return times
+
+
+def parity(paths, transform, model=None, device=None, size=256, batch_size=32):
+    '''
+    Compares the full and the draft decode through the same transform.
+
+    :param transform: Validation transform (Resize(256), CenterCrop(224), ToTensor, Normalize)
+    :param model: Optional network, the argmax predictions of both paths are compared
+
+    :return: Dictionary with the mean and max absolute difference of the transformed tensors (in normalized
+    units) and, with a model, the fraction of images with the same prediction
+    '''
+    import torch
+
+    diffs = []
+    max_diff = 0.
+    agree = 0
+    for begin in range(0, len(paths), batch_size):
+        batch = paths[begin:begin + batch_size]
+        full = torch.stack([transform(open_full(p)) for p in batch])
+        draft = torch.stack([transform(open_draft(p, size)) for p in batch])
+        diff = (full - draft).abs()
+        diffs.append(float(diff.mean()) * len(batch))
+        max_diff = max(max_diff, float(diff.max()))
+        if model is not None:
+            with torch.no_grad():
+                pred_full = torch.max(model(full.to(device)), 1)[1]
+                pred_draft = torch.max(model(draft.to(device)), 1)[1]
+            agree += int(torch.sum(pred_full == pred_draft))
+    result = {'mean_abs_diff': sum(diffs) / max(len(paths), 1), 'max_abs_diff': max_diff}
+    if model is not None:
+        result['prediction_agreement'] = agree / float(max(len(paths), 1))
+    return result
+
+
+if __name__ == '__main__':
+    import argparse
+    from torchvision import transforms
+
+    parser = argparse.ArgumentParser(description='Benchmark and parity check of the draft JPEG decoder')
+    parser.add_argument('image_dir', help='Directory searched recursively for .jpg images')
+    parser.add_argument('--n', type=int, default=200, help='Number of images')
+    parser.add_argument('--size', type=int, default=256)
+    args = parser.parse_args()
+
+    paths = []
+    for root, dirs, files in os.walk(args.image_dir):
+        paths += [os.path.join(root, f) for f in sorted(files) if f.lower().endswith(('.jpg', '.jpeg'))]
+    paths = paths[:args.n]
+    val_transform = transforms.Compose([
+        transforms.Resize(args.size),
+        transforms.CenterCrop(224),
+        transforms.ToTensor(),
+        transforms.Normalize([0.485, 0.456, 0.406], [0.229, 0.224, 0.225])])
+    print('Benchmark on {} images: {}'.format(len(paths), benchmark(paths, args.size)))
+    print('Parity: {}'.format(parity(paths, val_transform, size=args.size)))
@@ -0,0 +1,102 @@
+from __future__ import print_function, division
+
+import torch
+
+'''
+Batched decoders from network outputs to counts and count distributions.
+
+Every function takes and returns tensors on the outputs' device and works on whole batches (N x numOut
+outputs, or N x 1 for the scalar output algos), so decoding never copies to the host. The loss strategies
+(losses.py) decode with these for the training metrics, inference and serving; evaluation.redecode applies
+them to stored outputs for the eyeball comparisons. Image decoding is in decode.py.
+
+Counts are LongTensors of size N clipped to [0, numOut - 1]; distributions are N x numOut float tensors.
+'''
+
+
+def clip_counts(counts, numOut):
+    return counts.clamp(0, numOut - 1).long().view(-1)
+
+
+def argmax(outputs):
+    _, preds = torch.max(outputs, 1)
+    return preds
+
+
+def softmax(outputs, tau=1.):
+    '''Softmax with temperature tau.'''
+    return torch.softmax(outputs / tau, 1)
+
+
+def one_hot(counts, numOut):
+    '''Distribution with all the mass on counts, for the algos that predict a single count.'''
+    out = torch.zeros(counts.size(0), numOut, device=counts.device)
+    return out.scatter_(1, counts.view(-1, 1), 1.)
+
+
+def round_counts(values, numOut):
+    '''Nearest count of scalar predictions (regression, learn_a, fix_a).'''
+    return clip_counts(torch.round(values), numOut)
+
+
+def poisson_counts(rate, numOut):
+    '''Counts of the poisson algo, the floor of the rate.'''
+    return clip_counts(torch.floor(rate), numOut)
+
+
+def binomial_counts(p, numOut):
+    '''Counts of the binomial algo, the success probability scaled by numOut and rounded.'''
+    return clip_counts(torch.round(p * numOut), numOut)
+
+
+def cheng_counts(outputs, numOut):
+    '''Ordinal decoding, the number of leading outputs that are on (> 0), minus one.'''
+    on = (outputs > 0.0).long()
+    return clip_counts(torch.sum(torch.cumprod(on, dim=1), dim=1) - 1, numOut)
+
+
+def cdf2pmf(cdf):
+    '''
+    P(count = k) = P(count >= k) - P(count >= k + 1) of the per-count probabilities P(count >= k), the cdf2pmf
+    matrix product of the eyeball analysis as a shifted difference.
+    '''
+    return cdf - torch.cat([cdf[:, 1:], torch.zeros_like(cdf[:, :1])], 1)
+
+
+def cheng_pmf(outputs):
+    '''Distribution of the ordinal outputs, cdf2pmf of their sigmoids cut at 0 and renormalized.'''
+    pmf = cdf2pmf(torch.sigmoid(outputs)).clamp(min=0)
+    return pmf / pmf.sum(1, keepdim=True).clamp(min=1e-12)
+
+
+def ccr1_prob(probs):
+    '''Probability of every count to be within one of the true count, probs @ the tridiagonal ones matrix.'''
+    zeros = torch.zeros_like(probs[:, :1])
+    return probs + torch.cat([probs[:, 1:], zeros], 1) + torch.cat([zeros, probs[:, :-1]], 1)
+
+
+def expected_value(pmf):
+    '''Expected count of every distribution, N float values.'''
+    return torch.mv(pmf, torch.arange(pmf.size(1), dtype=pmf.dtype, device=pmf.device))
+
+
+def expected_counts(pmf):
+    return round_counts(expected_value(pmf), pmf.size(1))
+
+
+def median_counts(pmf):
+    '''Median of every distribution, the smallest count whose cumulative probability reaches 1/2.'''
+    return clip_counts(torch.sum(torch.cumsum(pmf, 1) < 0.5, 1), pmf.size(1))
+
+
+# Decoders of the eyeball analysis by name, outputs of the numOut output algos to counts
+DECODERS = {
+    'argmax': lambda outputs, tau=1.: argmax(outputs),
+    'cheng': lambda outputs, tau=1.: cheng_counts(outputs, outputs.size(1)),
+    'cheng_pmf': lambda outputs, tau=1.: argmax(cheng_pmf(outputs)),
+    'ccr1': lambda outputs, tau=1.: argmax(ccr1_prob(softmax(outputs, tau))),
+    'expected': lambda outputs, tau=1.: expected_counts(softmax(outputs, tau)),
+    'median': lambda outputs, tau=1.: median_counts(softmax(outputs, tau)),
+    'cheng_expected': lambda outputs, tau=1.: expected_counts(cheng_pmf(outputs)),
+    'cheng_median': lambda outputs, tau=1.: median_counts(cheng_pmf(outputs)),
+}
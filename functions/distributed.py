@@ -0,0 +1,152 @@
+from __future__ import print_function, division
+
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+import os
+import socket
+
+from functions.checkpoint import ResumableSampler, SeededSampler
+from functions.sampling import BalancedSampler
+
+'''
+Data-parallel training on CPU nodes.
+
+launch starts N local processes joined in a gloo process group. Every process builds its loaders, shards
+them with shard_loaders and calls train_model(..., distributed=True), which wraps the model in
+DistributedDataParallel, all-reduces the epoch metrics and keeps the TensorBoard, CSV/Excel logs and
+checkpoints on rank 0.
+
+  def worker(rank, world_size):
+      dset_loaders, dset_sizes, dset_classes = data.load_data('real', data_transforms)
+      dset_loaders = distributed.shard_loaders(dset_loaders)
+      ft.train_model(model, 'sgd', ft.exp_lr_scheduler, dset_loaders, dset_sizes, writer, use_gpu=False,
+                     distributed=True, ...)
+
+  distributed.launch(worker, 4)
+'''
+
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized()
+
+
+def get_rank():
+    return dist.get_rank() if is_distributed() else 0
+
+
+def get_world_size():
+    return dist.get_world_size() if is_distributed() else 1
+
+
+def _free_port():
+    s = socket.socket()
+    s.bind(('127.0.0.1', 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+
+def _run(rank, world_size, fn, args, port, threads):
+    os.environ['MASTER_ADDR'] = '127.0.0.1'
+    os.environ['MASTER_PORT'] = str(port)
+    if threads is not None:
+        torch.set_num_threads(threads)
+    dist.init_process_group('gloo', rank=rank, world_size=world_size)
+    try:
+        fn(rank, world_size, *args)
+    finally:
+        dist.destroy_process_group()
+
+
+def launch(fn, world_size, args=(), threads=None):
+    '''
+    Runs fn(rank, world_size, *args) in world_size local processes of a gloo process group.
+
+    :param threads: Intra-op threads per process, the cores split evenly between the processes if None
+    '''
+    if threads is None:
+        threads = max(1, torch.get_num_threads() // world_size)
+    mp.spawn(_run, args=(world_size, fn, args, _free_port(), threads), nprocs=world_size, join=True)
+
+
+class ShardedSampler(ResumableSampler):
+    '''
+    Partition of a sampler's epoch order across the ranks.
+
+    Every rank draws the same order of the wrapped sampler (its generator is seeded with seed + epoch, see
+    set_epoch) and takes every world_size-th position starting at its rank, so no sample slot is seen by two
+    ranks. With even=True the order is cut to a multiple of world_size so that every rank takes the same
+    number of steps, as DistributedDataParallel needs for training; evaluation shards use even=False and
+    cover every sample. The stored order of state_dict is the global one, any rank resumes its own shard.
+    '''
+
+    def __init__(self, sampler, rank=None, world_size=None, seed=0, even=True):
+        super(ShardedSampler, self).__init__(sampler)
+        self.rank = get_rank() if rank is None else rank
+        self.world_size = get_world_size() if world_size is None else world_size
+        self.seed = seed
+        self.even = even
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __len__(self):
+        n = len(self.sampler)
+        if self.even:
+            return n // self.world_size
+        return len(range(self.rank, n, self.world_size))
+
+    def __iter__(self):
+        if not self._replay:
+            if hasattr(self.sampler, 'generator'):
+                # Same draw on every rank
+                self.sampler.generator = torch.Generator()
+                self.sampler.generator.manual_seed(self.seed + self.epoch)
+            order = torch.as_tensor(list(iter(self.sampler)), dtype=torch.long)
+            if self.even:
+                order = order[:len(order) - len(order) % self.world_size]
+            self.order = order
+            self.start = 0
+        self._replay = False
+        return iter(self.order[self.rank::self.world_size][self.start:].tolist())
+
+
+def shard_loaders(dset_loaders, rank=None, world_size=None, seed=0):
+    '''
+    DataLoaders of the rank's shard, with the dataset, batch size and workers of dset_loaders.
+
+    A BalancedSampler is partitioned (seeded with seed if it has no seed), other training samplers (a
+    shuffle or a WeightedRandomSampler, possibly wrapped in a ResumableSampler) are sharded evenly and the
+    other phases are split without padding. The SeededSampler of load_data is kept around the rank's sampler.
+    '''
+    sharded = {}
+    for phase, loader in dset_loaders.items():
+        sampler = loader.sampler
+        seeded = isinstance(sampler, SeededSampler)
+        if seeded:
+            sampler = sampler.sampler
+        if isinstance(sampler, BalancedSampler):
+            if sampler.seed is None:
+                sampler.seed = seed
+            sampler = sampler.partition(get_rank() if rank is None else rank,
+                                        get_world_size() if world_size is None else world_size)
+        else:
+            if isinstance(sampler, ResumableSampler):
+                sampler = sampler.sampler
+            sampler = ShardedSampler(sampler, rank, world_size, seed=seed, even=(phase == 'train'))
+        if seeded:
+            sampler = SeededSampler(sampler)
+        sharded[phase] = torch.utils.data.DataLoader(loader.dataset, batch_size=loader.batch_size,
+                                                     sampler=sampler, num_workers=loader.num_workers,
+                                                     pin_memory=loader.pin_memory,
+                                                     persistent_workers=loader.persistent_workers)
+    return sharded
+
+
+def all_gather(obj):
+    '''Picklable obj of every rank, in rank order.'''
+    gathered = [None] * get_world_size()
+    dist.all_gather_object(gathered, obj)
+    return gathered
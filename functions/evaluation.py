@@ -0,0 +1,249 @@
+from __future__ import print_function, division
+
+import torch
+import torch.nn as nn
+import numpy as np
+import os
+import json
+from collections import OrderedDict
+
+from functions.decoders import DECODERS
+from functions.feature_cache import model_hash
+from functions.inference import inference_mode
+from functions.losses import make_decoder
+from functions.sampling import dataset_labels
+
+'''
+Shared-decode evaluation of many models.
+
+The eyeball analysis compares several trained models (algos x CV folds) on the same images. evaluate
+decodes every batch once and feeds it to all models; models whose weights only differ in the last layer
+(same trunk hash, e.g. heads trained on a frozen backbone) run the trunk once and only their fc separately.
+Predictions and raw outputs go into a PredictionTable, preallocated in memory or memory mapped on disk,
+with one row per image of the dataset and one column per model name, so comparisons such as the cheng /
+ccr1 windowing run on the stored predictions without touching the images again.
+
+  table = evaluation.PredictionTable(len(dset), ['ccr', 'ccr1', 'cheng'], 10, dataset_labels(dset))
+  evaluation.evaluate_folds(models, dset, splits.kfold_split(len(dset), 4), table,
+                            algos={'ccr': 'softmax', 'ccr1': 'softmax', 'cheng': 'cheng'})
+  wiw = evaluation.window(table.column('cheng'), table.column('ccr1'))
+  evaluation.count_metrics(table.label, wiw)
+  evaluation.count_metrics(table.label, evaluation.redecode(table, 'cheng', 'cheng_pmf'))
+'''
+
+
+class PredictionTable(object):
+    '''
+    Predictions of models keyed by (image row, model name).
+
+    label      N int64, true count of every image
+    pred       N x M int64 decoded counts, -1 until the image is evaluated by the model
+    outputs    N x M x numOut float32 raw network outputs, NaN past the output size of scalar output models
+
+    :param path: Directory of the memory mapped .npy columns, in memory if None
+    '''
+
+    def __init__(self, num_images, names, numOut, labels=None, path=None):
+        self.names = list(names)
+        self.numOut = numOut
+        self.path = path
+        shape = (num_images, len(self.names))
+        if path is None:
+            self.label = np.full(num_images, -1, dtype=np.int64)
+            self.pred = np.full(shape, -1, dtype=np.int64)
+            self.outputs = np.full(shape + (numOut,), np.nan, dtype=np.float32)
+        else:
+            if not os.path.exists(path):
+                os.makedirs(path)
+            with open(os.path.join(path, 'names.json'), 'w') as f:
+                json.dump({'names': self.names, 'numOut': numOut}, f)
+            open_memmap = np.lib.format.open_memmap
+            self.label = open_memmap(os.path.join(path, 'label.npy'), mode='w+', dtype=np.int64, shape=(num_images,))
+            self.pred = open_memmap(os.path.join(path, 'pred.npy'), mode='w+', dtype=np.int64, shape=shape)
+            self.outputs = open_memmap(os.path.join(path, 'outputs.npy'), mode='w+', dtype=np.float32,
+                                       shape=shape + (numOut,))
+            self.label[:] = -1
+            self.pred[:] = -1
+            self.outputs[:] = np.nan
+        if labels is not None:
+            self.label[:] = labels
+
+    @classmethod
+    def open(cls, path, mode='r'):
+        '''Table of a directory written by a memory mapped table.'''
+        table = cls.__new__(cls)
+        with open(os.path.join(path, 'names.json')) as f:
+            meta = json.load(f)
+        table.names = meta['names']
+        table.numOut = meta['numOut']
+        table.path = path
+        for name in ('label', 'pred', 'outputs'):
+            setattr(table, name, np.load(os.path.join(path, name + '.npy'), mmap_mode=mode))
+        return table
+
+    def flush(self):
+        if self.path is not None:
+            for column in (self.label, self.pred, self.outputs):
+                column.flush()
+
+    def index(self, name):
+        return self.names.index(name)
+
+    def column(self, name):
+        return self.pred[:, self.index(name)]
+
+    def model_outputs(self, name):
+        return self.outputs[:, self.index(name)]
+
+    def write(self, name, rows, pred, outputs):
+        j = self.index(name)
+        self.pred[rows, j] = pred
+        self.outputs[rows, j, :outputs.shape[1]] = outputs
+
+    def metrics(self, names=None, rows=None):
+        '''count_metrics of every model over rows (all rows if None), skipping images it did not see.'''
+        rows = np.arange(len(self.label)) if rows is None else np.asarray(rows)
+        result = OrderedDict()
+        for name in (self.names if names is None else names):
+            pred = self.column(name)[rows]
+            seen = pred >= 0
+            result[name] = count_metrics(self.label[rows][seen], pred[seen])
+        return result
+
+
+def count_metrics(labels, preds):
+    '''CCR, CCR-1, MAE and RMSE of predicted counts, as in the eyeball analysis.'''
+    errors = np.asarray(preds, dtype=np.int64) - np.asarray(labels, dtype=np.int64)
+    if len(errors) == 0:
+        return {'CCR': np.nan, 'CCR-1': np.nan, 'MAE': np.nan, 'RMSE': np.nan}
+    return {'CCR': np.mean(errors == 0), 'CCR-1': np.mean(np.abs(errors) <= 1), 'MAE': np.mean(np.abs(errors)),
+            'RMSE': np.sqrt(np.mean(errors ** 2))}
+
+
+def window(preds, center, width=1):
+    '''
+    Windowing of the eyeball analysis: preds (e.g. cheng) clipped to within width of the predictions of a
+    tolerant model (e.g. the CCR-1 trained one).
+    '''
+    center = np.asarray(center)
+    return np.clip(preds, center - width, center + width)
+
+
+def redecode(table, name, decoder, device=None, batch_size=65536, **kwargs):
+    '''
+    Counts of the stored outputs of a model with another decoder, on the device in chunks of batch_size.
+
+    :param decoder: Name of decoders.DECODERS (e.g. 'cheng_pmf', 'ccr1', 'median') or a function of a batch
+    of outputs to counts
+    :param kwargs: Decoder arguments, e.g. tau
+    :return: Counts, -1 for the images the model did not see
+    '''
+    if device is None:
+        device = torch.device('cuda:0' if torch.cuda.is_available() else 'cpu')
+    decoder = DECODERS[decoder] if isinstance(decoder, str) else decoder
+    outputs = table.model_outputs(name)
+    seen = np.flatnonzero(table.column(name) >= 0)
+    counts = np.full(len(outputs), -1, dtype=np.int64)
+    if len(seen) == 0:
+        return counts
+    width = int(np.sum(~np.isnan(outputs[seen[0]])))
+    for begin in range(0, len(seen), batch_size):
+        rows = seen[begin:begin + batch_size]
+        out = torch.from_numpy(np.ascontiguousarray(outputs[rows, :width])).to(device)
+        counts[rows] = decoder(out, **kwargs).cpu().numpy()
+    return counts
+
+
+def backbone_groups(models):
+    '''
+    Model names grouped by trunk, the models of a group differ at most in their fc layer.
+
+    :param models: Ordered dictionary of name to model
+    :return: List of lists of names
+    '''
+    groups = OrderedDict()
+    for name, model in models.items():
+        key = (type(model).__name__, model_hash(model)) if hasattr(model, 'fc') else (name,)
+        groups.setdefault(key, []).append(name)
+    return list(groups.values())
+
+
+def _trunk(model, inputs):
+    fc = model.fc
+    model.fc = nn.Sequential()
+    try:
+        return model(inputs)
+    finally:
+        model.fc = fc
+
+
+def evaluate(models, dset, table, rows=None, algos='mixed', device=None, batch_size=32, num_workers=12,
+             share_backbones=True):
+    '''
+    Runs every model over the images rows of dset, each batch being loaded once.
+
+    :param models: Dictionary of table column name to model (in eval mode on device)
+    :param table: PredictionTable with a column for every name of models and a row per image of dset
+    :param rows: Dataset rows to evaluate, all if None
+    :param algos: Algo of every model, a dictionary by name or one algo for all
+    :param share_backbones: Run the trunk once for the models of a backbone_groups group
+
+    :return: Number of evaluated images
+    '''
+    if device is None:
+        device = torch.device('cuda:0' if torch.cuda.is_available() else 'cpu')
+    rows = np.arange(len(dset)) if rows is None else np.sort(np.asarray(rows, dtype=np.int64))
+    models = OrderedDict(models)
+    decoders = {name: make_decoder(algos if isinstance(algos, str) else algos[name], table.numOut, device)
+                for name in models}
+    if share_backbones:
+        groups = backbone_groups(models)
+    else:
+        groups = [[name] for name in models]
+    for model in models.values():
+        model.train(False)
+
+    loader = torch.utils.data.DataLoader(torch.utils.data.Subset(dset, rows.tolist()), batch_size=batch_size,
+                                         shuffle=False, num_workers=num_workers,
+                                         pin_memory=device.type == 'cuda')
+    begin = 0
+    with inference_mode():
+        for inputs, labels in loader:
+            batch_rows = rows[begin:begin + inputs.size(0)]
+            inputs = inputs.to(device, non_blocking=True)
+            for group in groups:
+                if len(group) > 1:
+                    feats = _trunk(models[group[0]], inputs)
+                    outputs = [models[name].fc(feats) for name in group]
+                else:
+                    outputs = [models[group[0]](inputs)]
+                for name, out in zip(group, outputs):
+                    pred = decoders[name].decode(out)
+                    table.write(name, batch_rows, pred.cpu().numpy(), out.float().cpu().numpy())
+            table.label[batch_rows] = labels.numpy()
+            begin += inputs.size(0)
+    table.flush()
+    return begin
+
+
+def evaluate_folds(models, dset, folds, table, algos='mixed', **kwargs):
+    '''
+    Cross validation evaluation, model k of every name on the validation images of fold k.
+
+    :param models: Dictionary of name to the list of its per-fold models
+    :param folds: splits.kfold_split folds (dictionaries with a 'val' manifest) or lists of val rows
+    :param kwargs: Arguments of evaluate
+    '''
+    n = 0
+    for k, fold in enumerate(folds):
+        rows = fold['val'] if isinstance(fold, dict) else fold
+        n += evaluate(OrderedDict((name, arr[k]) for name, arr in models.items()), dset, table, rows, algos,
+                      **kwargs)
+    return n
+
+
+def new_table(dset, names, numOut=None, path=None):
+    '''PredictionTable over the images of an ImageFolder style dataset, with their labels.'''
+    if numOut is None:
+        numOut = len(dset.classes)
+    return PredictionTable(len(dset), names, numOut, dataset_labels(dset), path)
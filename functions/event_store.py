@@ -0,0 +1,304 @@
+from __future__ import print_function, division
+
+import numpy as np
+import os
+import re
+import json
+import struct
+
+'''
+Columnar store of the TensorBoard scalars of all runs.
+
+ingest walks a directory of TensorBoard runs (the SummaryWriter directories of train_and_validate.ipynb),
+reads the scalar events of every event file from the byte offset it stopped at the previous time and appends
+them to raw columns, so re-ingesting a directory of live runs only parses new events:
+    meta.json                  run names, tag names, byte offset reached in every event file
+    run.i32, tag.i32           run and tag number of every event
+    step.i64, wall.f64, value.f64
+
+Queries are vectorized over the whole store: curves aligns a tag of many runs on a runs x steps matrix,
+best_epoch takes the best step of every run, aggregate reduces the curves of groups of runs (sweeps).
+
+  store = RunStore('results/run_store')
+  store.ingest('results/tensorboard_runs')
+  runs, steps, values = store.best_epoch('val CIR-1', mode='max')
+  groups, steps, mean, std, count = store.aggregate('valRMSE', lambda run: run.split('_')[2])
+'''
+
+EVENT_COLUMNS = (('run', np.int32, 'i32'), ('tag', np.int32, 'i32'), ('step', np.int64, 'i64'),
+                 ('wall', np.float64, 'f64'), ('value', np.float64, 'f64'))
+
+
+def _event_pb2():
+    try:
+        from tensorboardX.proto import event_pb2
+    except ImportError:
+        from tensorboard.compat.proto import event_pb2
+    return event_pb2
+
+
+def read_scalars(path, offset=0):
+    '''
+    Scalar events of a TensorBoard event file from a byte offset. A record cut short by a writer that is
+    still running is left for the next read.
+
+    :return: List of (tag, step, wall time, value), offset after the last complete record
+    '''
+    event_pb2 = _event_pb2()
+    scalars = []
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        while True:
+            # TFRecord: length (uint64), length crc, data, data crc
+            header = f.read(12)
+            if len(header) < 12:
+                break
+            length = struct.unpack('<Q', header[:8])[0]
+            data = f.read(length)
+            footer = f.read(4)
+            if len(data) < length or len(footer) < 4:
+                break
+            offset = f.tell()
+            event = event_pb2.Event()
+            event.ParseFromString(data)
+            if not event.HasField('summary'):
+                continue
+            for v in event.summary.value:
+                if v.HasField('simple_value'):
+                    value = v.simple_value
+                elif v.HasField('tensor') and len(v.tensor.float_val):
+                    value = v.tensor.float_val[0]
+                elif v.HasField('tensor') and len(v.tensor.double_val):
+                    value = v.tensor.double_val[0]
+                else:
+                    continue
+                scalars.append((v.tag, event.step, event.wall_time, value))
+    return scalars, offset
+
+
+def find_event_files(root_dir):
+    '''Event files below root_dir with their run name (directory relative to root_dir).'''
+    files = []
+    for root, dirs, names in os.walk(root_dir):
+        dirs.sort()
+        for name in sorted(names):
+            if 'tfevents' in name:
+                run = os.path.relpath(root, root_dir)
+                files.append((os.path.join(root, name), '.' if run == '.' else run))
+    return files
+
+
+class RunStore(object):
+    '''
+    :param path: Store directory, created if it does not exist
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        if os.path.exists(self._file('meta.json')):
+            with open(self._file('meta.json')) as f:
+                self.meta = json.load(f)
+        else:
+            if not os.path.exists(path):
+                os.makedirs(path)
+            self.meta = {'runs': [], 'tags': [], 'files': {}, 'rows': 0}
+            self._write_meta()
+        self._columns = None
+        self._truncate()
+
+    def _truncate(self):
+        # Events appended by an ingest interrupted before its meta.json update are read again
+        for name, dtype, ext in EVENT_COLUMNS:
+            path = self._file('{}.{}'.format(name, ext))
+            size = self.meta['rows'] * np.dtype(dtype).itemsize
+            if os.path.exists(path) and os.path.getsize(path) > size:
+                with open(path, 'r+b') as f:
+                    f.truncate(size)
+
+    def _file(self, name):
+        return os.path.join(self.path, name)
+
+    def _write_meta(self):
+        with open(self._file('meta.json.tmp'), 'w') as f:
+            json.dump(self.meta, f, indent=1)
+        os.replace(self._file('meta.json.tmp'), self._file('meta.json'))
+
+    @property
+    def runs(self):
+        return self.meta['runs']
+
+    @property
+    def tags(self):
+        return self.meta['tags']
+
+    def _id(self, kind, name):
+        names = self.meta[kind]
+        if name not in names:
+            names.append(name)
+        return names.index(name)
+
+    def append(self, run, scalars):
+        '''Adds (tag, step, wall time, value) scalars of a run.'''
+        if not scalars:
+            return
+        run_id = self._id('runs', run)
+        tags, steps, walls, values = zip(*scalars)
+        lookup = {tag: self._id('tags', tag) for tag in set(tags)}
+        columns = {'run': np.full(len(scalars), run_id), 'tag': [lookup[t] for t in tags], 'step': steps,
+                   'wall': walls, 'value': values}
+        for name, dtype, ext in EVENT_COLUMNS:
+            with open(self._file('{}.{}'.format(name, ext)), 'ab') as f:
+                f.write(np.asarray(columns[name], dtype=dtype).tobytes())
+        self.meta['rows'] += len(scalars)
+        self._columns = None
+
+    def ingest(self, root_dir):
+        '''
+        Reads the new events of every event file below root_dir.
+
+        :return: Number of new scalars
+        '''
+        n = self.meta['rows']
+        for path, run in find_event_files(root_dir):
+            key = os.path.abspath(path)
+            offset = self.meta['files'].get(key, 0)
+            if os.path.getsize(path) <= offset:
+                continue
+            scalars, offset = read_scalars(path, offset)
+            self.append(run, scalars)
+            self.meta['files'][key] = offset
+            self._write_meta()
+        return self.meta['rows'] - n
+
+    def ingest_csv(self, paths):
+        '''
+        Imports scalars exported from TensorBoard as CSV (Wall time, Step, Value), named
+        run_<run>-tag-<tag>.csv as the files of analysis/.
+        '''
+        for path in paths:
+            match = re.match(r'run_(.*)-tag-(.*)\.csv$', os.path.basename(path))
+            if match is None:
+                raise ValueError('Not a TensorBoard CSV export name: ' + path)
+            run, tag = match.group(1), match.group(2)
+            data = np.loadtxt(path, delimiter=',', skiprows=1, ndmin=2)
+            self.append(run, [(tag, int(step), wall, value) for wall, step, value in data])
+        self._write_meta()
+
+    def columns(self):
+        if self._columns is None:
+            n = self.meta['rows']
+            self._columns = {name: np.memmap(self._file('{}.{}'.format(name, ext)), dtype=dtype, mode='r',
+                                             shape=(n,)) if n else np.zeros(0, dtype=dtype)
+                             for name, dtype, ext in EVENT_COLUMNS}
+        return self._columns
+
+    def tag_id(self, tag):
+        '''Number of a tag, by the name given to add_scalar or as stored (the writer replaces spaces by _).'''
+        for name in (tag, re.sub(r'[^-/\w\.]', '_', tag)):
+            if name in self.tags:
+                return self.tags.index(name)
+        raise KeyError('Unknown tag: ' + tag)
+
+    def select_runs(self, pattern=None):
+        '''Run numbers whose name matches the regular expression pattern (all if None).'''
+        if pattern is None:
+            return np.arange(len(self.runs))
+        regex = re.compile(pattern)
+        return np.asarray([k for k, run in enumerate(self.runs) if regex.search(run)], dtype=np.int64)
+
+    def scalars(self, tag, runs=None):
+        '''run numbers, steps, wall times and values of the events of a tag, optionally of the given runs.'''
+        cols = self.columns()
+        mask = np.asarray(cols['tag']) == self.tag_id(tag)
+        if runs is not None:
+            mask &= np.isin(cols['run'], runs)
+        rows = np.flatnonzero(mask)
+        return (np.asarray(cols['run'][rows]), np.asarray(cols['step'][rows]), np.asarray(cols['wall'][rows]),
+                np.asarray(cols['value'][rows]))
+
+    def curves(self, tag, runs=None):
+        '''
+        Curves of a tag aligned on their steps. The latest event wins when a step was written twice
+        (a resumed run).
+
+        :return: runs (numbers, rows of the matrix), steps (columns), values (runs x steps, NaN where a run has
+        no event)
+        '''
+        run, step, wall, value = self.scalars(tag, runs)
+        run_ids = np.unique(run if runs is None else runs)
+        steps = np.unique(step)
+        order = np.lexsort((wall, step, run))
+        run, step, value = run[order], step[order], value[order]
+        matrix = np.full((len(run_ids), len(steps)), np.nan)
+        matrix[np.searchsorted(run_ids, run), np.searchsorted(steps, step)] = value
+        return run_ids, steps, matrix
+
+    def best_epoch(self, tag, mode='min', runs=None):
+        '''
+        Best step of every run on a tag.
+
+        :param mode: 'min' (losses, RMSE, MAE) or 'max' (accuracy, CIR-1)
+        :return: runs, best steps, best values (runs without events of the tag are left out)
+        '''
+        run_ids, steps, matrix = self.curves(tag, runs)
+        valid = ~np.all(np.isnan(matrix), 1)
+        run_ids, matrix = run_ids[valid], matrix[valid]
+        filled = np.where(np.isnan(matrix), np.inf if mode == 'min' else -np.inf, matrix)
+        best = np.argmin(filled, 1) if mode == 'min' else np.argmax(filled, 1)
+        return run_ids, steps[best], matrix[np.arange(len(run_ids)), best]
+
+    def at_steps(self, tag, runs, steps):
+        '''Values of a tag at one step per run, e.g. the val accuracy at the best val RMSE step (NaN if missing).'''
+        run_ids, all_steps, matrix = self.curves(tag, runs)
+        rows = np.searchsorted(run_ids, runs)
+        cols = np.searchsorted(all_steps, steps)
+        ok = (rows < len(run_ids)) & (cols < len(all_steps))
+        out = np.full(len(runs), np.nan)
+        ok[ok] &= (run_ids[rows[ok]] == np.asarray(runs)[ok]) & (all_steps[cols[ok]] == np.asarray(steps)[ok])
+        out[ok] = matrix[rows[ok], cols[ok]]
+        return out
+
+    def aggregate(self, tag, group, runs=None):
+        '''
+        Mean, standard deviation and number of runs per step of the curves of groups of runs.
+
+        :param group: Function of a run name to its group key (e.g. the algo or learning rate of a sweep)
+        :return: group keys, steps, mean, std and count (groups x steps)
+        '''
+        run_ids, steps, matrix = self.curves(tag, runs)
+        keys = [group(self.runs[r]) for r in run_ids]
+        groups = sorted(set(keys))
+        member = np.asarray([groups.index(k) for k in keys], dtype=np.int64)
+        one_hot = np.zeros((len(groups), len(run_ids)))
+        one_hot[member, np.arange(len(run_ids))] = 1.
+        present = ~np.isnan(matrix)
+        values = np.where(present, matrix, 0.)
+        count = one_hot.dot(present)
+        mean = one_hot.dot(values) / np.maximum(count, 1)
+        var = one_hot.dot(values ** 2) / np.maximum(count, 1) - mean ** 2
+        mean[count == 0] = np.nan
+        return groups, steps, mean, np.sqrt(np.maximum(var, 0.)), count.astype(np.int64)
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Columnar store of TensorBoard scalars')
+    parser.add_argument('store', help='Store directory')
+    parser.add_argument('--ingest', default=None, help='Directory of TensorBoard runs to read new events from')
+    parser.add_argument('--csv', nargs='*', default=[], help='TensorBoard CSV exports to import')
+    parser.add_argument('--best', default=None, help='Tag to print the best epoch of every run for')
+    parser.add_argument('--mode', default='min', choices=['min', 'max'])
+    parser.add_argument('--runs', default=None, help='Regular expression on the run names')
+    args = parser.parse_args()
+
+    store = RunStore(args.store)
+    if args.ingest is not None:
+        print('{} new scalars'.format(store.ingest(args.ingest)))
+    if args.csv:
+        store.ingest_csv(args.csv)
+    print('{} runs, {} tags, {} scalars'.format(len(store.runs), len(store.tags), store.meta['rows']))
+    if args.best is not None:
+        runs, steps, values = store.best_epoch(args.best, args.mode, store.select_runs(args.runs))
+        for r, s, v in sorted(zip(runs, steps, values), key=lambda x: x[2], reverse=args.mode == 'max'):
+            print('{:8.4f} epoch {:4d} {}'.format(v, s, store.runs[r]))
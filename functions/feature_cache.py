@@ -0,0 +1,193 @@
+from __future__ import print_function, division
+
+import torch
+import torch.nn as nn
+import numpy as np
+import os
+import copy
+import json
+import hashlib
+import functions.fine_tune as ft
+
+'''
+Frozen-backbone feature cache.
+
+With end_to_end=False only the last layer of the network is trained, so the pooled features of the trunk
+never change. train_on_features runs the trunk (model without fc, in eval mode) once over every dataset,
+stores the features in memory mapped float32 files keyed by the trunk weights and the dataset transform, and
+trains the head of any algo with train_model on the cached features.
+
+The cached features are those of one pass with the dataset transform, so a random training transform is
+frozen to a single draw; use the deterministic (val) transform for the cached training set.
+
+The trunk's BatchNorm layers normalize with their running statistics by default. This differs from
+train_model with end_to_end=False on images: there the train phase ran the frozen trunk in train mode, so
+BatchNorm used the statistics of every training batch (and kept updating its running statistics). Heads
+trained on the default cache therefore see other features than the runs they replace. bn_batch_stats=True
+extracts the training features with batch statistics, over the extraction batches (dataset order,
+feature_batch_size) rather than the random training batches, without changing the running statistics;
+the other phases always use the running statistics, as train_model's eval phases did.
+'''
+
+
+class Head(nn.Module):
+    '''The last layer of a network as a module with an fc attribute, as train_model expects.'''
+
+    def __init__(self, fc):
+        super(Head, self).__init__()
+        self.fc = fc
+
+    def forward(self, x):
+        return self.fc(x)
+
+
+def model_hash(model, exclude=('fc.',)):
+    '''Hash of the trunk weights, the parameters and buffers not starting with an exclude prefix.'''
+    h = hashlib.sha1()
+    for name, value in sorted(model.state_dict().items()):
+        if name.startswith(exclude):
+            continue
+        h.update(name.encode('utf-8'))
+        h.update(value.detach().cpu().contiguous().numpy().tobytes())
+    return h.hexdigest()
+
+
+def transform_key(dset):
+    transform = getattr(dset, 'transform', None)
+    return hashlib.sha1(repr(transform).encode('utf-8')).hexdigest()
+
+
+def extract_features(model, dset, device, batch_size=64, num_workers=12, path=None, bn_batch_stats=False):
+    '''
+    Pooled trunk features of every image of dset, in dataset order.
+
+    :param path: Prefix of the memory mapped output (<path>.f32, <path>.labels.npy), in memory if None
+    :param bn_batch_stats: Normalize the BatchNorm layers with the statistics of every batch (train mode)
+    instead of their running statistics, which are left unchanged
+
+    :return: features (N x D float32, memory mapped if path is given), labels
+    '''
+    loader = torch.utils.data.DataLoader(dset, batch_size=batch_size, shuffle=False, num_workers=num_workers)
+    fc = model.fc
+    model.fc = nn.Sequential()
+    was_training = model.training
+    model.train(False)
+    batch_norms = [m for m in model.modules() if isinstance(m, nn.modules.batchnorm._BatchNorm)]
+    bn_states = [copy.deepcopy(m.state_dict()) for m in batch_norms]
+    if bn_batch_stats:
+        for m in batch_norms:
+            m.train(True)
+    feats = None
+    labels = np.zeros(len(dset), dtype=np.int64)
+    begin = 0
+    try:
+        with torch.no_grad():
+            for inputs, label in loader:
+                out = model(inputs.to(device)).view(inputs.size(0), -1).cpu().numpy()
+                if feats is None:
+                    shape = (len(dset), out.shape[1])
+                    if path is None:
+                        feats = np.zeros(shape, dtype=np.float32)
+                    else:
+                        feats = np.memmap(path + '.f32.tmp', dtype=np.float32, mode='w+', shape=shape)
+                feats[begin:begin + out.shape[0]] = out
+                labels[begin:begin + out.shape[0]] = label.numpy()
+                begin += out.shape[0]
+    finally:
+        model.fc = fc
+        model.train(was_training)
+        # Batch statistics mode updates the running statistics, the trunk (and its hash) must not change
+        for m, state in zip(batch_norms, bn_states):
+            m.load_state_dict(state)
+
+    if path is not None and feats is not None:
+        feats.flush()
+        del feats
+        os.rename(path + '.f32.tmp', path + '.f32')
+        np.save(path + '.labels.npy', labels)
+        feats = np.memmap(path + '.f32', dtype=np.float32, mode='r', shape=shape)
+    return feats, labels
+
+
+class FeatureCache(object):
+    '''
+    Directory of cached features, one entry per (trunk weights, transform, dataset size).
+
+    :param cache_dir: Cache directory, created if it does not exist
+    '''
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+
+    def key(self, model, dset, bn_batch_stats=False):
+        key = '{}_{}_{}'.format(model_hash(model)[:16], transform_key(dset)[:16], len(dset))
+        return key + '_bnbatch' if bn_batch_stats else key
+
+    def features(self, model, dset, device, batch_size=64, num_workers=12, bn_batch_stats=False):
+        path = os.path.join(self.cache_dir, self.key(model, dset, bn_batch_stats))
+        if os.path.exists(path + '.json'):
+            with open(path + '.json') as f:
+                meta = json.load(f)
+            feats = np.memmap(path + '.f32', dtype=np.float32, mode='r', shape=tuple(meta['shape']))
+            return feats, np.load(path + '.labels.npy')
+        print('Extracting features into ' + path)
+        feats, labels = extract_features(model, dset, device, batch_size=batch_size, num_workers=num_workers,
+                                         path=path, bn_batch_stats=bn_batch_stats)
+        with open(path + '.json', 'w') as f:
+            json.dump({'shape': list(feats.shape), 'transform': repr(getattr(dset, 'transform', None)),
+                       'bn_batch_stats': bn_batch_stats}, f)
+        return feats, labels
+
+
+class FeatureDataset(torch.utils.data.Dataset):
+    '''Cached features and labels as a dataset.'''
+
+    def __init__(self, feats, labels):
+        self.feats = feats
+        self.labels = labels
+        self.imgs = list(zip(range(len(labels)), labels.tolist()))
+
+    def __len__(self):
+        return len(self.labels)
+
+    def __getitem__(self, idx):
+        return torch.from_numpy(np.array(self.feats[idx])), int(self.labels[idx])
+
+
+def train_on_features(model, dsets, cache_dir, optim_str, lr_scheduler, writer, use_gpu=True, batch_size=32,
+                      feature_batch_size=64, num_workers=12, sampler=None, bn_batch_stats=False, **kwargs):
+    '''
+    Trains only the last layer of model on cached trunk features.
+
+    :param dsets: Dictionary of image datasets with 'train' and 'val' (and extra phases of train_model)
+    :param cache_dir: Feature cache directory
+    :param sampler: Dictionary of samplers over the dataset indices (e.g. the balanced WeightedRandomSampler)
+    :param bn_batch_stats: Extract the training features with BatchNorm batch statistics, closer to the
+    frozen-trunk runs on images (see the module docstring)
+    :param kwargs: Arguments of train_model (algo, num_epochs, numOut, multi_coeff, ...)
+
+    :return: best_model, last_model, result_log as train_model, with the trained heads put back on the trunk
+    '''
+    device = torch.device("cuda" if use_gpu else "cpu")
+    model = model.to(device)
+    cache = FeatureCache(cache_dir)
+    feats = {x: cache.features(model, dsets[x], device, batch_size=feature_batch_size, num_workers=num_workers,
+                               bn_batch_stats=bn_batch_stats and x == 'train')
+             for x in dsets}
+    if sampler is None:
+        sampler = {}
+    dset_loaders = {x: torch.utils.data.DataLoader(FeatureDataset(*feats[x]), batch_size=batch_size,
+                                                   shuffle=(x == 'train' and sampler.get(x) is None),
+                                                   sampler=sampler.get(x), num_workers=0)
+                    for x in dsets}
+    dset_sizes = {x: len(dsets[x]) for x in dsets}
+
+    head = Head(model.fc)
+    best_head, last_head, result_log = ft.train_model(head, optim_str, lr_scheduler, dset_loaders, dset_sizes,
+                                                      writer, use_gpu=use_gpu, batch_size=batch_size, **kwargs)
+    model.fc = last_head.fc
+    best_model = copy.deepcopy(model)
+    best_model.fc = best_head.fc
+    return best_model, model, result_log
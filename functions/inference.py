@@ -0,0 +1,322 @@
+from __future__ import print_function, division
+
+import torch
+import numpy as np
+import os
+import json
+import time
+from multiprocessing import Pool
+from torchvision import models
+
+from functions.augment import BatchAugment, uint8_transform
+from functions.checkpoint import load_checkpoint
+from functions.decode import open_draft, open_full
+from functions.losses import make_decoder
+from functions.metadata_index import MetadataIndex
+from functions.shards import IMG_EXTENSIONS
+
+'''
+Batch inference of a trained counting network.
+
+Images come from a directory, a manifest or the metadata index. A process pool decodes and resizes them to
+uint8 squares, the main process stacks them into batches, center crops and normalizes them on the device
+(BatchAugment) and runs the model under inference_mode. Outputs are decoded by the strategy of the algo the
+model was trained with (losses.make_decoder), exactly as train_model does, and every batch is written to
+the columnar output directory as soon as it is done:
+    meta.json      algo, numOut, model, number of images and of written rows
+    path.npy       image paths
+    image_id.npy   file names without extension (the metadata index ids)
+    label.npy      known counts, -1 if unknown
+    count.npy      predicted counts, -1 for images that could not be decoded
+    probs.npy      N x numOut float32 class probabilities
+
+  python -m functions.inference model_best.pt out/ --dir /data/abid/images --algo cheng --num-out 6
+'''
+
+COLUMNS = ('path', 'image_id', 'label', 'count', 'probs')
+
+
+def directory_inputs(root_dir):
+    '''
+    Images below root_dir, recursively and in sorted order.
+
+    :return: paths, labels (the count of the parent folder if it is a number, as in the per-count folders
+    of the dataset, -1 otherwise)
+    '''
+    paths = []
+    labels = []
+    for root, dirs, files in os.walk(root_dir):
+        dirs.sort()
+        parent = os.path.basename(root)
+        label = int(parent) if parent.isdigit() else -1
+        for fname in sorted(files):
+            if fname.lower().endswith(IMG_EXTENSIONS):
+                paths.append(os.path.join(root, fname))
+                labels.append(label)
+    return paths, np.asarray(labels, dtype=np.int64)
+
+
+def manifest_inputs(manifest_path):
+    '''
+    Images of a text manifest, one "path" or "path,label" per line. Relative paths are relative to the
+    manifest's directory.
+
+    :return: paths, labels (-1 where no label is given)
+    '''
+    base = os.path.dirname(os.path.abspath(manifest_path))
+    paths = []
+    labels = []
+    with open(manifest_path) as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            parts = line.rsplit(',', 1)
+            if len(parts) == 2 and parts[1].strip().lstrip('-').isdigit():
+                path, label = parts[0].strip(), int(parts[1])
+            else:
+                path, label = line, -1
+            paths.append(os.path.join(base, path))
+            labels.append(label)
+    return paths, np.asarray(labels, dtype=np.int64)
+
+
+def index_inputs(index_path, images_dir, min_count=0, max_count=None, ext='.jpg'):
+    '''
+    Images of the metadata index (metadata_index.build_index) with an expected quantity in
+    [min_count, max_count].
+
+    :return: paths, labels (the expected quantities)
+    '''
+    index = MetadataIndex.load(index_path)
+    rows = index.query(min_count, max_count)
+    return index.image_paths(images_dir, rows, ext), index.columns['quantity'][rows].astype(np.int64)
+
+
+def load_model(path, device, arch='resnet18', numOut=None):
+    '''
+    Trained model in eval mode and the algo it was trained with.
+
+    :param path: Whole model saved with torch.save(model, path), as train_and_validate.ipynb does (the algo
+    is then unknown and returned as None), or a train_model checkpoint (checkpoint_path), which stores the
+    algo and the weights; its network is rebuilt as torchvision's arch with the last layer of the algo.
+    :param numOut: Number of count classes of a checkpoint, read from its last layer if None
+    '''
+    state = load_checkpoint(path)
+    algo = None
+    if isinstance(state, dict) and 'model' in state and 'algo' in state:
+        algo = state['algo']
+        weights = state['model']
+        if numOut is None:
+            fc = weights.get('fc.weight', weights.get('fc.0.weight'))
+            if fc is None or fc.size(0) == 1:
+                raise ValueError('numOut of {} cannot be read from its last layer'.format(path))
+            numOut = fc.size(0)
+        model = getattr(models, arch)(num_classes=numOut)
+        model = make_decoder(algo, numOut, torch.device('cpu')).prepare_model(model)
+        model.load_state_dict(weights)
+    else:
+        model = state
+    model.train(False)
+    return model.to(device), algo
+
+
+def count_classes(model):
+    '''numOut of a model whose last layer has one output per count (all algos but the scalar ones).'''
+    fc = model.fc[0] if isinstance(model.fc, torch.nn.Sequential) else model.fc
+    if fc.out_features == 1:
+        raise ValueError('The number of counts of a scalar output model must be given')
+    return fc.out_features
+
+
+class ImageDecoder(object):
+    '''
+    Picklable pool function, path to the size x size uint8 array of the val transform before its center
+    crop (Resize(size), CenterCrop(size)). Returns None for images that cannot be read.
+    '''
+
+    def __init__(self, size=256, fast_decode=False):
+        self.size = size
+        self.fast_decode = fast_decode
+        self.transform = uint8_transform(size)
+
+    def __call__(self, path):
+        try:
+            im = open_draft(path, self.size) if self.fast_decode else open_full(path)
+            return self.transform(im).numpy()
+        except (IOError, OSError, ValueError):
+            return None
+
+
+def inference_mode():
+    if hasattr(torch, 'inference_mode'):
+        return torch.inference_mode()
+    return torch.no_grad()
+
+
+class PredictionWriter(object):
+    '''
+    Columnar output directory (see the module docstring). Columns are .npy files, the per-image ones
+    preallocated and memory mapped so that rows are written batch by batch.
+    '''
+
+    def __init__(self, out_dir, paths, labels, numOut, meta=None):
+        if not os.path.exists(out_dir):
+            os.makedirs(out_dir)
+        self.out_dir = out_dir
+        n = len(paths)
+        np.save(os.path.join(out_dir, 'path.npy'), np.asarray(paths, dtype=np.str_))
+        np.save(os.path.join(out_dir, 'image_id.npy'),
+                np.asarray([os.path.splitext(os.path.basename(p))[0] for p in paths], dtype=np.str_))
+        np.save(os.path.join(out_dir, 'label.npy'), np.asarray(labels, dtype=np.int64))
+        open_memmap = np.lib.format.open_memmap
+        self.count = open_memmap(os.path.join(out_dir, 'count.npy'), mode='w+', dtype=np.int64, shape=(n,))
+        self.probs = open_memmap(os.path.join(out_dir, 'probs.npy'), mode='w+', dtype=np.float32,
+                                 shape=(n, numOut))
+        self.count[:] = -1
+        self.meta = dict(meta or {}, numOut=numOut, n=n, written=0)
+        self._write_meta()
+
+    def _write_meta(self):
+        with open(os.path.join(self.out_dir, 'meta.json.tmp'), 'w') as f:
+            json.dump(self.meta, f, indent=1)
+        os.replace(os.path.join(self.out_dir, 'meta.json.tmp'), os.path.join(self.out_dir, 'meta.json'))
+
+    def write(self, begin, count, probs):
+        self.count[begin:begin + len(count)] = count
+        self.probs[begin:begin + len(count)] = probs
+        self.meta['written'] = begin + len(count)
+
+    def close(self):
+        self.count.flush()
+        self.probs.flush()
+        self._write_meta()
+        del self.count, self.probs
+
+
+def load_predictions(out_dir):
+    '''Columns of an output directory (count and probs memory mapped) and its meta dictionary.'''
+    columns = {}
+    for name in COLUMNS:
+        mmap = 'r' if name in ('count', 'probs') else None
+        columns[name] = np.load(os.path.join(out_dir, name + '.npy'), mmap_mode=mmap)
+    with open(os.path.join(out_dir, 'meta.json')) as f:
+        meta = json.load(f)
+    return columns, meta
+
+
+def _batches(images, batch_size):
+    batch = []
+    for im in images:
+        batch.append(im)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def predict(model, paths, out_dir, algo, numOut, labels=None, device=None, batch_size=64, num_workers=12,
+            fast_decode=False, size=256, crop_size=224, chunksize=8, meta=None):
+    '''
+    Counts of every image of paths, written to out_dir.
+
+    :param model: Trained network, as saved by train_and_validate.ipynb
+    :param algo: Algo the model was trained with, selects the decoding of its outputs
+    :param labels: Known counts stored next to the predictions, -1 for unknown
+    :param device: Inference device, the GPU if available and the CPU otherwise if None
+    :param num_workers: Decoding processes, images are decoded in the main process if 0
+    :param fast_decode: Decode JPEGs at reduced resolution (decode.open_draft)
+    :param size, crop_size: Resize and center crop of the val transform
+    :param chunksize: Paths handed to a decoding process at a time
+
+    :return: Dictionary with the number of images, of undecodable images and images per second
+    '''
+    if device is None:
+        device = torch.device('cuda:0' if torch.cuda.is_available() else 'cpu')
+    if labels is None:
+        labels = np.full(len(paths), -1, dtype=np.int64)
+    decoder = make_decoder(algo, numOut, device)
+    augment = BatchAugment(crop_size, random_crop=False, flip=False)
+    writer = PredictionWriter(out_dir, paths, labels, numOut, dict(meta or {}, algo=algo))
+    decode_image = ImageDecoder(size, fast_decode)
+    pool = Pool(num_workers) if num_workers > 0 else None
+    images = pool.imap(decode_image, paths, chunksize) if pool is not None else map(decode_image, paths)
+
+    model.train(False)
+    failed = 0
+    begin = 0
+    since = time.time()
+    try:
+        with inference_mode():
+            for batch in _batches(images, batch_size):
+                ok = [i for i, im in enumerate(batch) if im is not None]
+                count = np.full(len(batch), -1, dtype=np.int64)
+                probs = np.zeros((len(batch), numOut), dtype=np.float32)
+                if ok:
+                    inputs = torch.from_numpy(np.stack([batch[i] for i in ok]))
+                    if device.type == 'cuda':
+                        inputs = inputs.pin_memory()
+                    outputs = model(augment(inputs.to(device, non_blocking=True)))
+                    count[ok] = decoder.decode(outputs).cpu().numpy()
+                    probs[ok] = decoder.probs(outputs).float().cpu().numpy()
+                writer.write(begin, count, probs)
+                failed += len(batch) - len(ok)
+                begin += len(batch)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+        writer.close()
+    elapsed = time.time() - since
+    return {'images': begin, 'failed': failed, 'images_per_second': begin / max(elapsed, 1e-9)}
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Batch inference of a trained counting network')
+    parser.add_argument('model', help='Model saved with torch.save(model, path) or a train_model checkpoint')
+    parser.add_argument('out_dir', help='Output directory of the prediction columns')
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('--dir', help='Directory searched recursively for images')
+    source.add_argument('--manifest', help='Text file with one "path" or "path,label" per line')
+    source.add_argument('--index', help='Metadata index (index.npz), with --images')
+    parser.add_argument('--images', help='Image directory of the metadata index')
+    parser.add_argument('--min-count', type=int, default=0)
+    parser.add_argument('--max-count', type=int, default=None)
+    parser.add_argument('--algo', default=None, help='Algo the model was trained with, read from checkpoints')
+    parser.add_argument('--num-out', type=int, default=None, help='numOut the model was trained with')
+    parser.add_argument('--arch', default='resnet18', help='torchvision architecture of a checkpoint')
+    parser.add_argument('--batch-size', type=int, default=64)
+    parser.add_argument('--workers', type=int, default=12)
+    parser.add_argument('--fast-decode', action='store_true', help='Decode JPEGs at reduced resolution')
+    parser.add_argument('--cpu', action='store_true', help='Run on the CPU even if a GPU is available')
+    args = parser.parse_args()
+
+    if args.dir is not None:
+        paths, labels = directory_inputs(args.dir)
+    elif args.manifest is not None:
+        paths, labels = manifest_inputs(args.manifest)
+    else:
+        if args.images is None:
+            parser.error('--index needs --images')
+        paths, labels = index_inputs(args.index, args.images, args.min_count, args.max_count)
+    device = torch.device('cuda:0' if torch.cuda.is_available() and not args.cpu else 'cpu')
+    model, algo = load_model(args.model, device, args.arch, args.num_out)
+    algo = args.algo if args.algo is not None else algo
+    if algo is None:
+        parser.error('--algo is needed for a whole model file')
+    numOut = args.num_out if args.num_out is not None else count_classes(model)
+    print('Counting {} images with {} on {}'.format(len(paths), algo, device))
+    result = predict(model, paths, args.out_dir, algo, numOut, labels=labels, device=device,
+                     batch_size=args.batch_size, num_workers=args.workers, fast_decode=args.fast_decode,
+                     meta={'model': os.path.abspath(args.model)})
+    print('{images} images ({failed} failed), {images_per_second:.1f} images/s'.format(**result))
+
+    columns, meta = load_predictions(args.out_dir)
+    known = (columns['label'] >= 0) & (np.asarray(columns['count']) >= 0)
+    if np.any(known):
+        diff = np.abs(columns['label'][known] - np.asarray(columns['count'])[known])
+        print('CCR {:.4f} CCR-1 {:.4f} MAE {:.4f} RMSE {:.4f} on {} labeled images'.format(
+            np.mean(diff == 0), np.mean(diff <= 1), np.mean(diff), np.sqrt(np.mean(diff ** 2)), int(known.sum())))
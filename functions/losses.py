@@ -0,0 +1,470 @@
+from __future__ import print_function, division
+
+import torch
+import torch.nn as nn
+import numpy as np
+import math
+
+from functions.decoders import (argmax, binomial_counts, cheng_counts, cheng_pmf, one_hot, poisson_counts,
+                                round_counts)
+
+'''
+Loss strategies for train_model.
+
+Every algo of train_model is a LossStrategy registered under its name. A strategy is built once per run,
+owns its precomputed buffers (target tables, accumulators, log factorials) and criterion objects, and exposes
+    prepare_model(model): changes the last layer if the algo needs it
+    loss(outputs, labels): loss of a batch
+    decode(outputs): predicted counts of a batch as a LongTensor on the outputs' device (decoders.py)
+    probs(outputs): class probabilities of a batch (N x numOut) consistent with decode
+A new loss is added by subclassing LossStrategy and decorating it with register_loss.
+'''
+
+LOSSES = {}
+
+
+def register_loss(name, **overrides):
+    '''
+    Registers a LossStrategy class under an algo name.
+
+    :param name: Value of the algo argument of train_model
+    :param overrides: Keyword arguments forced for this algo, e.g. KL=True
+    '''
+    def wrap(cls):
+        LOSSES[name] = (cls, overrides)
+        return cls
+    return wrap
+
+
+def resolve_algo(algo=None, learn_a=False, fix_a=False, mae_loss=False, poisson=False, binomial=False,
+                 cheng=False, weighted_softmax=False, weighted_softmax_2=False, regression=False):
+    '''Name of the strategy for the boolean flags of train_model, used when algo is None.'''
+    if algo is not None:
+        return algo
+    if learn_a or fix_a:
+        return ('learn_a' if learn_a else 'fix_a') + ('_mae' if mae_loss else '')
+    if poisson:
+        return 'poisson'
+    if binomial:
+        return 'binomial'
+    if cheng:
+        return 'cheng'
+    if weighted_softmax:
+        return 'weighted_softmax'
+    if weighted_softmax_2:
+        return 'weighted_softmax_2'
+    if regression:
+        return 'regression_mae' if mae_loss else 'regression'
+    return 'mixed'
+
+
+def make_loss(algo, numOut, device, **kwargs):
+    '''
+    Builds the strategy registered under algo. kwargs are the loss arguments of train_model
+    (single_coeff, multi_coeff, cross_loss, multi_loss, KL, mae_loss, cheng_lambda, softmax_matrices).
+    '''
+    if algo not in LOSSES:
+        raise ValueError('Undefined algo: ' + str(algo))
+    cls, overrides = LOSSES[algo]
+    kwargs.update(overrides)
+    return cls(numOut, device, **kwargs)
+
+
+def make_decoder(algo, numOut, device):
+    '''
+    Strategy of algo for decode and probs only, e.g. for inference with a trained model. Decoding does not
+    depend on the loss coefficients, identity tables stand in for them.
+    '''
+    return make_loss(algo, numOut, device, single_coeff=np.eye(numOut), multi_coeff=np.eye(numOut))
+
+
+def kl_window_table(coeff, numOut):
+    '''
+    Soft targets of the poisson and binomial KL losses. Row l is the window coeff centered on label l,
+    cut to numOut classes and renormalized (no renormalization for a single coefficient).
+    '''
+    coeff = np.asarray(coeff, dtype=np.float64).reshape(-1)
+    extend = int((len(coeff) - 1) / 2)
+    table = np.zeros((numOut, numOut))
+    for label in range(numOut):
+        label_multi = np.zeros(numOut + 2 * extend)
+        label_multi[label:label + 2 * extend + 1] = coeff
+        if extend != 0:
+            label_multi = label_multi[extend:-extend]
+            label_multi = label_multi / np.sum(label_multi)
+        table[label, :] = label_multi
+    return table
+
+
+def make_coeff(n, metric, loss='softmax', lmbda=1):
+    '''
+    Soft target rows of train_and_validate.ipynb, one row per label, blended with the identity:
+    (1 - lmbda) * eye + lmbda * rows.
+
+    :param metric: 'ccr' (identity), 'ccr1' (labels k-1, k, k+1), 'mae' or 'mse' (windows of growing width
+    weighted for the metric) or 'test' (linear decay with the distance)
+    :param loss: 'softmax' rows sum to one, 'sigmoid' rows are scaled for the multi-label losses
+    '''
+    if metric == 'ccr':
+        return np.eye(n)
+    elif metric == 'ccr1':
+        coeff = np.zeros((n, n))
+        for k in range(n):
+            coeff[k, np.maximum(k - 1, 0):np.minimum(k + 2, n)] = 1
+        if loss == 'softmax':
+            coeff = coeff / np.sum(coeff, axis=1).reshape(-1, 1)
+    elif metric == 'mae':
+        coeff = np.zeros((n, n))
+        for k in range(n):
+            row = np.zeros(n)
+            for l in range(n - 1):
+                row_ = np.zeros(n)
+                row_[np.maximum(k - l, 0):np.minimum(k + l + 1, n)] = 1
+                if loss == 'softmax':
+                    row_ = row_ / np.sum(row_)
+                row += row_ / (n - 1)
+            coeff[k, :] = row
+    elif metric == 'mse':
+        coeff = np.zeros((n, n))
+        for k in range(n):
+            row = np.zeros(n)
+            for l in range(n - 1):
+                row_ = np.zeros(n)
+                row_[np.maximum(k - l, 0):np.minimum(k + l + 1, n)] = 1
+                row += (2 * l + 1) * row_
+            if loss == 'softmax':
+                row = row / np.sum(row)
+            elif loss == 'sigmoid':
+                row = row / ((n ** 2) - (2 * n) + 1)
+            else:
+                raise ValueError('Undefined loss: ' + str(loss))
+            coeff[k, :] = row
+    elif metric == 'test':
+        coeff = 1 - np.abs(np.arange(n).reshape(-1, 1) - np.arange(n)) / 45.
+    else:
+        raise ValueError('Undefined metric: ' + str(metric))
+    return np.eye(n) * (1 - lmbda) + lmbda * coeff
+
+
+def get_soft_matrices(metric, n):
+    '''
+    (weight, matrix) pairs of the weighted_softmax_2 algo for a metric, as in train_and_validate.ipynb: the
+    identity for 'ccr' and 'test', the tridiagonal ones for 'ccr1', windows of half width 0 .. n - 2
+    weighted 2k + 1 for 'mae' and 'mse'.
+    '''
+    if metric in ('ccr', 'test'):
+        matrices = [(1, np.eye(n))]
+    elif metric == 'ccr1':
+        mat = np.eye(n)
+        for k in range(n - 1):
+            mat[k, k + 1] = 1
+            mat[k + 1, k] = 1
+        matrices = [(1, mat)]
+    elif metric in ('mae', 'mse'):
+        matrices = [(1, np.eye(n))]
+        for k in range(1, n - 1):
+            mat = np.eye(n)
+            for l in range(n):
+                mat[l, max(0, l - k):(k + l + 1)] = 1
+            matrices.append((2 * k + 1, mat))
+    else:
+        raise ValueError('Undefined metric: ' + str(metric))
+    return [(coeff, torch.from_numpy(mat).float()) for coeff, mat in matrices]
+
+
+def weighted_softmax_table(numOut):
+    '''Targets of the accumulated weighted softmax loss, a block of numOut - 1 ones for every label.'''
+    table = np.zeros((numOut, numOut * (numOut - 1)))
+    for label in range(numOut):
+        table[label, label * (numOut - 1):(label + 1) * (numOut - 1)] = 1
+    return table
+
+
+def target_table(coeff, device):
+    '''Label to soft target lookup table on the device, targets of a batch are table[labels].'''
+    return torch.from_numpy(np.asarray(coeff, dtype=np.float64)).type(torch.FloatTensor).to(device)
+
+
+class LossStrategy(object):
+    '''Base strategy, a single output per class decoded with argmax.'''
+
+    def __init__(self, numOut, device, single_coeff=(1, 1, 1), multi_coeff=(1, 1, 1), cross_loss=1.,
+                 multi_loss=0., KL=False, mae_loss=False, cheng_lambda=0, softmax_matrices=()):
+        self.numOut = numOut
+        self.device = device
+        self.single_coeff = single_coeff
+        self.multi_coeff = multi_coeff
+        self.cross_loss = cross_loss
+        self.multi_loss = multi_loss
+        self.KL = KL
+        self.mae_loss = mae_loss
+        self.cheng_lambda = cheng_lambda
+        self.softmax_matrices = softmax_matrices
+
+    def prepare_model(self, model):
+        return model
+
+    def loss(self, outputs, labels):
+        raise NotImplementedError
+
+    def decode(self, outputs):
+        return argmax(outputs)
+
+    def probs(self, outputs):
+        return torch.softmax(outputs, 1)
+
+
+@register_loss('mixed')
+@register_loss('softmax', cross_loss=1., multi_loss=0.)
+@register_loss('sigmoid', cross_loss=0., multi_loss=1.)
+@register_loss('KL', KL=True, cross_loss=1., multi_loss=0.)
+class MixedLoss(LossStrategy):
+    '''
+    cross_loss x (cross entropy, or KL divergence to single_coeff rows if KL)
+    + multi_loss x multi-label soft margin loss to multi_coeff rows.
+    '''
+
+    def __init__(self, numOut, device, **kwargs):
+        super(MixedLoss, self).__init__(numOut, device, **kwargs)
+        if self.KL and self.cross_loss > 0.:
+            self.single_targets = target_table(self.single_coeff, device)
+        if self.multi_loss > 0.:
+            self.multi_targets = target_table(self.multi_coeff, device)
+        self.log_softmax = nn.LogSoftmax(dim=1)
+        self.kl_div = nn.KLDivLoss()
+        self.cross_entropy = nn.CrossEntropyLoss()
+        self.soft_margin = nn.MultiLabelSoftMarginLoss()
+
+    def loss(self, outputs, labels):
+        loss = 0.0
+        if self.cross_loss > 0.:
+            if self.KL:
+                loss += self.cross_loss * self.kl_div(self.log_softmax(outputs), self.single_targets[labels])
+            else:
+                loss += self.cross_loss * self.cross_entropy(outputs, labels)
+        if self.multi_loss > 0.:
+            loss += self.multi_loss * self.soft_margin(outputs, self.multi_targets[labels])
+        return loss
+
+
+@register_loss('learn_a', cross_loss=1., multi_loss=0.)
+@register_loss('learn_a_mae', cross_loss=1., multi_loss=0., mae_loss=True)
+class LearnALoss(LossStrategy):
+    '''Softmax followed by a learned linear layer to a scalar count in [0, numOut - 1], MSE or MAE loss.'''
+
+    fixed = False
+
+    def __init__(self, numOut, device, **kwargs):
+        super(LearnALoss, self).__init__(numOut, device, **kwargs)
+        self.criterion = nn.L1Loss() if self.mae_loss else nn.MSELoss()
+        self.sigmoid = nn.Sigmoid()
+
+    def prepare_model(self, model):
+        model.fc = nn.Sequential(model.fc, nn.Softmax(dim=1),
+                                 nn.Linear(model.fc.out_features, 1, bias=False)).to(self.device)
+        if self.fixed:
+            model.fc[2].weight = torch.nn.Parameter(
+                torch.arange(0, self.numOut, dtype=torch.float32, device=self.device).view(1, -1), False)
+        return model
+
+    def counts(self, outputs):
+        if self.fixed:
+            return outputs
+        return (self.numOut - 1) * self.sigmoid(outputs)
+
+    def loss(self, outputs, labels):
+        return self.criterion(self.counts(outputs), labels.float().view(-1, 1))
+
+    def decode(self, outputs):
+        return round_counts(self.counts(outputs), self.numOut)
+
+    def probs(self, outputs):
+        return one_hot(self.decode(outputs), self.numOut)
+
+
+@register_loss('fix_a', cross_loss=1., multi_loss=0.)
+@register_loss('fix_a_mae', cross_loss=1., multi_loss=0., mae_loss=True)
+class FixALoss(LearnALoss):
+    '''Expected count of the softmax with the fixed weights 0, 1, ..., numOut - 1.'''
+
+    fixed = True
+
+
+@register_loss('regression', cross_loss=1., multi_loss=0.)
+@register_loss('regression_mae', cross_loss=1., multi_loss=0., mae_loss=True)
+class RegressionLoss(LossStrategy):
+    '''
+    Scalar output regressed to the count with MSE or MAE, decoded by rounding.
+
+    Before the strategy registry, 'regression' built the 1 output head but fell through to the softmax branch
+    of train_model: a cross entropy over that single output (which fails on any label above 0) and argmax
+    counts (always 0). Results of runs made with that path are not comparable with this loss.
+    '''
+
+    def __init__(self, numOut, device, **kwargs):
+        super(RegressionLoss, self).__init__(numOut, device, **kwargs)
+        self.criterion = nn.L1Loss() if self.mae_loss else nn.MSELoss()
+
+    def prepare_model(self, model):
+        model.fc = nn.Linear(model.fc.in_features, 1).to(self.device)
+        return model
+
+    def loss(self, outputs, labels):
+        return self.criterion(outputs, labels.float().view(-1, 1))
+
+    def decode(self, outputs):
+        return round_counts(outputs, self.numOut)
+
+    def probs(self, outputs):
+        return one_hot(self.decode(outputs), self.numOut)
+
+
+class _ScalarPMFLoss(LossStrategy):
+    '''Scalar output turned into a PMF over the counts, KL divergence to the windowed single_coeff targets.'''
+
+    def __init__(self, numOut, device, **kwargs):
+        super(_ScalarPMFLoss, self).__init__(numOut, device, **kwargs)
+        self.kl_targets = target_table(kl_window_table(self.single_coeff, numOut), device)
+        self.ones_vec = torch.ones(numOut).type(torch.FloatTensor).view(1, numOut).to(device)
+        self.j_vec = torch.arange(0, numOut).type(torch.FloatTensor).view(1, numOut).to(device)
+        self.log_softmax = nn.LogSoftmax(dim=1)
+        self.kl_div = nn.KLDivLoss()
+
+    def prepare_model(self, model):
+        model.fc = nn.Linear(model.fc.in_features, 1).to(self.device)
+        return model
+
+    def log_pmf(self, outputs):
+        raise NotImplementedError
+
+    def loss(self, outputs, labels):
+        return self.kl_div(self.log_softmax(self.log_pmf(outputs)), self.kl_targets[labels])
+
+    def probs(self, outputs):
+        # PMF cut to the numOut counts and renormalized
+        return torch.softmax(self.log_pmf(outputs), 1)
+
+
+@register_loss('poisson', KL=True, cross_loss=0., multi_loss=0., multi_coeff=[1], single_coeff=[1])
+class PoissonLoss(_ScalarPMFLoss):
+    '''Poisson PMF with the softplus of the output as rate.'''
+
+    def __init__(self, numOut, device, **kwargs):
+        super(PoissonLoss, self).__init__(numOut, device, **kwargs)
+        log_j_fact = np.log(np.asarray([math.factorial(j) for j in range(numOut)]))
+        self.log_j_fact = torch.from_numpy(log_j_fact).type(torch.FloatTensor).view(1, numOut).to(device)
+        self.softplus = nn.Softplus()
+
+    def log_pmf(self, outputs):
+        rate = torch.mm(self.softplus(outputs), self.ones_vec)
+        return self.j_vec * torch.log(rate) - rate - self.log_j_fact
+
+    def decode(self, outputs):
+        return poisson_counts(self.softplus(outputs), self.numOut)
+
+
+@register_loss('binomial', KL=True, cross_loss=0., multi_loss=0., multi_coeff=[1], single_coeff=[1])
+class BinomialLoss(_ScalarPMFLoss):
+    '''Binomial PMF over numOut - 1 trials with the squashed sigmoid of the output as probability.'''
+
+    def __init__(self, numOut, device, **kwargs):
+        super(BinomialLoss, self).__init__(numOut, device, **kwargs)
+        log_j_binom = np.log(np.asarray([math.factorial(numOut - 1) /
+                                         (math.factorial(j) * math.factorial(numOut - 1 - j)) for j in range(numOut)]))
+        self.log_j_binom = torch.from_numpy(log_j_binom).type(torch.FloatTensor).view(1, numOut).to(device)
+        self.sigmoid = nn.Sigmoid()
+
+    def prob(self, outputs):
+        return ((self.sigmoid(outputs) - 0.5) * 0.99) + .5
+
+    def log_pmf(self, outputs):
+        p = torch.mm(self.prob(outputs), self.ones_vec)
+        return self.j_vec * torch.log(p) + (self.numOut - 1 - self.j_vec) * torch.log(1 - p) + self.log_j_binom
+
+    def decode(self, outputs):
+        return binomial_counts(self.prob(outputs), self.numOut)
+
+
+@register_loss('cheng', KL=True, cross_loss=0., multi_loss=0.)
+class ChengLoss(LossStrategy):
+    '''
+    Ordinal (Cheng et al.) targets: output k is trained to be on if the count is at least k, with the
+    cumulative multi_coeff rows as soft targets. cheng_lambda adds a cross entropy term.
+    '''
+
+    def __init__(self, numOut, device, **kwargs):
+        super(ChengLoss, self).__init__(numOut, device, **kwargs)
+        multi_coeff = np.array(self.multi_coeff, dtype=np.float64)
+        for k in range(multi_coeff.shape[0]):
+            temp = multi_coeff[k, :]
+            temp = temp / np.sum(temp)
+            temp = np.cumsum(temp[::-1])
+            multi_coeff[k, :] = temp[::-1]
+        self.multi_targets = target_table(multi_coeff, device)
+        self.soft_margin = nn.MultiLabelSoftMarginLoss()
+        self.cross_entropy = nn.CrossEntropyLoss()
+
+    def loss(self, outputs, labels):
+        loss = self.soft_margin(outputs, self.multi_targets[labels])
+        if self.cheng_lambda > 0:
+            loss += self.cheng_lambda * self.cross_entropy(outputs, labels)
+        return loss
+
+    def decode(self, outputs):
+        return cheng_counts(outputs, self.numOut)
+
+    def probs(self, outputs):
+        # Output k estimates P(count >= k)
+        return cheng_pmf(outputs)
+
+
+@register_loss('weighted_softmax', KL=True)
+class WeightedSoftmaxLoss(LossStrategy):
+    '''
+    multi_loss x KL divergence of the softmax accumulated over windows of growing width around every class,
+    plus cross_loss x (KL divergence to single_coeff rows, or cross entropy without KL).
+    '''
+
+    def __init__(self, numOut, device, **kwargs):
+        super(WeightedSoftmaxLoss, self).__init__(numOut, device, **kwargs)
+        Accumulators = np.zeros((numOut, numOut * (numOut - 1)))
+        for l in range(numOut):
+            for k in range(numOut - 1):
+                Accumulators[np.maximum(0, l - k):np.minimum(numOut, l + k + 1), l * (numOut - 1) + k] = 1
+        self.Accumulators = torch.from_numpy(Accumulators).type(torch.FloatTensor).to(device)
+        self.ws_targets = target_table(weighted_softmax_table(numOut), device)
+        if self.KL and self.cross_loss > 0.:
+            self.single_targets = target_table(self.single_coeff, device)
+        self.softmax = nn.Softmax(dim=1)
+        self.log_softmax = nn.LogSoftmax(dim=1)
+        self.kl_div = nn.KLDivLoss()
+        self.cross_entropy = nn.CrossEntropyLoss()
+
+    def loss(self, outputs, labels):
+        loss = 0.0
+        if self.multi_loss > 0. and self.KL:
+            outputs_accumulated_soft = torch.mm(self.softmax(outputs), self.Accumulators)
+            loss += (self.multi_loss * (self.numOut - 1) *
+                     self.kl_div(torch.log(outputs_accumulated_soft), self.ws_targets[labels])) / 3.0
+        if self.cross_loss > 0.:
+            if self.KL:
+                loss += self.cross_loss * self.kl_div(self.log_softmax(outputs), self.single_targets[labels])
+            else:
+                loss += self.cross_loss * self.cross_entropy(outputs, labels)
+        return loss
+
+
+@register_loss('weighted_softmax_2', KL=True)
+class WeightedSoftmax2Loss(LossStrategy):
+    '''Sum of cross entropies of the outputs mixed by every matrix of softmax_matrices.'''
+
+    def __init__(self, numOut, device, **kwargs):
+        super(WeightedSoftmax2Loss, self).__init__(numOut, device, **kwargs)
+        self.matrices = [matrice.to(device) for coeff, matrice in self.softmax_matrices]
+        self.cross_entropy = nn.CrossEntropyLoss()
+
+    def loss(self, outputs, labels):
+        loss = 0.0
+        for matrice in self.matrices:
+            loss += self.cross_entropy(torch.mm(outputs, matrice), labels)
+        return loss
@@ -0,0 +1,213 @@
+from __future__ import print_function, division
+
+import torch
+import numpy as np
+import os
+import json
+from multiprocessing import Pool
+from PIL import Image
+
+'''
+Columnar index over the ABID metadata JSON files.
+
+Replaces the serial walk of Folder_images.ipynb. Every metadata file is parsed once by a process pool
+and stored as one row of a set of numpy columns (index.npz). Re-indexing only parses files whose
+modification time or size changed. Loaders select images by count range from the index instead of
+relying on per-count folders.
+'''
+
+COLUMNS = ('image_id', 'quantity', 'num_skus', 'weight', 'mtime', 'size')
+
+
+def _read_metadata(args):
+    '''Parses one metadata file. Returns a row tuple in COLUMNS order, quantity is -1 if the file is broken.'''
+    path, mtime, size = args
+    image_id = os.path.splitext(os.path.basename(path))[0]
+    try:
+        with open(path) as json_file:
+            metadata = json.load(json_file)
+    except (IOError, ValueError):
+        return image_id, -1, 0, 0., mtime, size
+    skus = metadata.get('BIN_FCSKU_DATA', {}) or {}
+    weight = 0.
+    for sku in skus.values():
+        w = sku.get('weight', {}).get('value', 0.) or 0.
+        weight += w * sku.get('quantity', 1)
+    return image_id, int(metadata.get('EXPECTED_QUANTITY', -1)), len(skus), weight, mtime, size
+
+
+def _scan(metadata_dir):
+    entries = [e for e in os.scandir(metadata_dir) if e.is_file() and e.name.endswith('.json')]
+    names = np.asarray([os.path.splitext(e.name)[0] for e in entries])
+    stats = [e.stat() for e in entries]
+    mtimes = np.asarray([s.st_mtime for s in stats], dtype=np.float64)
+    sizes = np.asarray([s.st_size for s in stats], dtype=np.int64)
+    paths = [e.path for e in entries]
+    return names, mtimes, sizes, paths
+
+
+class MetadataIndex(object):
+    '''
+    Columns of the metadata index, one entry per image, sorted by image_id.
+
+    image_id: Image name without extension
+    quantity: EXPECTED_QUANTITY of the bin (-1 for unreadable files)
+    num_skus: Number of distinct products in the bin
+    weight: Total weight of the bin in pounds
+    mtime, size: Modification time and size of the metadata file, used for incremental updates
+    '''
+
+    def __init__(self, columns=None):
+        if columns is None:
+            columns = {'image_id': np.zeros(0, dtype='U1'),
+                       'quantity': np.zeros(0, dtype=np.int32),
+                       'num_skus': np.zeros(0, dtype=np.int32),
+                       'weight': np.zeros(0, dtype=np.float32),
+                       'mtime': np.zeros(0, dtype=np.float64),
+                       'size': np.zeros(0, dtype=np.int64)}
+        self.columns = columns
+
+    def __len__(self):
+        return len(self.columns['image_id'])
+
+    def __getitem__(self, name):
+        return self.columns[name]
+
+    @classmethod
+    def load(cls, path):
+        data = np.load(path)
+        return cls({name: data[name] for name in COLUMNS})
+
+    def save(self, path):
+        np.savez(path, **self.columns)
+
+    def rows(self, ids):
+        '''Row numbers of the given image ids, -1 for ids that are not in the index.'''
+        ids = np.asarray(ids)
+        image_id = self.columns['image_id']
+        pos = np.searchsorted(image_id, ids)
+        pos[pos == len(image_id)] = 0
+        found = len(image_id) > 0 and image_id[pos] == ids
+        return np.where(found, pos, -1)
+
+    def query(self, min_count=0, max_count=None):
+        '''Row numbers of the images whose expected quantity is in [min_count, max_count].'''
+        quantity = self.columns['quantity']
+        mask = quantity >= min_count
+        if max_count is not None:
+            mask &= quantity <= max_count
+        return np.flatnonzero(mask)
+
+    def image_paths(self, images_dir, rows=None, ext='.jpg'):
+        image_id = self.columns['image_id']
+        if rows is not None:
+            image_id = image_id[rows]
+        return [os.path.join(images_dir, name + ext) for name in image_id]
+
+
+def build_index(metadata_dir, index_path=None, num_workers=12, chunksize=256):
+    '''
+    Builds or incrementally updates the metadata index.
+
+    :param metadata_dir: Directory with the ABID metadata JSON files
+    :param index_path: index.npz to update and save, rows of unchanged files are reused
+    :param num_workers: Number of parsing processes
+    :param chunksize: Files per task sent to a worker
+
+    :return: MetadataIndex
+    '''
+    names, mtimes, sizes, paths = _scan(metadata_dir)
+    order = np.argsort(names)
+    names, mtimes, sizes = names[order], mtimes[order], sizes[order]
+    paths = [paths[k] for k in order]
+
+    if index_path is not None and os.path.exists(index_path):
+        old = MetadataIndex.load(index_path)
+    else:
+        old = MetadataIndex()
+
+    old_rows = old.rows(names)
+    known = old_rows >= 0
+    unchanged = known.copy()
+    unchanged[known] = (old['mtime'][old_rows[known]] == mtimes[known]) & \
+                       (old['size'][old_rows[known]] == sizes[known])
+    todo = np.flatnonzero(~unchanged)
+    print('{} metadata files, {} new or changed, {} removed'.format(
+        len(names), len(todo), len(old) - int(np.sum(known))))
+
+    columns = {'image_id': names,
+               'quantity': np.zeros(len(names), dtype=np.int32),
+               'num_skus': np.zeros(len(names), dtype=np.int32),
+               'weight': np.zeros(len(names), dtype=np.float32),
+               'mtime': mtimes,
+               'size': sizes}
+    for name in ('quantity', 'num_skus', 'weight'):
+        columns[name][unchanged] = old[name][old_rows[unchanged]]
+
+    if len(todo) > 0:
+        jobs = [(paths[k], mtimes[k], sizes[k]) for k in todo]
+        pool = Pool(num_workers)
+        try:
+            rows = pool.map(_read_metadata, jobs, chunksize=chunksize)
+        finally:
+            pool.close()
+            pool.join()
+        columns['quantity'][todo] = [row[1] for row in rows]
+        columns['num_skus'][todo] = [row[2] for row in rows]
+        columns['weight'][todo] = [row[3] for row in rows]
+
+    index = MetadataIndex(columns)
+    if index_path is not None:
+        index.save(index_path)
+    return index
+
+
+def count_labels(quantity, max_class=10):
+    '''Class labels from expected quantities, counts above max_class - 1 share the last class (10plus).'''
+    return np.minimum(quantity, max_class).astype(np.int64)
+
+
+class IndexDataset(torch.utils.data.Dataset):
+    '''
+    Image dataset driven by the metadata index instead of the per-count folder layout.
+
+    :param index: MetadataIndex
+    :param images_dir: Directory with the flat ABID images (<image_id>.jpg)
+    :param rows: Rows of the index to use, query(min_count, max_count) is used if None
+    :param max_class: Counts of max_class and above are mapped to the last class
+    '''
+
+    def __init__(self, index, images_dir, transform=None, rows=None, min_count=0, max_count=None, max_class=10,
+                 loader=None):
+        if rows is None:
+            rows = index.query(min_count, max_count)
+        self.rows = np.asarray(rows)
+        self.paths = index.image_paths(images_dir, self.rows)
+        self.labels = count_labels(index['quantity'][self.rows], max_class)
+        self.classes = [str(c) for c in range(max_class)] + [str(max_class) + 'plus']
+        self.imgs = list(zip(self.paths, self.labels.tolist()))
+        self.transform = transform
+        self.loader = loader
+
+    def __len__(self):
+        return len(self.paths)
+
+    def __getitem__(self, idx):
+        if self.loader is not None:
+            im = self.loader(self.paths[idx])
+        else:
+            im = Image.open(self.paths[idx]).convert('RGB')
+        if self.transform is not None:
+            im = self.transform(im)
+        return im, int(self.labels[idx])
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Build or update the ABID metadata index')
+    parser.add_argument('metadata_dir')
+    parser.add_argument('index_path')
+    parser.add_argument('--workers', type=int, default=12)
+    args = parser.parse_args()
+    build_index(args.metadata_dir, args.index_path, num_workers=args.workers)
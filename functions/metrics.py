@@ -0,0 +1,76 @@
+from __future__ import print_function, division
+
+import torch
+import numpy as np
+
+
+class CountMetrics(object):
+    '''
+    Running counting metrics kept on the model's device.
+
+    update only issues device ops (a scatter into a count confusion matrix and a loss sum), so the training
+    loop does not synchronize with the device. compute reads both back once and returns the metrics of
+    train_model: accuracy (CCR), CIR-1, RMSE, MAE and the summed batch loss divided by the sample count.
+    '''
+
+    def __init__(self, numOut, device):
+        self.numOut = numOut
+        self.device = device
+        label, pred = np.meshgrid(np.arange(numOut), np.arange(numOut), indexing='ij')
+        self.diff = np.abs(label - pred)
+        self.reset()
+
+    def reset(self):
+        self.confusion = torch.zeros(self.numOut * self.numOut, dtype=torch.long, device=self.device)
+        self.loss_sum = torch.zeros(1, dtype=torch.float64, device=self.device)
+
+    def update(self, preds, labels, loss=None):
+        '''
+        :param preds: Predicted counts, LongTensor
+        :param labels: True counts, LongTensor
+        :param loss: Loss of the batch, added to the loss sum
+        '''
+        idx = labels.view(-1) * self.numOut + preds.view(-1)
+        self.confusion.scatter_add_(0, idx, torch.ones_like(idx))
+        if loss is not None:
+            self.loss_sum += loss.detach().double()
+
+    def all_reduce(self):
+        '''
+        Sums the confusion matrices of every process of the default process group. The loss sums are
+        averaged, the batch losses being means over the per-process parts of the global batches.
+        '''
+        import torch.distributed as dist
+        dist.all_reduce(self.confusion)
+        dist.all_reduce(self.loss_sum)
+        self.loss_sum /= dist.get_world_size()
+
+    def state_dict(self):
+        return {'confusion': self.confusion.cpu().clone(), 'loss_sum': self.loss_sum.cpu().clone()}
+
+    def load_state_dict(self, state):
+        self.confusion = state['confusion'].to(self.device).clone()
+        self.loss_sum = state['loss_sum'].to(self.device).clone()
+
+    def confusion_matrix(self):
+        '''Confusion matrix on the host, rows are labels and columns are predictions.'''
+        return self.confusion.view(self.numOut, self.numOut).cpu().numpy()
+
+    def compute(self, n=None):
+        '''
+        :param n: Normalizer, the number of seen samples if None (train_model passes the dataset size)
+
+        :return: Dictionary with loss, acc, cir1, rmse, mae and count
+        '''
+        values = torch.cat([self.confusion.double(), self.loss_sum]).cpu().numpy()
+        confusion = values[:-1].reshape(self.numOut, self.numOut)
+        count = np.sum(confusion)
+        if n is None:
+            n = count
+        n = float(max(n, 1))
+        return {'loss': values[-1] / n,
+                'acc': np.sum(confusion[self.diff == 0]) / n,
+                'cir1': np.sum(confusion[self.diff <= 1]) / n,
+                'rmse': np.sqrt(np.sum(confusion * self.diff ** 2) / n),
+                'mae': np.sum(confusion * self.diff) / n,
+                'count': int(count)}
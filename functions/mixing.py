@@ -0,0 +1,68 @@
+from __future__ import print_function, division
+
+import torch
+
+
+class PersistentIterator(object):
+    '''
+    Long-lived iterator over a DataLoader. The underlying iterator (and its worker pool and prefetch queue)
+    is only recreated when the loader is exhausted, never per batch.
+    '''
+
+    def __init__(self, loader):
+        self.loader = loader
+        self._it = None
+        self.restarts = 0
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self._it is None:
+            self._it = iter(self.loader)
+        try:
+            return next(self._it)
+        except StopIteration:
+            self.restarts += 1
+            self._it = iter(self.loader)
+            return next(self._it)
+
+    next = __next__
+
+
+class MixedLoader(object):
+    '''
+    Epochs of a fixed number of steps mixed from several loaders.
+
+    Every step takes ratios[k] batches from source k through a PersistentIterator and concatenates them
+    into one batch, so it can be used as dset_loaders['train'] of train_model.
+
+    :param loaders: List of DataLoaders (e.g. real and synthetic training loaders)
+    :param ratios: Batches per step from every loader, 1 for each if None
+    :param steps: Steps per epoch, the length of the first loader if None
+    '''
+
+    def __init__(self, loaders, ratios=None, steps=None):
+        self.loaders = list(loaders)
+        self.ratios = list(ratios) if ratios is not None else [1] * len(self.loaders)
+        if len(self.ratios) != len(self.loaders):
+            raise ValueError('One ratio is needed for every loader')
+        self.steps = steps if steps is not None else len(self.loaders[0])
+        self.iterators = [PersistentIterator(loader) for loader in self.loaders]
+
+    def __len__(self):
+        return self.steps
+
+    def __iter__(self):
+        for step in range(self.steps):
+            inputs = []
+            labels = []
+            for iterator, ratio in zip(self.iterators, self.ratios):
+                for k in range(ratio):
+                    x, y = next(iterator)
+                    inputs.append(x)
+                    labels.append(y)
+            if len(inputs) == 1:
+                yield inputs[0], labels[0]
+            else:
+                yield torch.cat(inputs, 0), torch.cat(labels, 0)
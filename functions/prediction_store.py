@@ -0,0 +1,333 @@
+from __future__ import print_function, division
+
+import numpy as np
+import os
+import json
+from PIL import Image
+
+from functions.decode import open_draft
+
+'''
+Persistent prediction store of a run, for error mining.
+
+One row per (image, epoch or checkpoint) with the image id, label, decoded count and class probabilities,
+kept as append-only raw columns read through np.memmap:
+    meta.json          numOut, number of rows, id width, image directory, indexed row count
+    image_id.S         fixed width byte strings
+    path.S             image paths, if the rows were appended with them
+    label.i64, pred.i64, epoch.i64
+    probs.f32          rows x numOut
+    index_<name>.*     sorted indexes, rebuilt on the first query after an append
+
+An index sorts the rows by a tuple of key columns packed into one int64 (every column a digit spanning its
+min .. max over the store, kept in meta.json), so a query that fixes the leading
+columns and bounds the next one is a binary search and a slice of the row order; the other conditions are
+checked on the returned rows only. Queries over hundreds of thousands of rows take milliseconds:
+
+  store = PredictionStore('runs/cheng_fold0')
+  rows = store.query(label=3, pred=(5, None))           # latest epoch, 3 objects predicted as >= 5
+  store.thumbnails(rows[:50])                           # written on demand to runs/cheng_fold0/thumbs
+'''
+
+# Sorted indexes and their key columns; abs_error is |pred - label|
+INDEXES = {'label': ('epoch', 'label', 'pred'),
+           'pred': ('epoch', 'pred', 'label'),
+           'error': ('epoch', 'abs_error', 'label')}
+
+COLUMNS = {'label': np.int64, 'pred': np.int64, 'epoch': np.int64}
+
+
+class PredictionStore(object):
+    '''
+    :param path: Store directory, created if it does not exist
+    :param numOut: Number of count classes, needed to create a store
+    :param images_dir: Directory of the images (<images_dir>/<image_id><ext>), used for thumbnails
+    '''
+
+    def __init__(self, path, numOut=None, images_dir=None, ext='.jpg', id_width=32, path_width=256):
+        self.path = path
+        meta_path = os.path.join(path, 'meta.json')
+        if os.path.exists(meta_path):
+            with open(meta_path) as f:
+                self.meta = json.load(f)
+            if images_dir is not None:
+                self.meta['images_dir'] = images_dir
+        else:
+            if numOut is None:
+                raise ValueError('numOut is needed to create a prediction store')
+            if not os.path.exists(path):
+                os.makedirs(path)
+            self.meta = {'numOut': numOut, 'rows': 0, 'id_width': id_width, 'images_dir': images_dir, 'ext': ext,
+                         'path_width': path_width, 'paths': None, 'epochs': [], 'indexed': 0}
+            self._write_meta()
+        self.numOut = self.meta['numOut']
+        self._columns = None
+        self._indexes = {}
+
+    def _file(self, name):
+        return os.path.join(self.path, name)
+
+    def _write_meta(self):
+        with open(self._file('meta.json.tmp'), 'w') as f:
+            json.dump(self.meta, f, indent=1)
+        os.replace(self._file('meta.json.tmp'), self._file('meta.json'))
+
+    def __len__(self):
+        return self.meta['rows']
+
+    def append(self, image_ids, labels, preds, probs, epoch, paths=None):
+        '''
+        Adds the predictions of one epoch or checkpoint.
+
+        :param image_ids: Image ids (file names without extension)
+        :param probs: n x numOut class probabilities
+        :param epoch: Epoch or checkpoint number of every row (an int for all)
+        :param paths: Image paths, given for every append of a store or for none
+        '''
+        n = len(image_ids)
+        if self.meta['paths'] is None:
+            self.meta['paths'] = paths is not None
+        if self.meta['paths'] != (paths is not None):
+            raise ValueError('Image paths must be given for all or none of the appends')
+        if paths is not None:
+            with open(self._file('path.S'), 'ab') as f:
+                f.write(np.asarray(paths, dtype='S{}'.format(self.meta['path_width'])).tobytes())
+        ids = np.asarray(image_ids, dtype='S{}'.format(self.meta['id_width']))
+        values = {'label': labels, 'pred': preds, 'epoch': np.broadcast_to(epoch, (n,))}
+        probs = np.asarray(probs, dtype=np.float32).reshape(n, self.numOut)
+        with open(self._file('image_id.S'), 'ab') as f:
+            f.write(ids.tobytes())
+        for name, dtype in COLUMNS.items():
+            with open(self._file(name + '.i64'), 'ab') as f:
+                f.write(np.ascontiguousarray(values[name], dtype=dtype).tobytes())
+        with open(self._file('probs.f32'), 'ab') as f:
+            f.write(probs.tobytes())
+        self.meta['rows'] += n
+        self.meta['epochs'] = sorted(set(self.meta['epochs']) | set(np.unique(values['epoch']).tolist()))
+        self._write_meta()
+        self._columns = None
+
+    def columns(self):
+        '''Memory mapped columns, plus abs_error.'''
+        if self._columns is None:
+            n = len(self)
+            if n == 0:
+                raise ValueError('The prediction store is empty')
+            cols = {'image_id': np.memmap(self._file('image_id.S'), dtype='S{}'.format(self.meta['id_width']),
+                                          mode='r', shape=(n,)),
+                    'probs': np.memmap(self._file('probs.f32'), dtype=np.float32, mode='r', shape=(n, self.numOut))}
+            for name, dtype in COLUMNS.items():
+                cols[name] = np.memmap(self._file(name + '.i64'), dtype=dtype, mode='r', shape=(n,))
+            if self.meta['paths']:
+                cols['path'] = np.memmap(self._file('path.S'), dtype='S{}'.format(self.meta['path_width']),
+                                         mode='r', shape=(n,))
+            cols['abs_error'] = np.abs(cols['pred'] - cols['label'])
+            self._columns = cols
+        return self._columns
+
+    def epochs(self):
+        return np.asarray(self.meta['epochs'], dtype=np.int64)
+
+    def _digit(self, name):
+        '''Lowest value and radix of a column's digit in the packed keys, epochs are ranked.'''
+        if name == 'epoch':
+            return 0, len(self.meta['epochs'])
+        return self.meta['digits'][name]
+
+    def _keys(self, names, values):
+        '''Packed int64 keys of per-column values (epochs already ranked).'''
+        key = np.zeros(len(values[0]), dtype=np.int64)
+        for name, v in zip(names, values):
+            low, radix = self._digit(name)
+            key = key * radix + (v - low)
+        return key
+
+    def build_index(self):
+        '''Writes every index of INDEXES, called by query when rows were appended since the last build.'''
+        cols = self.columns()
+        epoch_rank = np.searchsorted(self.epochs(), cols['epoch'])
+        # Labels are not bounded by numOut (raw counts of inference inputs), the digits span the stored values
+        self.meta['digits'] = {}
+        for k in ('label', 'pred', 'abs_error'):
+            low, high = int(np.min(cols[k])), int(np.max(cols[k]))
+            self.meta['digits'][k] = [low, high - low + 1]
+        for name, keys in INDEXES.items():
+            span = np.prod([float(self._digit(k)[1]) for k in keys])
+            if span >= 2 ** 63:
+                raise ValueError('Values of the {} index keys {} do not fit in int64'.format(name, keys))
+            values = [epoch_rank if k == 'epoch' else np.asarray(cols[k]) for k in keys]
+            packed = self._keys(keys, values)
+            order = np.argsort(packed, kind='stable')
+            np.save(self._file('index_{}.order.npy'.format(name)), order)
+            np.save(self._file('index_{}.key.npy'.format(name)), packed[order])
+        self.meta['indexed'] = len(self)
+        self._write_meta()
+        self._indexes = {}
+
+    def _index(self, name):
+        if self.meta['indexed'] != len(self) or 'digits' not in self.meta:
+            self.build_index()
+        if name not in self._indexes:
+            self._indexes[name] = (np.load(self._file('index_{}.order.npy'.format(name)), mmap_mode='r'),
+                                   np.load(self._file('index_{}.key.npy'.format(name)), mmap_mode='r'))
+        return self._indexes[name]
+
+    def query(self, label=None, pred=None, error=None, epoch='last'):
+        '''
+        Rows matching every condition. A condition is a value or an inclusive (low, high) range, None for an
+        open bound.
+
+        :param error: Bound on |pred - label|
+        :param epoch: Epoch or checkpoint, the latest if 'last', all if None
+        :return: Sorted row numbers
+        '''
+        epochs = self.epochs()
+        if epoch == 'last':
+            epoch = int(epochs[-1])
+        if epoch is None and len(epochs) > 1:
+            # One indexed range per epoch
+            return np.sort(np.concatenate([self.query(label, pred, error, int(e)) for e in epochs]))
+        conditions = {'label': label, 'pred': pred, 'abs_error': error}
+        if epoch is not None:
+            pos = int(np.searchsorted(epochs, epoch))
+            if pos == len(epochs) or epochs[pos] != epoch:
+                return np.zeros(0, dtype=np.int64)
+            conditions['epoch'] = pos
+
+        # The index whose leading columns are fixed by the most conditions
+        def prefix(keys):
+            n = 0
+            for k in keys:
+                if conditions.get(k) is None:
+                    break
+                n += 1
+                if isinstance(conditions[k], tuple):
+                    break
+            return n
+        name = max(INDEXES, key=lambda x: prefix(INDEXES[x]))
+        keys = INDEXES[name]
+        order, packed = self._index(name)
+
+        # Key range of the leading conditions, the digits after the first open one span their whole range
+        low = high = 0
+        used = []
+        bounded = True
+        for k in keys:
+            offset, radix = self._digit(k)
+            c = conditions.get(k)
+            if bounded and c is not None:
+                lo, hi = c if isinstance(c, tuple) else (c, c)
+                lo = 0 if lo is None else min(max(lo - offset, 0), radix)
+                hi = radix - 1 if hi is None else max(min(hi - offset, radix - 1), -1)
+                used.append(k)
+                bounded = not isinstance(c, tuple)
+            else:
+                lo, hi = 0, radix - 1
+                bounded = False
+            low = low * radix + lo
+            high = high * radix + hi
+        begin, end = np.searchsorted(packed, [low, high + 1])
+        rows = np.sort(np.asarray(order[begin:end]))
+
+        # Conditions not covered by the key range
+        cols = self.columns()
+        for k, c in conditions.items():
+            if c is None or k in used or k == 'epoch':
+                continue
+            values = np.asarray(cols[k][rows])
+            lo, hi = c if isinstance(c, tuple) else (c, c)
+            mask = np.ones(len(rows), dtype=bool)
+            if lo is not None:
+                mask &= values >= lo
+            if hi is not None:
+                mask &= values <= hi
+            rows = rows[mask]
+        if epoch is not None and 'epoch' not in used:
+            rows = rows[np.asarray(cols['epoch'][rows]) == epoch]
+        return rows
+
+    def get(self, rows):
+        '''Column values of rows as a dictionary of arrays, image ids decoded to str.'''
+        cols = self.columns()
+        result = {name: np.asarray(cols[name][rows]) for name in ('label', 'pred', 'epoch', 'probs')}
+        result['image_id'] = np.asarray([s.decode('utf-8') for s in cols['image_id'][rows]])
+        if 'path' in cols:
+            result['path'] = np.asarray([s.decode('utf-8') for s in cols['path'][rows]])
+        return result
+
+    def thumbnails(self, rows, size=128, images_dir=None):
+        '''
+        Thumbnail paths of rows, made on first use (draft decode, size on the longest side) into <store>/thumbs.
+
+        :return: List of paths, None for the images that cannot be read
+        '''
+        images_dir = images_dir if images_dir is not None else self.meta['images_dir']
+        values = self.get(rows)
+        if 'path' in values:
+            sources = values['path']
+        elif images_dir is not None:
+            sources = [os.path.join(images_dir, image_id + self.meta['ext']) for image_id in values['image_id']]
+        else:
+            raise ValueError('images_dir is needed for thumbnails of a store without paths')
+        thumb_dir = self._file('thumbs_{}'.format(size))
+        if not os.path.exists(thumb_dir):
+            os.makedirs(thumb_dir)
+        paths = []
+        for image_id, source in zip(values['image_id'], sources):
+            thumb = os.path.join(thumb_dir, image_id + '.jpg')
+            if not os.path.exists(thumb):
+                try:
+                    im = open_draft(source, size)
+                    im.thumbnail((size, size), Image.BILINEAR)
+                    im.save(thumb + '.tmp', 'JPEG', quality=85)
+                    os.replace(thumb + '.tmp', thumb)
+                except (IOError, OSError):
+                    thumb = None
+            paths.append(thumb)
+        return paths
+
+    def contact_sheet(self, rows, size=128, ncols=8, images_dir=None):
+        '''The thumbnails of rows in one image, ncols per line, with label -> pred in the corner.'''
+        from PIL import ImageDraw
+
+        values = self.get(rows)
+        thumbs = self.thumbnails(rows, size, images_dir)
+        nrows = int(np.ceil(len(thumbs) / float(ncols)))
+        sheet = Image.new('RGB', (ncols * size, max(nrows, 1) * size), (255, 255, 255))
+        draw = ImageDraw.Draw(sheet)
+        for k, thumb in enumerate(thumbs):
+            x, y = (k % ncols) * size, (k // ncols) * size
+            if thumb is not None:
+                sheet.paste(Image.open(thumb), (x, y))
+            draw.text((x + 2, y + 2), '{} -> {}'.format(values['label'][k], values['pred'][k]), fill=(255, 0, 0))
+        return sheet
+
+
+def from_inference(out_dir, store_path, epoch=0, images_dir=None):
+    '''Store of the output directory of inference.predict.'''
+    from functions.inference import load_predictions
+
+    columns, meta = load_predictions(out_dir)
+    store = PredictionStore(store_path, meta['numOut'], images_dir)
+    store.append(columns['image_id'], columns['label'], columns['count'], columns['probs'], epoch,
+                 paths=columns['path'])
+    return store
+
+
+def from_table(table, name, algo, image_ids, store_path, epoch=0, images_dir=None):
+    '''
+    Store of one model of an evaluation.PredictionTable, with the probabilities of the algo's strategy.
+
+    :param image_ids: Image id of every table row
+    '''
+    import torch
+    from functions.losses import make_decoder
+
+    seen = np.flatnonzero(table.column(name) >= 0)
+    outputs = np.asarray(table.model_outputs(name)[seen])
+    width = int(np.sum(~np.isnan(outputs[0]))) if len(seen) else table.numOut
+    decoder = make_decoder(algo, table.numOut, torch.device('cpu'))
+    probs = decoder.probs(torch.from_numpy(np.ascontiguousarray(outputs[:, :width]))).numpy()
+    store = PredictionStore(store_path, table.numOut, images_dir)
+    store.append(np.asarray(image_ids)[seen], table.label[seen], table.column(name)[seen], probs, epoch)
+    return store
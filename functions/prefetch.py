@@ -0,0 +1,102 @@
+from __future__ import print_function, division
+
+import torch
+import time
+from collections import deque
+
+
+class Prefetcher(object):
+    '''
+    Iterates a DataLoader with the next batches already on their way to the device.
+
+    Up to depth batches are staged ahead of the one being trained on. On a GPU their host-to-device copies
+    are issued non-blocking from pinned memory on a side stream, and the training stream only waits on the
+    copy of the batch it takes, so the copies overlap with the forward and backward passes. On the CPU the
+    batches are only staged.
+
+    wait_time is the time the loop spent blocked on the loader in the last pass (seconds), batches the
+    number of batches of that pass; a large wait_time / epoch time means the run is input-bound. copy_time
+    is the time spent staging batches on the device, last_copy_time the part of it spent while the last
+    batch was being taken (the h2d stage of train_model's timing).
+
+    :param loader: DataLoader (pin_memory=True avoids a pinning copy here)
+    :param device: Training device
+    :param depth: Number of batches staged ahead, at least 1
+    :param sync: Wait for every copy to finish, so that copy_time is the transfer time rather than the time
+    to issue it (for timing only, the copies no longer overlap with the computation)
+    '''
+
+    def __init__(self, loader, device, depth=2, sync=False):
+        self.loader = loader
+        self.device = torch.device(device)
+        self.depth = max(1, int(depth))
+        self.sync = sync
+        self.wait_time = 0.
+        self.copy_time = 0.
+        self.last_copy_time = 0.
+        self.batches = 0
+        self._stream = None
+
+    def __len__(self):
+        return len(self.loader)
+
+    def _copy(self, x):
+        if not torch.is_tensor(x):
+            return x
+        if not x.is_pinned():
+            x = x.pin_memory()
+        return x.to(self.device, non_blocking=True)
+
+    def __iter__(self):
+        self.wait_time = 0.
+        self.copy_time = 0.
+        self.last_copy_time = 0.
+        self.batches = 0
+        pending = [0.]
+        cuda = self.device.type == 'cuda'
+        if cuda and self._stream is None:
+            self._stream = torch.cuda.Stream(self.device)
+        it = iter(self.loader)
+        staged = deque()
+
+        def stage():
+            since = time.time()
+            try:
+                batch = next(it)
+            except StopIteration:
+                return False
+            finally:
+                self.wait_time += time.time() - since
+            since = time.perf_counter()
+            if cuda:
+                with torch.cuda.stream(self._stream):
+                    batch = tuple(self._copy(x) for x in batch)
+                    ready = torch.cuda.Event()
+                    ready.record(self._stream)
+                if self.sync:
+                    ready.synchronize()
+            else:
+                batch = tuple(x.to(self.device) if torch.is_tensor(x) else x for x in batch)
+                ready = None
+            pending[0] += time.perf_counter() - since
+            staged.append((batch, ready))
+            return True
+
+        for k in range(self.depth):
+            if not stage():
+                break
+        while staged:
+            batch, ready = staged.popleft()
+            if ready is not None:
+                current = torch.cuda.current_stream(self.device)
+                current.wait_event(ready)
+                # The batch was allocated on the side stream, keep its memory until the training stream is done
+                for x in batch:
+                    if torch.is_tensor(x):
+                        x.record_stream(current)
+            stage()
+            self.batches += 1
+            self.copy_time += pending[0]
+            self.last_copy_time = pending[0]
+            pending[0] = 0.
+            yield batch
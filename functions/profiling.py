@@ -0,0 +1,116 @@
+from __future__ import print_function, division
+
+import torch
+import numpy as np
+import json
+import time
+
+'''
+Per-stage wall time of the training loop.
+
+train_model(timing=True) marks the end of every stage of a step with a StageTimer and writes per-epoch
+percentiles of every stage to the writer ('<phase> time <stage> p50', milliseconds) and as one JSON line per
+(epoch, phase) to a TimingLog. On a GPU the timer synchronizes the device at every mark so that the time of
+the asynchronous kernels is attributed to the stage that launched them; this slows training down and is why
+the timing is opt-in.
+'''
+
+STAGES = ['data', 'h2d', 'augment', 'forward', 'loss', 'backward', 'optimizer', 'metrics', 'log']
+PERCENTILES = [50, 90, 99]
+
+
+class StageTimer(object):
+    '''
+    Wall time per stage, one sample per step.
+
+    start() sets the reference point, every mark(stage) records the time since the previous mark. Parts of
+    that interval measured elsewhere (e.g. the host-to-device copies made by the Prefetcher while the loader
+    is waited on) are given as stage=seconds, recorded under their own stage and taken out of stage's time.
+
+    :param device: Training device, marks synchronize it if it is a GPU
+    '''
+
+    def __init__(self, device=None):
+        self.sync = device is not None and torch.device(device).type == 'cuda'
+        self.times = {stage: [] for stage in STAGES}
+        self._last = None
+
+    def _now(self):
+        if self.sync:
+            torch.cuda.synchronize()
+        return time.perf_counter()
+
+    def start(self):
+        self._last = self._now()
+
+    def mark(self, stage, **parts):
+        now = self._now()
+        elapsed = now - self._last
+        for name, seconds in parts.items():
+            self.times.setdefault(name, []).append(seconds)
+            elapsed -= seconds
+        self.times.setdefault(stage, []).append(max(elapsed, 0.))
+        self._last = now
+
+    def reset(self):
+        self.times = {stage: [] for stage in STAGES}
+
+    def summary(self, percentiles=PERCENTILES):
+        '''Per stage count, total (s), mean and percentiles (ms) of the recorded samples.'''
+        result = {}
+        for stage, samples in self.times.items():
+            if not samples:
+                continue
+            ms = 1000. * np.asarray(samples)
+            stats = {'count': len(samples), 'total': float(ms.sum()) / 1000., 'mean': float(ms.mean())}
+            for p, value in zip(percentiles, np.percentile(ms, percentiles)):
+                stats['p{}'.format(p)] = float(value)
+            result[stage] = stats
+        return result
+
+    def write(self, writer, phase, epoch, percentiles=PERCENTILES):
+        summary = self.summary(percentiles)
+        for stage in summary:
+            for p in percentiles:
+                writer.add_scalar('{} time {} p{}'.format(phase, stage, p), summary[stage]['p{}'.format(p)], epoch)
+        return summary
+
+
+class NullTimer(object):
+    '''StageTimer interface that records nothing, used when timing is off.'''
+
+    def start(self):
+        pass
+
+    def mark(self, stage, **parts):
+        pass
+
+    def reset(self):
+        pass
+
+    def write(self, writer, phase, epoch, percentiles=PERCENTILES):
+        return {}
+
+
+class TimingLog(object):
+    '''JSON lines file of stage summaries, one line per (run, epoch, phase).'''
+
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, 'a')
+
+    def log(self, run, epoch, phase, summary):
+        if not summary:
+            return
+        self._file.write(json.dumps({'run': run, 'epoch': epoch, 'phase': phase, 'stages': summary},
+                                    sort_keys=True) + '\n')
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+def read_timing(path):
+    '''Records of a TimingLog file.'''
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
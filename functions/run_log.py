@@ -0,0 +1,168 @@
+from __future__ import print_function, division
+
+import os
+import csv
+import threading
+import time
+import numpy as np
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+'''
+Buffered run log of train_model.
+
+Epoch metrics are appended as CSV rows keyed by run and epoch. Rows are queued by the training loop and
+written by a background thread, so logging never blocks a phase on file I/O. export_excel builds the
+column layout train_model used to write into logs.xlsx once, at the end of a run or a sweep.
+'''
+
+FIELDS = ('run', 'epoch', 'phase', 'loss', 'acc', 'cir1', 'rmse', 'mae', 'time')
+METRICS = ('loss', 'acc', 'cir1', 'rmse', 'mae')
+
+
+def make_run_id(since=None):
+    '''Run key from a start time, unique up to the millisecond.'''
+    if since is None:
+        since = time.time()
+    return time.strftime('%Y-%m-%d_%H-%M-%S', time.localtime(since)) + '_{:03d}'.format(int(since * 1000) % 1000)
+
+
+class NullWriter(object):
+    '''Writer that drops every scalar, for processes that do not log (e.g. ranks other than 0).'''
+
+    def add_scalar(self, *args, **kwargs):
+        pass
+
+
+class RunLog(object):
+    '''
+    Append-only CSV sink of epoch metrics, written asynchronously.
+
+    :param path: CSV file, the header is written if the file is new
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        new_file = not os.path.exists(path) or os.path.getsize(path) == 0
+        self._file = open(path, 'a')
+        self._writer = csv.writer(self._file)
+        if new_file:
+            self._writer.writerow(FIELDS)
+            self._file.flush()
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            row = self._queue.get()
+            if row is None:
+                self._file.flush()
+                self._queue.task_done()
+                break
+            self._writer.writerow(row)
+            if self._queue.empty():
+                self._file.flush()
+            self._queue.task_done()
+
+    def log(self, run, epoch, phase, metrics):
+        '''
+        Queues one row.
+
+        :param metrics: Dictionary with loss, acc, cir1, rmse and mae
+        '''
+        self._queue.put([run, epoch, phase] + [float(metrics[name]) for name in METRICS] + [time.time()])
+
+    def flush(self):
+        '''Blocks until every queued row is written.'''
+        self._queue.join()
+
+    def close(self):
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
+        self._file.close()
+
+
+def read_log(path):
+    '''
+    Reads a run log.
+
+    :return: Dictionary run -> {phase -> {metric -> array over epochs}, 'epoch' -> array}, runs in file order
+    '''
+    runs = {}
+    with open(path) as f:
+        for row in csv.DictReader(f):
+            run = runs.setdefault(row['run'], {})
+            phase = run.setdefault(row['phase'], {'epoch': []})
+            phase['epoch'].append(int(row['epoch']))
+            for name in METRICS:
+                phase.setdefault(name, []).append(float(row[name]))
+    for run in runs.values():
+        for phase in run.values():
+            for name in phase:
+                phase[name] = np.asarray(phase[name])
+    return runs
+
+
+def excel_values(run, iter_loc):
+    '''
+    Cells of one run in the logs.xlsx layout of train_model.
+
+    Columns iter_loc .. iter_loc + 10 hold the epoch with the best (lowest) val RMSE, iter_loc + 11 ..
+    iter_loc + 19 hold the last epoch.
+
+    :return: Dictionary column -> value
+    '''
+    tr, val = run['train'], run['val']
+    n = min(len(tr['epoch']), len(val['epoch']))
+    cells = {}
+    if n == 0:
+        return cells
+    last = n - 1
+    cells[iter_loc + 11] = int(val['epoch'][last]) + 1
+    for k, name in enumerate(('acc', 'rmse', 'mae', 'cir1')):
+        cells[iter_loc + 12 + 2 * k] = float(tr[name][last])
+        cells[iter_loc + 13 + 2 * k] = float(val[name][last])
+
+    rmse = val['rmse'][:n]
+    if np.min(rmse) < 100.0:
+        best = int(np.argmin(rmse))
+        cells[iter_loc] = int(val['epoch'][best]) + 1
+        for k, name in enumerate(('loss', 'acc', 'rmse', 'mae', 'cir1')):
+            cells[iter_loc + 1 + 2 * k] = float(tr[name][best])
+            cells[iter_loc + 2 + 2 * k] = float(val[name][best])
+    return cells
+
+
+def export_excel(log_path, logname, iter_loc, runs=None, rows=None):
+    '''
+    Writes the runs of a run log into an existing workbook with a single load and save.
+
+    :param log_path: CSV run log
+    :param logname: Workbook, e.g. ../results/logs.xlsx
+    :param iter_loc: First result column, as passed to train_model
+    :param runs: Runs to export, all runs of the log if None
+    :param rows: Dictionary run -> sheet row. If None the runs go to the last len(runs) rows of the sheet
+    in order, which are the rows appended by writeLog_xlsx before every run of a sweep.
+    '''
+    import openpyxl
+
+    log = read_log(log_path)
+    if runs is None:
+        runs = list(log.keys())
+    book = openpyxl.load_workbook(logname)
+    sheet = book.active
+    if rows is None:
+        first = sheet.max_row - len(runs) + 1
+        rows = {run: first + k for k, run in enumerate(runs)}
+    for run in runs:
+        if run not in log:
+            continue
+        for column, value in excel_values(log[run], iter_loc).items():
+            sheet.cell(row=rows[run], column=column).value = value
+    book.save(logname)
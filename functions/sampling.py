@@ -0,0 +1,156 @@
+from __future__ import print_function, division
+
+import torch
+import numpy as np
+
+'''
+Vectorized class-balanced sampling.
+
+The balanced weights of make_weights_for_balanced_classes (N / count of the image's class) give every
+non-empty class the same probability, and every image of a class the same probability within it. Instead of
+a multinomial over all images, BalancedSampler draws a class uniformly and then an image from that class's
+index stream, in vectorized chunks of a few hundred samples, so an epoch costs O(batch) per step and no
+per-image Python lists are built.
+'''
+
+
+def dataset_labels(dset):
+    '''Labels of an ImageFolder style dataset (imgs list of (path, label)) as an int64 array.'''
+    return np.fromiter((item[1] for item in dset.imgs), dtype=np.int64, count=len(dset.imgs))
+
+
+def balanced_weights(labels, nclasses):
+    '''
+    Balanced sampling weights, np.bincount version of make_weights_for_balanced_classes.
+
+    :return: weight (per image), weight_per_class (0 for empty classes)
+    '''
+    labels = np.asarray(labels, dtype=np.int64)
+    count = np.bincount(labels, minlength=nclasses).astype(np.float64)
+    weight_per_class = np.zeros(nclasses)
+    weight_per_class[count > 0] = len(labels) / count[count > 0]
+    return weight_per_class[labels], weight_per_class
+
+
+class _ClassStreams(object):
+    '''Per-class permutations consumed in order and reshuffled when exhausted (sampling without replacement).'''
+
+    def __init__(self, members):
+        self.members = members
+        self.perm = [None] * len(members)
+        self.pos = [0] * len(members)
+
+    def take(self, rng, c, n):
+        out = []
+        while n > 0:
+            if self.perm[c] is None or self.pos[c] == len(self.perm[c]):
+                self.perm[c] = rng.permutation(self.members[c])
+                self.pos[c] = 0
+            k = min(n, len(self.perm[c]) - self.pos[c])
+            out.append(self.perm[c][self.pos[c]:self.pos[c] + k])
+            self.pos[c] += k
+            n -= k
+        return np.concatenate(out)
+
+
+class BalancedSampler(torch.utils.data.Sampler):
+    '''
+    Class-balanced sampler, the distribution of the WeightedRandomSampler of load_data.
+
+    :param labels: Label of every image
+    :param num_samples: Samples per epoch over all ranks, the number of images if None
+    :param replacement: Images drawn with replacement within their class. Without replacement every class is
+    a reshuffled stream, an image is seen again only after all images of its class.
+    :param seed: Base seed, the epoch's draws use seed + epoch (set_epoch). If None, every epoch draws its
+    seed from the torch RNG, as WeightedRandomSampler does.
+    :param rank, world_size: Partition of the epoch across processes. Every rank generates the same stream
+    and takes every world_size-th sample from rank on, so the ranks never share a draw and take
+    num_samples // world_size samples each. A seed is required with world_size > 1.
+    :param chunk: Samples of the stream drawn per vectorized step, the stream does not depend on world_size
+    '''
+
+    def __init__(self, labels, num_samples=None, replacement=True, seed=None, rank=0, world_size=1, chunk=1024):
+        if world_size > 1 and seed is None:
+            raise ValueError('A seed shared by the ranks is needed to partition the sampler')
+        self.labels = np.asarray(labels, dtype=np.int64)
+        self.num_samples = len(self.labels) if num_samples is None else num_samples
+        self.replacement = replacement
+        self.seed = seed
+        self.rank = rank
+        self.world_size = world_size
+        self.chunk = chunk
+        self.epoch = 0
+
+        # Image indices grouped by class
+        nclasses = int(self.labels.max()) + 1 if len(self.labels) else 0
+        self.counts = np.bincount(self.labels, minlength=nclasses)
+        self.by_class = np.argsort(self.labels, kind='stable')
+        self.starts = np.concatenate([[0], np.cumsum(self.counts)[:-1]]).astype(np.int64)
+        self.present = np.nonzero(self.counts)[0]
+
+        self._epoch_seed = None
+        self._start = 0
+        self._replay = False
+
+    def partition(self, rank, world_size):
+        '''The same sampler for one rank of world_size processes.'''
+        return BalancedSampler(self.labels, self.num_samples, self.replacement, self.seed, rank, world_size,
+                               self.chunk)
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __len__(self):
+        return self.num_samples // self.world_size
+
+    def _draw(self, rng, streams, n):
+        cls = self.present[rng.randint(len(self.present), size=n)]
+        if self.replacement:
+            offsets = (rng.random_sample(n) * self.counts[cls]).astype(np.int64)
+            return self.by_class[self.starts[cls] + offsets]
+        out = np.empty(n, dtype=np.int64)
+        for c in np.unique(cls):
+            mask = cls == c
+            out[mask] = streams.take(rng, c, int(mask.sum()))
+        return out
+
+    def __iter__(self):
+        if not self._replay:
+            if self.seed is None:
+                self._epoch_seed = int(torch.empty((), dtype=torch.int64).random_(2 ** 31 - 1).item())
+            else:
+                self._epoch_seed = self.seed + self.epoch
+            self._start = 0
+        self._replay = False
+        return self._generate(self._epoch_seed, self._start)
+
+    def _generate(self, seed, start):
+        rng = np.random.RandomState(seed)
+        members = [self.by_class[self.starts[c]:self.starts[c] + self.counts[c]] for c in range(len(self.counts))]
+        streams = _ClassStreams(members)
+        # Global slot g of the stream belongs to rank g % world_size
+        total = len(self) * self.world_size
+        skip = start * self.world_size
+        produced = 0
+        while produced < total:
+            # Full chunks keep the stream independent of the epoch length
+            n = min(self.chunk, total - produced)
+            idx = self._draw(rng, streams, self.chunk)[:n]
+            if produced + n > skip:
+                first = max(produced, skip)
+                first += (self.rank - first) % self.world_size
+                for i in idx[first - produced::self.world_size].tolist():
+                    yield i
+            produced += n
+
+    def state_dict(self, position):
+        '''
+        :param position: Number of samples of the current epoch already consumed by this rank
+        '''
+        return {'epoch': self.epoch, 'seed': self._epoch_seed, 'position': int(position)}
+
+    def load_state_dict(self, state):
+        self.epoch = state['epoch']
+        self._epoch_seed = state['seed']
+        self._start = state['position']
+        self._replay = True
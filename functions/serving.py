@@ -0,0 +1,336 @@
+from __future__ import print_function, division
+
+import torch
+import numpy as np
+import io
+import json
+import threading
+import time
+from collections import deque
+from PIL import Image
+
+try:
+    import queue
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+except ImportError:
+    import Queue as queue
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+
+from functions.augment import BatchAugment, uint8_transform
+from functions.decode import open_draft
+from functions.inference import count_classes, inference_mode, load_model
+from functions.losses import make_decoder
+from functions.profiling import PERCENTILES
+
+'''
+Local HTTP counting server with dynamic batching.
+
+Request threads decode the posted images and queue them. A single batcher thread takes the oldest request,
+waits at most max_wait_ms after its arrival for more requests, up to max_batch_size, and runs one batched
+forward pass; the outputs are decoded with the strategy of the algo the model was trained with, as
+train_model does. Endpoints:
+    POST /count     raw image bytes, answers {"count", "probs", "latency_ms"}
+    GET  /stats     counters, throughput and latency percentiles as JSON
+    GET  /metrics   the same as Prometheus text (histograms with cumulative buckets)
+    GET  /health
+
+  python -m functions.serving model_best.pt --algo cheng --port 8080 --max-batch-size 32 --max-wait-ms 5
+  python -m benchmarks.loadgen http://127.0.0.1:8080 /data/abid/images --concurrency 16 --requests 2000
+'''
+
+# Upper bounds (ms) of the latency histogram buckets, the last bucket is unbounded
+LATENCY_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+
+
+class Histogram(object):
+    '''
+    Thread-safe latency histogram with fixed buckets, and a window of the most recent samples for exact
+    percentiles.
+    '''
+
+    def __init__(self, buckets=LATENCY_BUCKETS, window=10000):
+        self.buckets = np.asarray(buckets, dtype=np.float64)
+        self.counts = np.zeros(len(buckets) + 1, dtype=np.int64)
+        self.total = 0.
+        self.recent = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        with self._lock:
+            self.counts[np.searchsorted(self.buckets, value)] += 1
+            self.total += value
+            self.recent.append(value)
+
+    def summary(self, percentiles=PERCENTILES):
+        with self._lock:
+            count = int(self.counts.sum())
+            result = {'count': count, 'mean': self.total / max(count, 1)}
+            recent = np.asarray(self.recent)
+        for p in percentiles:
+            result['p{}'.format(p)] = float(np.percentile(recent, p)) if len(recent) else 0.
+        return result
+
+    def prometheus(self, name):
+        with self._lock:
+            cumulative = np.cumsum(self.counts)
+            total = self.total
+        lines = ['# TYPE {} histogram'.format(name)]
+        for bound, count in zip(self.buckets, cumulative):
+            lines.append('{}_bucket{{le="{:g}"}} {}'.format(name, bound, count))
+        lines.append('{}_bucket{{le="+Inf"}} {}'.format(name, cumulative[-1]))
+        lines.append('{}_sum {}'.format(name, total))
+        lines.append('{}_count {}'.format(name, cumulative[-1]))
+        return lines
+
+
+class ServerStats(object):
+    '''
+    Counters and histograms of the server.
+
+    Latencies (ms): request (arrival to answer), decode (image bytes to array), queue (arrival to the start
+    of its batch) and batch (forward pass and decoding of a batch). batch_size is a histogram of the batch
+    sizes.
+    '''
+
+    HISTOGRAMS = ('request', 'decode', 'queue', 'batch')
+
+    def __init__(self, max_batch_size):
+        self.histograms = {name: Histogram() for name in self.HISTOGRAMS}
+        self.batch_size = Histogram(buckets=np.arange(1, max_batch_size + 1))
+        self.counters = {'requests': 0, 'images': 0, 'batches': 0, 'errors': 0}
+        self.started = time.time()
+        self._lock = threading.Lock()
+
+    def count(self, name, n=1):
+        with self._lock:
+            self.counters[name] += n
+
+    def to_dict(self):
+        with self._lock:
+            counters = dict(self.counters)
+        uptime = time.time() - self.started
+        result = {'uptime_s': uptime, 'counters': counters,
+                  'throughput': {'images_per_s': counters['images'] / max(uptime, 1e-9),
+                                 'batches_per_s': counters['batches'] / max(uptime, 1e-9)},
+                  'batch_size': self.batch_size.summary()}
+        result['latency_ms'] = {name: h.summary() for name, h in self.histograms.items()}
+        return result
+
+    def prometheus(self):
+        with self._lock:
+            counters = dict(self.counters)
+        lines = []
+        for name, value in sorted(counters.items()):
+            lines.append('# TYPE counting_{}_total counter'.format(name))
+            lines.append('counting_{}_total {}'.format(name, value))
+        lines.append('# TYPE counting_uptime_seconds gauge')
+        lines.append('counting_uptime_seconds {}'.format(time.time() - self.started))
+        for name, h in self.histograms.items():
+            lines += h.prometheus('counting_{}_latency_ms'.format(name))
+        lines += self.batch_size.prometheus('counting_batch_size')
+        return '\n'.join(lines) + '\n'
+
+
+class _Pending(object):
+    def __init__(self, image):
+        self.image = image
+        self.arrival = time.perf_counter()
+        self.done = threading.Event()
+        self.count = None
+        self.probs = None
+        self.error = None
+
+
+class DynamicBatcher(object):
+    '''
+    Groups queued images into batches and runs them through the model on one thread.
+
+    :param model: Trained network in eval mode on device
+    :param algo: Algo the model was trained with
+    :param max_batch_size: Largest batch of a forward pass
+    :param max_wait_ms: Longest time the oldest queued image waits for the batch to fill
+    '''
+
+    def __init__(self, model, algo, numOut, device, max_batch_size=32, max_wait_ms=5., crop_size=224, stats=None):
+        self.model = model
+        self.decoder = make_decoder(algo, numOut, device)
+        self.device = device
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.
+        self.augment = BatchAugment(crop_size, random_crop=False, flip=False)
+        self.stats = stats if stats is not None else ServerStats(max_batch_size)
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def submit(self, image):
+        '''Queues a uint8 HxWx3 array, the returned request's done event is set once it is counted.'''
+        pending = _Pending(image)
+        self._queue.put(pending)
+        return pending
+
+    def _next_batch(self):
+        first = self._queue.get()
+        if first is None:
+            return None
+        batch = [first]
+        deadline = first.arrival + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.perf_counter()
+            try:
+                item = self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is None:
+                self._queue.put(None)
+                break
+            batch.append(item)
+        return batch
+
+    def _forward(self, batch):
+        inputs = torch.from_numpy(np.stack([item.image for item in batch]))
+        with inference_mode():
+            outputs = self.model(self.augment(inputs.to(self.device)))
+            counts = self.decoder.decode(outputs).cpu().numpy()
+            probs = self.decoder.probs(outputs).float().cpu().numpy()
+        return counts, probs
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                break
+            start = time.perf_counter()
+            for item in batch:
+                self.stats.histograms['queue'].observe(1000. * (start - item.arrival))
+            try:
+                counts, probs = self._forward(batch)
+                for item, count, p in zip(batch, counts, probs):
+                    item.count = int(count)
+                    item.probs = p.tolist()
+            except Exception as e:
+                for item in batch:
+                    item.error = repr(e)
+                self.stats.count('errors', len(batch))
+            self.stats.histograms['batch'].observe(1000. * (time.perf_counter() - start))
+            self.stats.batch_size.observe(len(batch))
+            self.stats.count('batches')
+            self.stats.count('images', len(batch))
+            for item in batch:
+                item.done.set()
+
+    def close(self):
+        self._queue.put(None)
+        self._thread.join()
+
+
+def decode_image(data, size=256, fast_decode=False):
+    '''Image bytes to the size x size uint8 array of the val transform before its center crop.'''
+    f = io.BytesIO(data)
+    im = open_draft(f, size) if fast_decode else Image.open(f).convert('RGB')
+    return uint8_transform(size)(im).numpy()
+
+
+class _ThreadingServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def make_handler(batcher, size=256, fast_decode=False, timeout=30.):
+    stats = batcher.stats
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, format, *args):
+            pass
+
+        def _send(self, code, body, content_type='application/json'):
+            if not isinstance(body, bytes):
+                body = body.encode('utf-8')
+            self.send_response(code)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path == '/stats':
+                self._send(200, json.dumps(stats.to_dict()))
+            elif self.path == '/metrics':
+                self._send(200, stats.prometheus(), 'text/plain; version=0.0.4')
+            elif self.path == '/health':
+                self._send(200, json.dumps({'status': 'ok'}))
+            else:
+                self._send(404, json.dumps({'error': 'not found'}))
+
+        def do_POST(self):
+            if self.path != '/count':
+                self._send(404, json.dumps({'error': 'not found'}))
+                return
+            arrival = time.perf_counter()
+            stats.count('requests')
+            data = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            try:
+                image = decode_image(data, size, fast_decode)
+            except (IOError, OSError, ValueError) as e:
+                stats.count('errors')
+                self._send(400, json.dumps({'error': 'cannot decode image: {}'.format(e)}))
+                return
+            stats.histograms['decode'].observe(1000. * (time.perf_counter() - arrival))
+            pending = batcher.submit(image)
+            if not pending.done.wait(timeout):
+                stats.count('errors')
+                self._send(503, json.dumps({'error': 'timed out'}))
+                return
+            if pending.error is not None:
+                self._send(500, json.dumps({'error': pending.error}))
+                return
+            latency = 1000. * (time.perf_counter() - arrival)
+            stats.histograms['request'].observe(latency)
+            self._send(200, json.dumps({'count': pending.count, 'probs': pending.probs, 'latency_ms': latency}))
+
+    return Handler
+
+
+def serve(model, algo, numOut, device, host='127.0.0.1', port=8080, max_batch_size=32, max_wait_ms=5.,
+          size=256, crop_size=224, fast_decode=False):
+    '''Runs the server until interrupted.'''
+    batcher = DynamicBatcher(model, algo, numOut, device, max_batch_size, max_wait_ms, crop_size)
+    server = _ThreadingServer((host, port), make_handler(batcher, size, fast_decode))
+    print('Counting with {} on {}, listening on http://{}:{}'.format(algo, device, host, port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        batcher.close()
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Local dynamic-batching counting server')
+    parser.add_argument('model', help='Model saved with torch.save(model, path) or a train_model checkpoint')
+    parser.add_argument('--algo', default=None, help='Algo the model was trained with, read from checkpoints')
+    parser.add_argument('--num-out', type=int, default=None, help='numOut the model was trained with')
+    parser.add_argument('--arch', default='resnet18', help='torchvision architecture of a checkpoint')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--max-batch-size', type=int, default=32)
+    parser.add_argument('--max-wait-ms', type=float, default=5.)
+    parser.add_argument('--fast-decode', action='store_true', help='Decode JPEGs at reduced resolution')
+    parser.add_argument('--cpu', action='store_true', help='Run on the CPU even if a GPU is available')
+    args = parser.parse_args()
+
+    device = torch.device('cuda:0' if torch.cuda.is_available() and not args.cpu else 'cpu')
+    model, algo = load_model(args.model, device, args.arch, args.num_out)
+    algo = args.algo if args.algo is not None else algo
+    if algo is None:
+        parser.error('--algo is needed for a whole model file')
+    numOut = args.num_out if args.num_out is not None else count_classes(model)
+    serve(model, algo, numOut, device, args.host, args.port, args.max_batch_size, args.max_wait_ms,
+          fast_decode=args.fast_decode)
@@ -0,0 +1,228 @@
+from __future__ import print_function, division
+
+import torch
+import numpy as np
+import os
+from multiprocessing import Pool
+from PIL import Image
+from torchvision import transforms
+from functions.decode import open_draft
+
+'''
+Packed image shards for ABID.
+
+Images are decoded and resized once, then written into fixed-size shard files of raw uint8
+records (shard_size x H x W x 3). As transforms.Resize(256) of the notebook the resize keeps the
+aspect ratio, and the record is its center H x W crop: the center crop of a record is the crop of the
+notebook's validation transform, random training crops range over the central H x W box (not over
+the full long side). An index.npz next to the shards holds the label, shard number and record offset
+of every image. ShardDataset reads the shards through np.memmap, so a sample is only copied when its
+crop is taken.
+
+Layout of a shard directory:
+    index.npz          labels, shard, offset, names, classes, imsize
+    shard_00000.u8     raw uint8 records
+    shard_00001.u8
+    ...
+'''
+
+IMG_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.ppm', '.bmp', '.tif', '.tiff')
+
+default_shard_transform = transforms.Compose([
+    transforms.ToTensor(),
+    transforms.Normalize([0.485, 0.456, 0.406], [0.229, 0.224, 0.225])])
+
+
+def shard_name(shard):
+    return 'shard_{:05d}.u8'.format(shard)
+
+
+def find_images(root_dir):
+    '''
+    Lists the images of an ImageFolder style directory (one sub folder per class).
+
+    :param root_dir: Directory with one sub folder per class
+
+    :return:
+    :paths: List of image paths
+    :labels: Class index of every image
+    :classes: Sorted class names
+    '''
+    classes = sorted(d for d in os.listdir(root_dir) if os.path.isdir(os.path.join(root_dir, d)))
+    paths = []
+    labels = []
+    for label, cls in enumerate(classes):
+        for fname in sorted(os.listdir(os.path.join(root_dir, cls))):
+            if fname.lower().endswith(IMG_EXTENSIONS):
+                paths.append(os.path.join(root_dir, cls, fname))
+                labels.append(label)
+    return paths, labels, classes
+
+
+def _load_resized(args):
+    path, imsize, fast_decode = args
+    if fast_decode:
+        im = open_draft(path, max(imsize))
+    else:
+        im = Image.open(path).convert('RGB')
+    # Smallest aspect preserving resize that covers imsize, then its center crop (Resize + CenterCrop)
+    h, w = imsize
+    if h * im.size[0] >= w * im.size[1]:
+        height, width = h, max(w, int(h * im.size[0] / float(im.size[1])))
+    else:
+        height, width = max(h, int(w * im.size[1] / float(im.size[0]))), w
+    im = im.resize((width, height), Image.BILINEAR)
+    top = int(round((height - h) / 2.))
+    left = int(round((width - w) / 2.))
+    im = im.crop((left, top, left + w, top + h))
+    return np.asarray(im, dtype=np.uint8)
+
+
+def write_shards(paths, labels, out_dir, classes=None, imsize=(256, 256), shard_size=4096, num_workers=12,
+                 fast_decode=False):
+    '''
+    Decodes, resizes and packs images into uint8 shards.
+
+    :param paths: Image paths
+    :param labels: Label of every image
+    :param out_dir: Output directory, created if it does not exist
+    :param classes: Class names stored in the index
+    :param imsize: (height, width) of the stored records, the center crop of an aspect preserving resize
+    (transforms.Resize(256) and CenterCrop(256) for the default)
+    :param shard_size: Number of records per shard
+    :param num_workers: Number of decoding processes
+    :param fast_decode: Decode JPEGs at reduced resolution (decode.open_draft)
+
+    :return: Number of images written
+    '''
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+    imsize = tuple(imsize)
+    record_shape = imsize + (3,)
+    n = len(paths)
+    labels = np.asarray(labels, dtype=np.int64)
+    shard_ids = np.arange(n, dtype=np.int32) // shard_size
+    offsets = np.arange(n, dtype=np.int32) % shard_size
+
+    pool = Pool(num_workers)
+    try:
+        for shard in range(int(np.ceil(n / float(shard_size)))):
+            begin = shard * shard_size
+            end = min(n, begin + shard_size)
+            mm = np.memmap(os.path.join(out_dir, shard_name(shard)), dtype=np.uint8, mode='w+',
+                           shape=(end - begin,) + record_shape)
+            jobs = [(paths[k], imsize, fast_decode) for k in range(begin, end)]
+            for k, im in enumerate(pool.imap(_load_resized, jobs, chunksize=16)):
+                mm[k] = im
+            mm.flush()
+            del mm
+            print('Shard {} written ({}/{} images)'.format(shard, end, n))
+    finally:
+        pool.close()
+        pool.join()
+
+    if classes is None:
+        classes = [str(c) for c in range(int(labels.max()) + 1)] if n > 0 else []
+    names = np.asarray([os.path.splitext(os.path.basename(p))[0] for p in paths])
+    np.savez(os.path.join(out_dir, 'index.npz'), labels=labels, shard=shard_ids, offset=offsets,
+             names=names, classes=np.asarray(classes), imsize=np.asarray(imsize),
+             shard_size=np.asarray(shard_size))
+    return n
+
+
+def folder_to_shards(root_dir, out_dir, phases=('train', 'val'), **kwargs):
+    '''
+    Converts an ImageFolder tree (root_dir/<phase>/<class>/<image>) into one shard directory per phase.
+    Extra keyword arguments are passed to write_shards.
+    '''
+    for phase in phases:
+        paths, labels, classes = find_images(os.path.join(root_dir, phase))
+        print('{}: {} images in {} classes'.format(phase, len(paths), len(classes)))
+        write_shards(paths, labels, os.path.join(out_dir, phase), classes=classes, **kwargs)
+
+
+class ShardDataset(torch.utils.data.Dataset):
+    '''
+    Dataset over a shard directory written by write_shards.
+
+    Records are memory mapped lazily in every worker. The crop (random or center) and the horizontal
+    flip are taken on the memory mapped view; only the cropped pixels are copied. The transform is then
+    applied to the cropped PIL image, so it should only hold the tensor conversion and normalization.
+    If transform is None the crop is returned as a HxWx3 uint8 tensor.
+    '''
+
+    def __init__(self, shard_dir, transform=default_shard_transform, crop_size=224, random_crop=False,
+                 flip=False):
+        index = np.load(os.path.join(shard_dir, 'index.npz'))
+        self.shard_dir = shard_dir
+        self.labels = index['labels']
+        self.shard = index['shard']
+        self.offset = index['offset']
+        self.names = index['names']
+        self.classes = index['classes'].tolist()
+        self.imsize = tuple(int(s) for s in index['imsize'])
+        self.shard_size = int(index['shard_size'])
+        self.imgs = list(zip(self.names.tolist(), self.labels.tolist()))
+        self.transform = transform
+        self.crop_size = crop_size
+        self.random_crop = random_crop
+        self.flip = flip
+        self._maps = {}
+
+    def __len__(self):
+        return len(self.labels)
+
+    def _shard(self, shard):
+        mm = self._maps.get(shard)
+        if mm is None:
+            path = os.path.join(self.shard_dir, shard_name(shard))
+            count = os.path.getsize(path) // (self.imsize[0] * self.imsize[1] * 3)
+            mm = np.memmap(path, dtype=np.uint8, mode='r', shape=(count,) + self.imsize + (3,))
+            self._maps[shard] = mm
+        return mm
+
+    def record(self, idx):
+        '''Returns the full memory mapped HxWx3 record of an image without copying it.'''
+        return self._shard(int(self.shard[idx]))[int(self.offset[idx])]
+
+    def __getitem__(self, idx):
+        im = self.record(idx)
+        if self.crop_size is not None:
+            h, w = self.imsize
+            if self.random_crop:
+                top = int(torch.randint(0, h - self.crop_size + 1, (1,)))
+                left = int(torch.randint(0, w - self.crop_size + 1, (1,)))
+            else:
+                top = (h - self.crop_size) // 2
+                left = (w - self.crop_size) // 2
+            im = im[top:top + self.crop_size, left:left + self.crop_size]
+        if self.flip and float(torch.rand(1)) < 0.5:
+            im = im[:, ::-1]
+        im = np.array(im)
+
+        if self.transform is not None:
+            im = self.transform(Image.fromarray(im))
+        else:
+            im = torch.from_numpy(im)
+        return im, int(self.labels[idx])
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_maps'] = {}
+        return state
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Pack an ImageFolder tree into memory mapped uint8 shards')
+    parser.add_argument('root_dir', help='Directory with train/ and val/ ImageFolder trees')
+    parser.add_argument('out_dir', help='Output directory, one shard directory per phase')
+    parser.add_argument('--phases', nargs='+', default=['train', 'val'])
+    parser.add_argument('--imsize', type=int, default=256)
+    parser.add_argument('--shard-size', type=int, default=4096)
+    parser.add_argument('--workers', type=int, default=12)
+    parser.add_argument('--fast-decode', action='store_true', help='Reduced resolution JPEG decode')
+    args = parser.parse_args()
+    folder_to_shards(args.root_dir, args.out_dir, phases=args.phases, imsize=(args.imsize, args.imsize),
+                     shard_size=args.shard_size, num_workers=args.workers, fast_decode=args.fast_decode)
@@ -0,0 +1,62 @@
+from __future__ import print_function, division
+
+import torch
+import copy
+from collections import OrderedDict
+
+
+class StateSnapshot(object):
+    '''
+    Handle to a copy of a model's state_dict held in preallocated CPU buffers.
+
+    capture copies the parameters and buffers into the same CPU tensors every time (non-blocking from the
+    GPU into pinned memory), so keeping the best model of a run costs one state copy per improvement instead
+    of a deepcopy of the whole module. The module is only rebuilt by materialize.
+    '''
+
+    def __init__(self, model, pin_memory=None):
+        if pin_memory is None:
+            pin_memory = torch.cuda.is_available()
+        self.buffers = OrderedDict()
+        for name, value in model.state_dict().items():
+            self.buffers[name] = torch.empty(value.size(), dtype=value.dtype, device='cpu',
+                                             pin_memory=pin_memory and value.is_cuda)
+        self.valid = False
+        self.epoch = None
+        self._pending = False
+
+    def capture(self, model, epoch=None):
+        for name, value in model.state_dict().items():
+            self.buffers[name].copy_(value.detach(), non_blocking=True)
+        self._pending = any(value.is_cuda for value in model.state_dict().values())
+        self.valid = True
+        self.epoch = epoch
+        return self
+
+    def load(self, state, epoch=None):
+        '''Copies a state_dict (e.g. of a checkpoint) into the buffers.'''
+        for name, value in state.items():
+            self.buffers[name].copy_(value)
+        self._pending = False
+        self.valid = True
+        self.epoch = epoch
+        return self
+
+    def state_dict(self):
+        '''The captured state, waits for pending device copies.'''
+        if self._pending:
+            torch.cuda.synchronize()
+            self._pending = False
+        return self.buffers
+
+    def restore(self, model):
+        '''Loads the captured state into model.'''
+        model.load_state_dict(self.state_dict())
+        return model
+
+    def materialize(self, model):
+        '''A new module with the structure of model and the captured state.'''
+        return self.restore(copy.deepcopy(model))
+
+    def save(self, path):
+        torch.save(self.state_dict(), path)
@@ -0,0 +1,155 @@
+from __future__ import print_function, division
+
+import torch
+import numpy as np
+
+'''
+Train/val/eyeball splits as index manifests.
+
+A manifest is a sorted int64 array of row numbers into a dataset (ImageFolder, ShardDataset, IndexDataset).
+Splits never copy files; loaders are built over torch.utils.data.Subset views of the manifests.
+'''
+
+
+def ids_to_rows(all_ids, ids):
+    '''
+    Rows of all_ids that are contained in ids, as a sorted manifest. Sort based, O((N + M) log M).
+
+    :param all_ids: Image id of every row of the dataset
+    :param ids: Ids to look up, e.g. the entries of dataset/random_val.txt
+    '''
+    all_ids = np.asarray(all_ids).astype(str)
+    ids = np.unique(np.asarray(ids).astype(str))
+    pos = np.searchsorted(ids, all_ids)
+    pos[pos == len(ids)] = 0
+    if len(ids) == 0:
+        return np.zeros(0, dtype=np.int64)
+    return np.flatnonzero(ids[pos] == all_ids).astype(np.int64)
+
+
+def complement(n, rows):
+    '''Sorted manifest of the rows in range(n) that are not in rows.'''
+    mask = np.ones(n, dtype=bool)
+    mask[np.asarray(rows, dtype=np.int64)] = False
+    return np.flatnonzero(mask).astype(np.int64)
+
+
+def contains(manifest, rows):
+    '''Boolean membership of rows in a sorted manifest.'''
+    rows = np.asarray(rows)
+    if len(manifest) == 0:
+        return np.zeros(rows.shape, dtype=bool)
+    pos = np.searchsorted(manifest, rows)
+    pos[pos == len(manifest)] = 0
+    return manifest[pos] == rows
+
+
+def id_split(all_ids, val_ids):
+    '''
+    Train/val split from a list of validation image ids, as in the Folder_images notebook.
+
+    :param all_ids: Image id of every row of the dataset
+    :param val_ids: Validation image ids, e.g. np.loadtxt('dataset/random_val.txt', dtype=str)
+    '''
+    val = ids_to_rows(all_ids, val_ids)
+    return {'train': complement(len(all_ids), val), 'val': val}
+
+
+def index_split(n, val_idx):
+    '''Train/val split from validation row numbers, e.g. np.loadtxt('dataset/validation.txt').'''
+    val = np.unique(np.asarray(val_idx, dtype=np.int64))
+    return {'train': complement(n, val), 'val': val}
+
+
+def stratified_split(labels, sizes=(('train', 7000), ('val', 1500)), eyeball=0, seed=1):
+    '''
+    Seeded per-class split, the index version of small_abid.ipynb.
+
+    Every class is shuffled once and consecutive blocks of it go to the subsets in the order of sizes.
+    Classes with fewer images fill the subsets in order until they run out.
+
+    :param labels: Label of every row of the dataset
+    :param sizes: Sequence of (name, images per class)
+    :param eyeball: Images per class drawn from the last subset for the eyeball set, 0 for none
+    :param seed: Random seed
+
+    :return: Dictionary of manifests
+    '''
+    labels = np.asarray(labels)
+    rng = np.random.RandomState(seed)
+    sizes = list(sizes)
+    manifests = {name: [] for name, _ in sizes}
+    if eyeball > 0:
+        manifests['eyeball'] = []
+
+    order = np.argsort(labels, kind='stable')
+    classes, starts = np.unique(labels[order], return_index=True)
+    ends = np.append(starts[1:], len(labels))
+    for begin, end in zip(starts, ends):
+        rows = order[begin:end].copy()
+        rng.shuffle(rows)
+        pos = 0
+        for name, size in sizes:
+            manifests[name].append(rows[pos:pos + size])
+            pos += size
+        if eyeball > 0:
+            last = manifests[sizes[-1][0]][-1].copy()
+            rng.shuffle(last)
+            manifests['eyeball'].append(last[:eyeball])
+
+    return {name: np.sort(np.concatenate(parts)).astype(np.int64) if len(parts) > 0
+            else np.zeros(0, dtype=np.int64) for name, parts in manifests.items()}
+
+
+def kfold_split(n, CV, seed=1):
+    '''
+    Cross validation folds with the same permutation as train_and_validate.ipynb
+    (np.random.seed(seed), shuffle, CV equal blocks), without np.setdiff1d.
+
+    :return: List of CV dictionaries with 'train' and 'val' manifests
+    '''
+    indices = np.arange(n)
+    np.random.RandomState(seed).shuffle(indices)
+    splits = (n * np.linspace(0, 1, CV + 1)).astype(int)
+    folds = []
+    for k in range(CV):
+        val = np.sort(indices[splits[k]:splits[k + 1]])
+        folds.append({'train': complement(n, val), 'val': val})
+    return folds
+
+
+def save_manifests(path, manifests):
+    np.savez(path, **manifests)
+
+
+def load_manifests(path):
+    data = np.load(path)
+    return {name: data[name] for name in data.files}
+
+
+def subset_loaders(dsets, manifests, batch_size=32, num_workers=12, shuffle=None, sampler=None):
+    '''
+    Builds DataLoaders over Subset views of the manifests.
+
+    :param dsets: A dataset, or a dictionary of datasets with the same keys as manifests
+    (e.g. the same images with train and val transforms)
+    :param manifests: Dictionary of manifests
+    :param shuffle: Dictionary of shuffle flags, shuffles only 'train' if None
+    :param sampler: Dictionary of samplers over the subset positions, overrides shuffle
+
+    :return: dset_loaders, dset_sizes
+    '''
+    if shuffle is None:
+        shuffle = {name: name == 'train' for name in manifests}
+    if sampler is None:
+        sampler = {}
+    subsets = {}
+    for name, rows in manifests.items():
+        dset = dsets[name] if isinstance(dsets, dict) else dsets
+        subsets[name] = torch.utils.data.Subset(dset, rows.tolist())
+    dset_loaders = {name: torch.utils.data.DataLoader(subsets[name], batch_size=batch_size,
+                                                      shuffle=shuffle[name] and sampler.get(name) is None,
+                                                      sampler=sampler.get(name), num_workers=num_workers)
+                    for name in manifests}
+    dset_sizes = {name: len(rows) for name, rows in manifests.items()}
+    return dset_loaders, dset_sizes
@@ -7,25 +7,32 @@ import numpy as np
 import matplotlib.pyplot as plt
 import os
 from PIL import Image
+from functions.decode import open_draft
 
 default_transform=transforms.Compose([
-        transforms.Scale(256),
+        transforms.Resize(256),
         transforms.CenterCrop(224),
         transforms.ToTensor(),
         transforms.Normalize([0.485, 0.456, 0.406], [0.229, 0.224, 0.225])])
 
 def im2torchNorm(imdir,mean = np.array([0.485, 0.456, 0.406]),std = np.array([0.229, 0.224, 0.225])\
-                 ,imsize=(256,256),imMax=255.):
-    im = Image.open(imdir)
+                 ,imsize=(256,256),imMax=255.,fast_decode=False):
+    if(fast_decode):
+        im = open_draft(imdir, imsize, keep_aspect=False)
+    else:
+        im = Image.open(imdir)
     im = im.resize(imsize)#, Image.ANTIALIAS) # resizes image in-place
-    im=np.asarray(im).astype(np.float)/imMax
+    im=np.asarray(im).astype(np.float64)/imMax
     im=im[16:240,16:240,:]
     im_norm=(im-mean)/std
     return im_norm
 
 
-def im2torchTransform(imdir, transform=default_transform):
-    im = Image.open(imdir)
+def im2torchTransform(imdir, transform=default_transform, fast_decode=False, decode_size=256):
+    if(fast_decode):
+        im = open_draft(imdir, decode_size)
+    else:
+        im = Image.open(imdir)
     return transform(im).numpy().transpose(1,2,0)
 
 def subsetCreator(rootdir,im_per_room=10,roomdirs=['//BR//','//Kitchen//','//LR//'],multi_dir=True):
@@ -48,7 +55,7 @@ def subsetCreator(rootdir,im_per_room=10,roomdirs=['//BR//','//Kitchen//','//LR/
                         if im_per_room==0:
                             rand_idx=range(len(imdirs_c))
                         else:
-                            rand_idx=np.floor(np.random.rand(im_per_room)*len(imdirs_c)).astype(np.int)
+                            rand_idx=np.floor(np.random.rand(im_per_room)*len(imdirs_c)).astype(int)
                         for idx in rand_idx:
                             imdirs.append(parentdir+'//'+imdirs_c[idx])
                             house.append(hme+1)
@@ -58,7 +65,7 @@ def subsetCreator(rootdir,im_per_room=10,roomdirs=['//BR//','//Kitchen//','//LR/
 
 
 
-def torchFromDirs(imdirs,im_dims=[224,224,3],begin_idx=0,batch_size=16):
+def torchFromDirs(imdirs,im_dims=[224,224,3],begin_idx=0,batch_size=16,use_gpu=True):
     if len(imdirs)<begin_idx:
         raise ValueError('Begin index cannot be higher than the length of image dirs')
     if len(imdirs)<begin_idx+batch_size:
@@ -67,7 +74,10 @@ def torchFromDirs(imdirs,im_dims=[224,224,3],begin_idx=0,batch_size=16):
     for k in range(batch_size):
         imgs[k,:,:,:]=im2torchTransform(imdirs[begin_idx+k])
 
-    im_torch=Variable(torch.from_numpy(imgs.transpose(0,3,1,2)).cuda()).float()
+    im_torch=torch.from_numpy(imgs.transpose(0,3,1,2))
+    if(use_gpu):
+        im_torch=im_torch.cuda()
+    im_torch=Variable(im_torch).float()
     return im_torch
 
 def class_based_cirs(label,pred):
@@ -91,11 +101,11 @@ def class_based_cirs(label,pred):
     cir2s[9]=np.mean(err<=2)
     return cirs,cir1s,cir2s
 
-def extractFeats(imdirs,network,batchsize=16,outsize=512):
+def extractFeats(imdirs,network,batchsize=16,outsize=512,use_gpu=True):
     fvec=np.zeros([len(imdirs),outsize])
 
     for k in range(0,len(imdirs),batchsize):
-        im_torch=torchFromDirs(imdirs,begin_idx=k,batch_size=batchsize)
+        im_torch=torchFromDirs(imdirs,begin_idx=k,batch_size=batchsize,use_gpu=use_gpu)
         feat=network(im_torch)
         feat=feat.cpu()
         feat=feat.data.numpy()
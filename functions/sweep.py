@@ -0,0 +1,385 @@
+from __future__ import print_function, division
+
+import torch
+import torch.nn as nn
+import torch.multiprocessing as mp
+import numpy as np
+import os
+import csv
+import json
+import time
+import random
+import hashlib
+import itertools
+import traceback
+from torchvision import models
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+import functions.fine_tune as ft
+from functions.data import load_data
+from functions.losses import get_soft_matrices, make_coeff, resolve_algo
+from functions.run_log import NullWriter, RunLog, read_log
+from functions.shards import ShardDataset, folder_to_shards
+
+'''
+Parallel hyperparameter sweeps of train_model.
+
+A spec lists the train_model arguments of the runs, fixed, on a grid and/or drawn at random:
+
+  {"fixed":  {"num_epochs": 30, "batch_size": 16, "optim": "sgd", "lr_decay_epoch": 7},
+   "grid":   {"algo": ["softmax", "cheng"], "metric": ["ccr", "ccr1", "mae"]},
+   "random": {"lr": ["loguniform", 1e-4, 1e-1], "coeff_lmbda": ["uniform", 0, 1], "momentum": [0, 0.9]},
+   "samples": 4, "seed": 0}
+
+Every grid point is run with samples draws of the random arguments (a list is a choice, ["uniform" |
+"loguniform" | "int", low, high] a distribution). Besides the train_model arguments a run takes the
+arguments of the notebook's setup cell: arch, pretrained, end_to_end, optim, lr (init_lr), metric and
+coeff_lmbda (multi_coeff = single_coeff = make_coeff(numOut, metric, 'sigmoid', coeff_lmbda) and the
+softmax_matrices of the metric) and seed. Runs are compared in the results table, nothing is exported to
+logs.xlsx (a spec with iter_loc is rejected). The loaders are the ones of data.load_data on the shards,
+with its uniform_sampler (class-balanced draws by default, as the notebook) and replacement arguments, so a
+swept configuration trains as a notebook run.
+
+Images are decoded once into the memory mapped shards of shards.py (run_sweep builds them from an image
+folder if needed); every worker process maps the same shard files, so all runs read one copy of the
+decoded pixels from the page cache. Runs are started longest first (num_epochs x arch cost), at most
+workers at a time with threads intra-op threads each, a new process per run, so that cores stay busy
+until the last runs. Run processes are not daemonic and can have DataLoader workers (loader_workers); a
+run whose process dies (e.g. killed out of memory) is recorded as failed with the time since its start. The
+parent writes one row per run to <sweep_dir>/results.csv; runs already in the table are skipped, an
+interrupted sweep is resumed by running it again.
+
+  results = sweep.run_sweep(spec, '/data/abid/shards', '../results/sweep_lr', image_dir='/data/abid/images')
+
+  python -m functions.sweep spec.json --shards /data/abid/shards --images /data/abid/images \\
+      --out ../results/sweep_lr --workers 8 --threads 2
+'''
+
+RESULT_FIELDS = ('status', 'best_epoch', 'val_rmse', 'val_mae', 'val_acc', 'val_cir1', 'train_rmse',
+                 'last_val_rmse', 'last_val_acc', 'epochs', 'seconds', 'error')
+
+TEXT_FIELDS = ('job', 'status', 'error')
+
+DISTRIBUTIONS = ('uniform', 'loguniform', 'int')
+
+# Relative cost of an epoch of every architecture, to start the longest runs first
+ARCH_COST = {'resnet18': 1., 'resnet34': 2., 'resnet50': 2.3, 'resnet101': 4., 'resnet152': 6.}
+
+# Arguments of the runner, the others are passed to train_model
+RUN_DEFAULTS = {'arch': 'resnet18', 'pretrained': True, 'end_to_end': True, 'optim': 'sgd', 'lr': 0.001,
+                'metric': None, 'coeff_lmbda': 1., 'seed': 0, 'crop_size': 224,
+                'batch_size': 4, 'num_epochs': 25, 'uniform_sampler': True, 'replacement': True}
+
+
+def grid(values):
+    '''Every combination of a dictionary of argument -> list of values, as dictionaries.'''
+    names = sorted(values)
+    return [dict(zip(names, combination)) for combination in itertools.product(*[values[n] for n in names])]
+
+
+def draw(value, rng):
+    '''One draw of a random argument of a spec.'''
+    if len(value) == 3 and value[0] in DISTRIBUTIONS:
+        kind, low, high = value
+        if kind == 'uniform':
+            return float(rng.uniform(low, high))
+        if kind == 'loguniform':
+            return float(np.exp(rng.uniform(np.log(low), np.log(high))))
+        return int(rng.randint(low, high + 1))
+    return value[rng.randint(len(value))]
+
+
+def expand(spec):
+    '''
+    Configurations of a spec, the fixed arguments updated with a grid point and a draw of the random ones.
+
+    :return: List of dictionaries
+    '''
+    rng = np.random.RandomState(spec.get('seed', 0))
+    points = grid(spec.get('grid', {}))
+    randoms = spec.get('random', {})
+    samples = spec.get('samples', 1) if randoms else 1
+    configs = []
+    for point in points:
+        for k in range(samples):
+            config = dict(spec.get('fixed', {}))
+            config.update(point)
+            config.update({name: draw(randoms[name], rng) for name in sorted(randoms)})
+            configs.append(config)
+    return configs
+
+
+def job_key(config):
+    '''Run name of a configuration, a hash of its arguments.'''
+    return hashlib.sha1(json.dumps(config, sort_keys=True).encode('utf-8')).hexdigest()[:12]
+
+
+def job_cost(config):
+    arch = config.get('arch', RUN_DEFAULTS['arch'])
+    return config.get('num_epochs', RUN_DEFAULTS['num_epochs']) * ARCH_COST.get(arch, 1.)
+
+
+def build_model(arch, numOut, pretrained=True, end_to_end=True):
+    '''torchvision arch with a numOut outputs last layer, as network_loader of the notebook.'''
+    model = getattr(models, arch)(weights='DEFAULT' if pretrained else None)
+    if not end_to_end:
+        for param in model.parameters():
+            param.requires_grad = False
+    model.fc = nn.Linear(model.fc.in_features, numOut)
+    return model
+
+
+def train_arguments(config, numOut):
+    '''train_model keyword arguments of a configuration.'''
+    options = dict(RUN_DEFAULTS)
+    options.update(config)
+    kwargs = {name: value for name, value in config.items() if name not in RUN_DEFAULTS}
+    kwargs.update(num_epochs=options['num_epochs'], batch_size=options['batch_size'], init_lr=options['lr'],
+                  numOut=numOut)
+    if options['metric'] is not None:
+        coeff = make_coeff(numOut, options['metric'], loss='sigmoid', lmbda=options['coeff_lmbda'])
+        kwargs.update(multi_coeff=coeff, single_coeff=coeff,
+                      softmax_matrices=get_soft_matrices(options['metric'], numOut))
+    return options, kwargs
+
+
+def _result(run, seconds):
+    tr, val = run['train'], run['val']
+    n = min(len(tr['epoch']), len(val['epoch']))
+    best = int(np.argmin(val['rmse'][:n]))
+    return {'status': 'ok', 'best_epoch': int(val['epoch'][best]), 'val_rmse': val['rmse'][best],
+            'val_mae': val['mae'][best], 'val_acc': val['acc'][best], 'val_cir1': val['cir1'][best],
+            'train_rmse': tr['rmse'][best], 'last_val_rmse': val['rmse'][n - 1],
+            'last_val_acc': val['acc'][n - 1], 'epochs': n, 'seconds': seconds}
+
+
+def _run_job(job):
+    '''Trains one configuration and returns its row of the results table.'''
+    key, config, shard_dir, sweep_dir, numOut, options = job
+    since = time.time()
+    sink = None
+    try:
+        torch.set_num_threads(options['threads'])
+        run, kwargs = train_arguments(config, numOut)
+        torch.manual_seed(run['seed'])
+        np.random.seed(run['seed'])
+        random.seed(run['seed'])
+
+        dset_loaders, dset_sizes, _ = load_data('real', None, uniform_sampler=run['uniform_sampler'],
+                                                batch_size=run['batch_size'], shard_dir=shard_dir,
+                                                crop_size=run['crop_size'], replacement=run['replacement'],
+                                                sampler_seed=run['seed'], num_workers=options['loader_workers'])
+
+        model = build_model(run['arch'], numOut, run['pretrained'], run['end_to_end'])
+        if options['tensorboard_dir'] is not None:
+            from tensorboardX import SummaryWriter
+            writer = SummaryWriter(os.path.join(options['tensorboard_dir'], key))
+        else:
+            writer = NullWriter()
+        log_path = os.path.join(sweep_dir, 'runs', key + '_epochs.csv')
+        sink = RunLog(log_path)
+        best_model, last_model, _ = ft.train_model(model, run['optim'], ft.exp_lr_scheduler, dset_loaders,
+                                                   dset_sizes, writer, use_gpu=options['use_gpu'],
+                                                   logname=None, log_sink=sink, run_id=key, **kwargs)
+        sink.close()
+        sink = None
+        if hasattr(writer, 'close'):
+            writer.close()
+        if options['save_models']:
+            algo = resolve_algo(**{name: value for name, value in kwargs.items()
+                                   if name in resolve_algo.__code__.co_varnames})
+            torch.save({'model': best_model.state_dict(), 'algo': algo},
+                       os.path.join(sweep_dir, 'runs', key + '.pt'))
+        row = _result(read_log(log_path)[key], time.time() - since)
+    except Exception:
+        row = {'status': 'failed', 'seconds': time.time() - since,
+               'error': traceback.format_exc().strip().splitlines()[-1]}
+        print('Run {} failed:\n{}'.format(key, traceback.format_exc()))
+    finally:
+        if sink is not None:
+            sink.close()
+    row['job'] = key
+    return row
+
+
+def _job_process(job, results):
+    results.put(_run_job(job))
+
+
+def _schedule(jobs, workers, poll=1.):
+    '''
+    Runs _run_job over jobs (in order) in spawned processes, at most workers at a time.
+
+    :return: Generator of the rows, in completion order
+    '''
+    ctx = mp.get_context('spawn')
+    results = ctx.Queue()
+    pending = list(jobs)
+    running = {}
+    try:
+        while pending or running:
+            while pending and len(running) < workers:
+                job = pending.pop(0)
+                process = ctx.Process(target=_job_process, args=(job, results))
+                process.start()
+                running[job[0]] = (process, time.time())
+            try:
+                row = results.get(timeout=poll)
+            except queue.Empty:
+                # A process that exited without its row was killed or crashed
+                for key, (process, started) in list(running.items()):
+                    if not process.is_alive() and process.exitcode != 0:
+                        del running[key]
+                        yield {'job': key, 'status': 'failed', 'seconds': time.time() - started,
+                               'error': 'Run process exited with code {}'.format(process.exitcode)}
+                continue
+            running.pop(row['job'])[0].join()
+            yield row
+    finally:
+        for process, _ in running.values():
+            process.terminate()
+            process.join()
+
+
+def _format(value):
+    if isinstance(value, (bool, list, tuple, dict)):
+        return json.dumps(value)
+    if isinstance(value, (float, np.floating)):
+        return repr(float(value))
+    return value
+
+
+def _parse(value):
+    try:
+        return json.loads(value)
+    except ValueError:
+        return value
+
+
+def load_results(path):
+    '''Rows of a results table (a file or a sweep directory), numbers and lists parsed, '' for missing cells.'''
+    if os.path.isdir(path):
+        path = os.path.join(path, 'results.csv')
+    if not os.path.exists(path):
+        return []
+    with open(path) as f:
+        return [{name: _parse(value) if value != '' and name not in TEXT_FIELDS else value
+                 for name, value in row.items()} for row in csv.DictReader(f)]
+
+
+def write_results(path, rows):
+    '''Rewrites the results table atomically, one column per argument found in any configuration.'''
+    names = sorted(set(name for row in rows for name in row) - set(RESULT_FIELDS) - {'job'})
+    with open(path + '.tmp', 'w') as f:
+        writer = csv.writer(f)
+        writer.writerow(['job'] + names + list(RESULT_FIELDS))
+        for row in rows:
+            writer.writerow([_format(row.get(name, '')) for name in ['job'] + names + list(RESULT_FIELDS)])
+    os.replace(path + '.tmp', path)
+
+
+def run_sweep(spec, shard_dir, sweep_dir, image_dir=None, imsize=(256, 256), workers=None, threads=None,
+              numOut=None, use_gpu=False, loader_workers=0, tensorboard_dir=None, save_models=False,
+              retry_failed=True):
+    '''
+    Runs every configuration of a spec not yet in the results table of sweep_dir.
+
+    :param spec: Spec dictionary (see expand) or a list of configurations
+    :param shard_dir: Directory with train/ and val/ shard directories (shards.folder_to_shards)
+    :param image_dir: ImageFolder tree with train/ and val/, converted to shard_dir at imsize if the shards
+    do not exist
+    :param workers: Concurrent runs, as many as the cores (or cores / threads) if None
+    :param threads: Intra-op threads of every run, the cores split evenly between the workers if None
+    :param loader_workers: DataLoader workers of every run, 0 loads the crops in the training process
+    :param tensorboard_dir: Every run writes TensorBoard scalars to <tensorboard_dir>/<job> if given
+    :param save_models: Save the best model of every run as a checkpoint (inference.load_model) in
+    <sweep_dir>/runs/<job>.pt
+    :param retry_failed: Run again the configurations whose previous run failed
+
+    :return: Rows of the results table, configuration arguments and RESULT_FIELDS
+    '''
+    if not os.path.exists(os.path.join(shard_dir, 'train', 'index.npz')):
+        if image_dir is None:
+            raise ValueError('No shards in {} and no image_dir to build them from'.format(shard_dir))
+        folder_to_shards(image_dir, shard_dir, imsize=imsize)
+    if numOut is None:
+        numOut = len(ShardDataset(os.path.join(shard_dir, 'train')).classes)
+    if not os.path.exists(os.path.join(sweep_dir, 'runs')):
+        os.makedirs(os.path.join(sweep_dir, 'runs'))
+
+    configs = expand(spec) if isinstance(spec, dict) else list(spec)
+    if any('iter_loc' in config for config in configs):
+        raise ValueError('iter_loc is not a sweep argument, runs are compared in results.csv')
+    results_path = os.path.join(sweep_dir, 'results.csv')
+    done = {row['job']: row for row in load_results(results_path)
+            if row['status'] == 'ok' or not retry_failed}
+    rows = list(done.values())
+    jobs = {}
+    for config in configs:
+        key = job_key(config)
+        if key not in done:
+            jobs[key] = config
+    if not jobs:
+        print('All {} runs of the sweep are done'.format(len(configs)))
+        return rows
+
+    cpus = os.cpu_count() or 1
+    if workers is None:
+        workers = min(len(jobs), max(1, cpus // (threads or 1)))
+    if threads is None:
+        threads = max(1, cpus // workers)
+    options = {'threads': threads, 'use_gpu': use_gpu, 'loader_workers': loader_workers,
+               'tensorboard_dir': tensorboard_dir, 'save_models': save_models}
+
+    # Download the pretrained weights once instead of in every worker
+    for arch in sorted(set(c.get('arch', RUN_DEFAULTS['arch']) for c in jobs.values()
+                           if c.get('pretrained', RUN_DEFAULTS['pretrained']))):
+        build_model(arch, numOut)
+
+    order = sorted(jobs, key=lambda key: job_cost(jobs[key]), reverse=True)
+    print('{} runs ({} done) on {} workers x {} threads'.format(len(order), len(done), workers, threads))
+    args = [(key, jobs[key], shard_dir, sweep_dir, numOut, options) for key in order]
+    for k, result in enumerate(_schedule(args, workers)):
+        row = dict(jobs[result['job']])
+        row.update(result)
+        rows = [r for r in rows if r['job'] != row['job']] + [row]
+        write_results(results_path, rows)
+        print('[{}/{}] run {} {}: val RMSE {}'.format(k + 1, len(order), row['job'], row['status'],
+                                                      row.get('val_rmse', '-')))
+    return rows
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Parallel hyperparameter sweep of train_model')
+    parser.add_argument('spec', help='JSON spec (fixed, grid, random, samples, seed)')
+    parser.add_argument('--shards', required=True, help='Shard directory with train/ and val/')
+    parser.add_argument('--images', default=None, help='Image folder with train/ and val/ to build the shards')
+    parser.add_argument('--imsize', type=int, nargs=2, default=[256, 256], help='Size of the shard records')
+    parser.add_argument('--out', required=True, help='Sweep directory (results.csv and run logs)')
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--threads', type=int, default=None)
+    parser.add_argument('--numOut', type=int, default=None)
+    parser.add_argument('--gpu', action='store_true')
+    parser.add_argument('--loader-workers', type=int, default=0)
+    parser.add_argument('--tensorboard', default=None, help='Directory of the TensorBoard runs')
+    parser.add_argument('--save-models', action='store_true')
+    parser.add_argument('--top', type=int, default=10, help='Number of best runs printed')
+    args = parser.parse_args()
+
+    with open(args.spec) as f:
+        spec = json.load(f)
+    rows = run_sweep(spec, args.shards, args.out, image_dir=args.images, imsize=tuple(args.imsize),
+                     workers=args.workers, threads=args.threads, numOut=args.numOut, use_gpu=args.gpu,
+                     loader_workers=args.loader_workers, tensorboard_dir=args.tensorboard,
+                     save_models=args.save_models)
+    ranked = sorted((row for row in rows if row['status'] == 'ok'), key=lambda row: float(row['val_rmse']))
+    for row in ranked[:args.top]:
+        config = {name: row[name] for name in row if name not in RESULT_FIELDS and name != 'job'}
+        print('{:8.4f} epoch {:3d} {} {}'.format(float(row['val_rmse']), int(row['best_epoch']), row['job'],
+                                                 json.dumps(config, sort_keys=True)))
@@ -0,0 +1,45 @@
+import numpy as np
+import pytest
+
+from functions.prediction_store import PredictionStore
+
+
+def brute_force(labels, preds, epochs, label=None, pred=None, error=None, epoch=None):
+    mask = np.ones(len(labels), dtype=bool)
+    for values, c in ((labels, label), (preds, pred), (np.abs(preds - labels), error), (epochs, epoch)):
+        if c is None:
+            continue
+        lo, hi = c if isinstance(c, tuple) else (c, c)
+        if lo is not None:
+            mask &= values >= lo
+        if hi is not None:
+            mask &= values <= hi
+    return np.flatnonzero(mask)
+
+
+@pytest.fixture
+def store(tmp_path):
+    # Raw labels of inference inputs go past numOut, predictions stay in [0, numOut - 1]
+    rng = np.random.RandomState(0)
+    numOut, n = 6, 3000
+    labels = rng.randint(0, 30, 2 * n)
+    preds = rng.randint(0, numOut, 2 * n)
+    epochs = np.repeat([3, 7], n)
+    s = PredictionStore(str(tmp_path / 'store'), numOut)
+    for k, e in enumerate((3, 7)):
+        rows = slice(k * n, (k + 1) * n)
+        s.append(['img{}'.format(i) for i in range(n)], labels[rows], preds[rows],
+                 np.full((n, numOut), 1. / numOut), e)
+    return s, labels, preds, epochs
+
+
+@pytest.mark.parametrize('conditions', [
+    {'label': 12}, {'label': 29}, {'label': (7, 20)}, {'label': 30}, {'label': -1},
+    {'pred': 3}, {'pred': (None, 2), 'label': (10, None)},
+    {'error': (20, None)}, {'error': 0}, {'label': 12, 'pred': (1, 4)},
+])
+def test_query_labels_above_numOut(store, conditions):
+    s, labels, preds, epochs = store
+    for epoch in (3, 7, None):
+        expected = brute_force(labels, preds, epochs, epoch=epoch, **conditions)
+        np.testing.assert_array_equal(s.query(epoch=epoch, **conditions), expected)
@@ -0,0 +1,99 @@
+import os
+import time
+
+import numpy as np
+import pytest
+import torch
+import torch.nn as nn
+from PIL import Image
+
+from functions.checkpoint import load_checkpoint
+from functions.data import load_data
+from functions.fine_tune import train_model
+from functions.run_log import NullWriter
+from functions.shards import folder_to_shards
+
+STEPS, EVERY, STOP = 12, 5, (1, 5)  # steps per epoch, checkpoint_every, (epoch, step) of the interruption
+
+
+class TinyNet(nn.Module):
+    def __init__(self, numOut=6):
+        super(TinyNet, self).__init__()
+        self.pool = nn.AdaptiveAvgPool2d(4)
+        self.fc = nn.Linear(3 * 16, numOut)
+
+    def forward(self, x):
+        return self.fc(self.pool(x).flatten(1))
+
+
+class Interrupted(Exception):
+    pass
+
+
+class Recorder(object):
+    '''Training batch_transform that keeps every batch and optionally stops after a checkpoint.'''
+
+    def __init__(self, checkpoint_path=None, stop=None):
+        self.batches = []
+        self.checkpoint_path = checkpoint_path
+        self.stop = stop
+
+    def __call__(self, inputs):
+        if self.stop is not None and len(self.batches) == self.stop[0] * STEPS + self.stop[1]:
+            # The checkpoint of the previous step boundary is written in the background
+            deadline = time.time() + 60
+            while time.time() < deadline:
+                if os.path.exists(self.checkpoint_path):
+                    checkpoint = load_checkpoint(self.checkpoint_path)
+                    if (checkpoint['epoch'], checkpoint['step']) == self.stop:
+                        raise Interrupted()
+                time.sleep(0.05)
+            raise AssertionError('No checkpoint at {}'.format(self.stop))
+        self.batches.append(inputs.cpu().clone())
+        return inputs
+
+
+@pytest.fixture(scope='module')
+def shard_dir(tmp_path_factory):
+    root = tmp_path_factory.mktemp('images')
+    rng = np.random.RandomState(0)
+    for phase, n in (('train', 48), ('val', 16)):
+        for i in range(n):
+            class_dir = root / phase / str(i % 6)
+            class_dir.mkdir(parents=True, exist_ok=True)
+            size = (48 + 4 * (i % 5), 40 + 3 * (i % 7))
+            Image.fromarray(rng.randint(0, 256, size + (3,), dtype=np.uint8)).save(
+                str(class_dir / '{}.png'.format(i)))
+    out_dir = tmp_path_factory.mktemp('shards')
+    folder_to_shards(str(root), str(out_dir), imsize=(40, 40), num_workers=2)
+    return str(out_dir)
+
+
+def run(shard_dir, recorder, checkpoint_path, resume=False):
+    torch.manual_seed(0)
+    loaders, sizes, _ = load_data('real', None, batch_size=4, shard_dir=shard_dir, crop_size=32, num_workers=2)
+    assert len(loaders['train']) == STEPS
+    _, last_model, _ = train_model(TinyNet(), 'sgd', None, loaders, sizes, NullWriter(), use_gpu=False,
+                                   num_epochs=2, batch_size=4, algo='softmax', logname=None,
+                                   batch_transform={'train': recorder, 'val': lambda x: x}, prefetch=1,
+                                   checkpoint_path=checkpoint_path, checkpoint_every=EVERY, resume=resume)
+    return last_model.state_dict()
+
+
+def test_resume_replays_batches(shard_dir, tmp_path):
+    full = Recorder()
+    full_state = run(shard_dir, full, str(tmp_path / 'full.pt'))
+    assert len(full.batches) == 2 * STEPS
+
+    path = str(tmp_path / 'resumed.pt')
+    with pytest.raises(Interrupted):
+        run(shard_dir, Recorder(path, stop=STOP), path)
+    resumed = Recorder()
+    resumed_state = run(shard_dir, resumed, path, resume=True)
+
+    start = STOP[0] * STEPS + STOP[1]
+    assert len(resumed.batches) == len(full.batches) - start
+    for a, b in zip(full.batches[start:], resumed.batches):
+        assert torch.equal(a, b)
+    for key in full_state:
+        assert torch.equal(full_state[key], resumed_state[key])